@@ -1,13 +1,35 @@
 import os
+import codecs
 from datetime import datetime
 
-from flask import Flask, request, abort, jsonify, render_template
+from flask import Flask, request, abort, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_migrate import Migrate
+from sqlalchemy import func, and_, or_, text, cast, literal_column, Integer, inspect
 
-from models import setup_db, User, Organisation, Event
+from models import setup_db, init_db_command, geocode_events_command, User, Organisation, \
+    Event, add_participants, remove_participants, participant_ids
 from auth import AuthError, requires_auth
+from db_pool import pool_stats
+import replicas
+from replicas import replica_reads, replica_set
+import metrics
+import slow_queries
+import profiler
+from json_backend import jsonify
+from queries import query_events, format_event_row, \
+    query_organisations, format_organisation_row, \
+    event_search_query, event_search_rank, skills_match_count, \
+    within_box, radius_box, location_order, distance_km
+from response_cache import response_cache, cached_response, expire_cached_response_at
+from etags import event_etag, organisation_etag, is_not_modified, not_modified
+from streaming import stream_json_response, STREAM_BATCH_SIZE
+from pagination import split_page, after_cursor, before_cursor, ranked_after_cursor, \
+    nearest_after_cursor, split_nearest_page, get_page_limit, get_datetime_arg, get_bool_arg, \
+    get_float_arg
+from bulk_events import FORMATS, read_records, import_events, ndjson_response, \
+    export_response, import_events_command, export_events_command, EVENT_FIELDS
 
 app = Flask(__name__)
 db = setup_db(app)
@@ -15,11 +37,32 @@ db = setup_db(app)
 CORS(app)
 
 migrate = Migrate(app, db)
+#reads of the subject of a write stay on the primary for a while
+replicas.init_app(app)
+#per route latency, query and token verification metrics, if METRICS_ENABLED
+metrics.init_app(app)
+#statements slower than SLOW_QUERY_MS are logged, `flask slow-queries` summarises them
+slow_queries.init_app(app)
+#requests with an X-Profile header are answered with their sampled stacks
+profiler.init_app(app)
+app.cli.add_command(init_db_command)
+app.cli.add_command(geocode_events_command)
+app.cli.add_command(import_events_command)
+app.cli.add_command(export_events_command)
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 API_AUDIENCE = os.environ['API_AUDIENCE']
 AUTH0_CLIENT_ID = os.environ['AUTH0_CLIENT_ID']
 
+#most items accepted by a bulk endpoint in one request
+MAX_BULK_SIZE = int(os.getenv('MAX_BULK_SIZE', 500))
+#longest search text, and most skills searched at once
+MAX_SEARCH_LENGTH = 200
+MAX_SEARCH_SKILLS = 20
+#radius of GET /events/nearby, km
+DEFAULT_NEARBY_RADIUS = 10
+MAX_NEARBY_RADIUS = 500
+
 if os.getenv('FLASK_ENV', None) == 'development':
     DOMAIN = "http://localhost:5000"
 else:
@@ -59,28 +102,276 @@ def login_results():
 #----------------------------------------------------------------------------#
 # Api Endpoints - Events
 #----------------------------------------------------------------------------#
+def listing_cache_key(name):
+    """Cache key of a listing request, streamed listings are not cached"""
+    if request.args.get('stream', 'false').lower() in ('true', '1'):
+        return None
+    return response_cache.listing_key(name)
+
+def event_exists(event_id):
+    """Check an event exists without loading it"""
+    return db.session.query(Event.id).filter(Event.id == event_id).first() is not None
+
+def formatted_event(event):
+    """Event.format() of a committed event, reloaded in two queries with
+    Event.format_options rather than refreshed and lazy loaded"""
+    event_id = inspect(event).identity[0]
+    return Event.query.options(*Event.format_options()).populate_existing() \
+        .filter(Event.id == event_id).one().format()
+
 """
-Get all events
+Get events, ordered by start_datetime and paginated by cursor.
+With stream=true every matching event is streamed in a single response
 """
 @app.route('/events', methods=['GET'])
+@replica_reads
+@cached_response(lambda: listing_cache_key('events'))
 def get_events():
-    events = Event.query.all()
+    stream = get_bool_arg('stream')
+    limit = get_page_limit()
+    query = query_events()
+
+    org_id = request.args.get('organisation_id', None)
+    if org_id is not None:
+        if not org_id.isdigit():
+            abort(400)
+        query = query.filter(Event.organisation_id == int(org_id))
+
+    start_from = get_datetime_arg('start_from')
+    if start_from is not None:
+        query = query.filter(Event.start_datetime >= start_from)
+    start_to = get_datetime_arg('start_to')
+    if start_to is not None:
+        query = query.filter(Event.start_datetime < start_to)
+    if get_bool_arg('upcoming'):
+        query = query.filter(Event.end_datetime > datetime.now())
+
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        try:
+            query = query.filter(after_cursor(Event.start_datetime, Event.id, cursor))
+        except ValueError:
+            abort(400)
+
+    query = query.order_by(Event.start_datetime.asc().nullslast(), Event.id.asc())
+    if stream:
+        return stream_json_response({
+            'success': True,
+            'data': (format_event_row(row) for row in query.yield_per(STREAM_BATCH_SIZE)),
+            'next_cursor': None
+        })
+
+    rows, next_cursor = split_page(query.limit(limit + 1).all(), limit,
+        lambda row: [row.start_datetime, row.id])
+
     return jsonify({
         'success': True, 
-        'data': [e.format() for e in events]
+        'data': [format_event_row(row) for row in rows],
+        'next_cursor': next_cursor
     })
 
 """
-Get specific event
+Get specific event, supports conditional GET with If-None-Match
 """
 @app.route('/events/<int:event_id>', methods=['GET'])
+@replica_reads
+@cached_response(lambda event_id: response_cache.row_key('event', event_id))
 def get_event(event_id):
-    event = Event.query.get_or_404(event_id)
-    return jsonify({
+    if request.if_none_match:
+        #check the version alone before loading participants
+        version = db.session.query(Event.version) \
+            .filter(Event.id == event_id).scalar()
+        if version is None:
+            abort(404)
+        etag = event_etag(event_id, version)
+        if is_not_modified(etag):
+            return not_modified(etag)
+
+    row = query_events().filter(Event.id == event_id).first()
+    if row is None:
+        abort(404)
+    response = jsonify({
         'success': True, 
-        'data': event.format()
+        'data': format_event_row(row)
+    })
+    response.set_etag(event_etag(row.id, row.version))
+    return response
+
+"""
+Get participant counts per event, ordered by start_datetime and paginated
+by cursor. Served by an index-only scan, participants are not loaded
+"""
+@app.route('/events/summary', methods=['GET'])
+@replica_reads
+def get_events_summary():
+    limit = get_page_limit()
+    query = db.session.query(
+        Event.id, Event.start_datetime, Event.organisation_id, Event.participant_count)
+
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        try:
+            query = query.filter(after_cursor(Event.start_datetime, Event.id, cursor))
+        except ValueError:
+            abort(400)
+
+    rows, next_cursor = split_page(
+        query.order_by(Event.start_datetime.asc().nullslast(), Event.id.asc())
+            .limit(limit + 1).all(),
+        limit, lambda row: [row.start_datetime, row.id])
+
+    return jsonify({
+        'success': True,
+        'data': [{
+            'id': row.id,
+            'start_datetime': row.start_datetime,
+            'organisation_id': row.organisation_id,
+            'participant_count': row.participant_count,
+        } for row in rows],
+        'next_cursor': next_cursor
+    })
+
+"""
+Search events by keywords in their name, description and address, best
+matches first and paginated by cursor. q is parsed like a web search:
+"quoted phrases", `or` and -excluded words
+"""
+@app.route('/events/search', methods=['GET'])
+@replica_reads
+def search_events():
+    q = request.args.get('q', '').strip()
+    if not q or len(q) > MAX_SEARCH_LENGTH:
+        abort(400)
+    limit = get_page_limit()
+    tsquery = event_search_query(q)
+    rank = event_search_rank(tsquery)
+    query = query_events().add_columns(rank.label('rank')) \
+        .filter(Event.search_vector.op('@@')(tsquery))
+    if get_bool_arg('upcoming'):
+        query = query.filter(Event.end_datetime > datetime.now())
+
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        try:
+            query = query.filter(ranked_after_cursor(rank, Event.id, cursor))
+        except ValueError:
+            abort(400)
+
+    rows, next_cursor = split_page(
+        query.order_by(rank.desc(), Event.id.asc()).limit(limit + 1).all(),
+        limit, lambda row: [row.rank, row.id])
+
+    return jsonify({
+        'success': True,
+        'data': [format_event_row(row) for row in rows],
+        'next_cursor': next_cursor
+    })
+
+"""
+Find the geocoded events within radius_km of (lat, lng), or in a box 
+(bbox=min_lng,min_lat,max_lng,max_lat), nearest to the center first and
+paginated by cursor. Both are nearest neighbour scans of the GiST index on
+event locations, the order is the index's: by degrees of latitude and
+longitude, the distance_km of each event is the great circle distance.
+Pages can hold less than limit events
+"""
+@app.route('/events/nearby', methods=['GET'])
+@replica_reads
+def get_nearby_events():
+    limit = get_page_limit()
+    bbox = request.args.get('bbox', None)
+    if bbox is not None:
+        if any(name in request.args for name in ('lat', 'lng', 'radius_km')):
+            abort(400)
+        try:
+            min_lng, min_lat, max_lng, max_lat = [float(value) for value in bbox.split(',')]
+        except ValueError:
+            abort(400)
+        if not (-180 <= min_lng <= max_lng <= 180 and -90 <= min_lat <= max_lat <= 90):
+            abort(400)
+        lat, lng = (min_lat + max_lat) / 2, (min_lng + max_lng) / 2
+        condition = within_box(min_lng, min_lat, max_lng, max_lat)
+    else:
+        lat = get_float_arg('lat', -90, 90)
+        lng = get_float_arg('lng', -180, 180)
+        radius = get_float_arg('radius_km', 0, MAX_NEARBY_RADIUS)
+        if lat is None or lng is None or radius == 0:
+            abort(400)
+        radius = radius or DEFAULT_NEARBY_RADIUS
+        #the box is served by the index, the radius checked on the rows in it
+        condition = and_(within_box(*radius_box(lat, lng, radius)),
+            distance_km(lat, lng) <= radius)
+
+    order = location_order(lng, lat)
+    query = query_events().add_columns(order.label('location_order'),
+        distance_km(lat, lng).label('distance_km')).filter(condition)
+    if get_bool_arg('upcoming'):
+        query = query.filter(Event.end_datetime > datetime.now())
+
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        try:
+            query = query.filter(nearest_after_cursor(order, Event.id, cursor))
+        except ValueError:
+            abort(400)
+
+    #ordering by distance alone, the index returns the nearest events first
+    #and the scan stops at the end of the page
+    page = split_nearest_page(query.order_by(order).limit(limit + 1).all(),
+        limit, lambda row: row.location_order)
+    if page is None:
+        #more than a page of events at the same distance, sorted by id
+        page = split_page(query.order_by(order, Event.id.asc()).limit(limit + 1).all(),
+            limit, lambda row: [row.location_order, row.id])
+    rows, next_cursor = page
+
+    return jsonify({
+        'success': True,
+        'data': [dict(format_event_row(row), distance_km=round(row.distance_km, 3))
+            for row in rows],
+        'next_cursor': next_cursor
     })
 
+"""
+Export every event, or an organisation's, as NDJSON or CSV in a single 
+streamed response
+"""
+@app.route('/events/export', methods=['GET'])
+@replica_reads
+def export_events():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        abort(400)
+    org_id = request.args.get('organisation_id', None)
+    if org_id is not None:
+        if not org_id.isdigit():
+            abort(400)
+        org_id = int(org_id)
+    return export_response(fmt, org_id)
+
+"""
+Import events of the login organisation from NDJSON or CSV (text/csv body or
+format=csv), in batches of one transaction each. Rejected records and batch
+summaries are streamed back as NDJSON while the import runs
+"""
+@app.route('/events/import', methods=['POST'])
+@requires_auth(permission='create:event')
+def import_events_from_body(jwt_payload):
+    fmt = request.args.get('format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if fmt not in FORMATS:
+        abort(400)
+
+    #records are imported into the login organisation only
+    auth0_id = jwt_payload.get('sub', None)
+    org = db.session.query(Organisation.id) \
+        .filter(Organisation.auth0_id == auth0_id).first()
+    if not org:
+        abort(403)
+
+    #the body is decoded line by line as it is read
+    lines = codecs.iterdecode(request.stream, 'utf-8', errors='replace')
+    return ndjson_response(import_events(read_records(lines, fmt), org.id, {org.id}))
+
 """
 Create an event
 """
@@ -88,6 +379,9 @@ Create an event
 @requires_auth(permission='create:event')
 def create_event(jwt_payload):
     body = request.get_json()
+    #counters and version are maintained by Event.touch, not written by clients
+    if set(body) - set(EVENT_FIELDS):
+        abort(400)
     
     org_id = body.get('organisation_id', None)
     org = Organisation.query.get(org_id) 
@@ -106,7 +400,7 @@ def create_event(jwt_payload):
         event.insert()
         return jsonify({
             'success': True,
-            'created': event.format()
+            'created': formatted_event(event)
         })
     except Exception as e:
         print(e)
@@ -119,6 +413,9 @@ Update an event
 @requires_auth(permission='update:event')
 def update_event(jwt_payload, event_id):
     body = request.get_json()
+    #counters and version are maintained by Event.touch, not written by clients
+    if set(body) - set(EVENT_FIELDS):
+        abort(400)
 
     event = Event.query.get(event_id)
     if not event:
@@ -139,7 +436,7 @@ def update_event(jwt_payload, event_id):
         event.update()
         return jsonify({
             'success': True,
-            'updated': event.format()
+            'updated': formatted_event(event)
         })
     except Exception as e:
         print(e)
@@ -191,18 +488,17 @@ def add_user_to_event(jwt_payload, event_id):
         abort(403, 'not permitted')
 
     try:
-        event = Event.query.get(event_id)
-        if not event:
+        if not event_exists(event_id):
             raise 
 
-        event.participants.append(user)
-        event.update()
+        #already registered users are left alone
+        add_participants([(event_id, user.id)])
 
         return jsonify({
             'success': True,
             'updated': {
-                'event_id': event.id,
-                'event_participants': [u.id for u in event.participants]
+                'event_id': event_id,
+                'event_participants': participant_ids(event_id)
             }
         })
     except Exception as e:
@@ -227,61 +523,333 @@ def remove_user_from_event(jwt_payload, event_id):
         abort(403, 'not permitted')
 
     try:
-        event = Event.query.get(event_id)
-        if not event: 
+        if not event_exists(event_id): 
             raise
         
-        event.participants.remove(user)
-        event.update()
+        if not remove_participants([(event_id, user.id)]):
+            raise ValueError('user is not a participant')
 
         return jsonify({
             'success': True,
             'updated': {
-                'event_id': event.id,
-                'event_participants': [u.id for u in event.participants]
+                'event_id': event_id,
+                'event_participants': participant_ids(event_id)
             }
         })
     except Exception as e:
         print(e)
         abort(422)
 
+def get_id_list(name):
+    """Read a list of ids from the request body, abort with 400 if it isn't
+    a non empty list of at most MAX_BULK_SIZE integers. Duplicates are dropped
+    """
+    body = request.get_json(silent=True) or {}
+    ids = body.get(name, None)
+    if not isinstance(ids, list) or not 0 < len(ids) <= MAX_BULK_SIZE:
+        abort(400)
+    if not all(type(item_id) is int for item_id in ids):
+        abort(400)
+    return list(dict.fromkeys(ids))
+
+def register_results(requested_ids, existing_ids, added_ids, id_key):
+    """Per item outcome of a bulk registration, in request order"""
+    results = []
+    for item_id in requested_ids:
+        if item_id not in existing_ids:
+            status = 'not_found'
+        elif item_id in added_ids:
+            status = 'added'
+        else:
+            status = 'already_registered'
+        results.append({id_key: item_id, 'status': status})
+    return results
+
+"""
+Add many users to an event at once, i.e. a coordinator registering a group.
+Only the organisation running the event can register other users
+"""
+@app.route('/events/<int:event_id>/participants/bulk', methods=['POST'])
+@requires_auth(permission='add:event-participant')
+def add_users_to_event(jwt_payload, event_id):
+    user_ids = get_id_list('user_ids')
+
+    event = db.session.query(Event.id, Organisation.auth0_id) \
+        .join(Organisation, Organisation.id == Event.organisation_id) \
+        .filter(Event.id == event_id).first()
+    if not event:
+        abort(422)
+
+    #login user different from resource user
+    auth0_id = jwt_payload.get('sub', None)
+    if event.auth0_id != auth0_id:
+        abort(403)
+
+    try:
+        existing_ids = {row.id for row in 
+            db.session.query(User.id).filter(User.id.in_(user_ids))}
+        added = add_participants([(event_id, user_id) for user_id in existing_ids])
+
+        return jsonify({
+            'success': True,
+            'event_id': event_id,
+            'results': register_results(user_ids, existing_ids, 
+                {user_id for _, user_id in added}, 'user_id')
+        })
+    except Exception as e:
+        print(e)
+        abort(422)
+
+"""
+Add a user to many events at once
+"""
+@app.route('/users/<int:user_id>/events', methods=['POST'])
+@requires_auth(permission='add:event-participant')
+def add_user_to_events(jwt_payload, user_id):
+    event_ids = get_id_list('event_ids')
+
+    user = db.session.query(User.id, User.auth0_id).filter(User.id == user_id).first()
+    if not user:
+        abort(422)
+
+    auth0_id = jwt_payload.get('sub', None)
+    if user.auth0_id != auth0_id:
+        abort(403, 'not permitted')
+
+    try:
+        existing_ids = {row.id for row in 
+            db.session.query(Event.id).filter(Event.id.in_(event_ids))}
+        added = add_participants([(event_id, user_id) for event_id in existing_ids])
+
+        return jsonify({
+            'success': True,
+            'user_id': user_id,
+            'results': register_results(event_ids, existing_ids,
+                {event_id for event_id, _ in added}, 'event_id')
+        })
+    except Exception as e:
+        print(e)
+        abort(422)
+
+"""
+Search users by skills, comma separated. Users having every skill are 
+returned, or with match=any those having at least one, the ones with the
+most of the skills first. Skills are matched exactly
+"""
+@app.route('/users/search', methods=['GET'])
+@requires_auth(permission='search:users')
+@replica_reads
+def search_users(jwt_payload):
+    skills = sorted({skill.strip() for skill in request.args.get('skills', '').split(',')} - {''})
+    if not skills or len(skills) > MAX_SEARCH_SKILLS:
+        abort(400)
+    match = request.args.get('match', 'all')
+    if match not in ('all', 'any'):
+        abort(400)
+    limit = get_page_limit()
+
+    if match == 'all':
+        #every user found has all the skills: users are read in primary key
+        #order, without sorting the matches
+        matched = cast(literal_column(str(len(skills))), Integer)
+        condition = User.skills.contains(skills)
+        order = [User.id.asc()]
+    else:
+        matched = skills_match_count(skills)
+        condition = User.skills.overlap(skills)
+        order = [matched.desc(), User.id.asc()]
+    query = db.session.query(User.id, User.name, User.skills, matched.label('matched')) \
+        .filter(condition)
+
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        try:
+            query = query.filter(ranked_after_cursor(matched, User.id, cursor))
+        except ValueError:
+            abort(400)
+
+    rows, next_cursor = split_page(
+        query.order_by(*order).limit(limit + 1).all(),
+        limit, lambda row: [row.matched, row.id])
+
+    return jsonify({
+        'success': True,
+        'data': [{
+            'id': row.id,
+            'name': row.name,
+            'skills': row.skills,
+        } for row in rows],
+        'next_cursor': next_cursor
+    })
+
 #----------------------------------------------------------------------------#
 # Api Endpoints - Organisations
 #----------------------------------------------------------------------------#
 """
-Get all organisations
+Get all organisations, streamed with stream=true
 """
 @app.route('/organisations', methods=['GET'])
+@replica_reads
+@cached_response(lambda: listing_cache_key('organisations'))
 def get_organisations():
-    organisations = Organisation.query.all()
+    query = query_organisations().order_by(Organisation.id)
+    if get_bool_arg('stream'):
+        return stream_json_response({
+            'success': True,
+            'data': (format_organisation_row(row) 
+                for row in query.yield_per(STREAM_BATCH_SIZE))
+        })
+
+    rows = query.all()
     return jsonify({
         'success': True,
-        'data': [org.format() for org in organisations]
+        'data': [format_organisation_row(row) for row in rows]
     })
 
 
 """
-Get specific organisation details
+Get event counts per organisation
+"""
+@app.route('/organisations/summary', methods=['GET'])
+@replica_reads
+def get_organisations_summary():
+    rows = db.session.query(Organisation.id, Organisation.name, Organisation.event_count) \
+        .order_by(Organisation.id).all()
+    return jsonify({
+        'success': True,
+        'data': [{
+            'id': row.id,
+            'name': row.name,
+            'event_count': row.event_count,
+        } for row in rows]
+    })
+
+
+"""
+Get specific organisation details with its past and upcoming events, each
+paginated by cursor. Supports conditional GET with If-None-Match
 """
 @app.route('/organisations/<int:organisation_id>', methods=['GET'])
+@replica_reads
+@cached_response(lambda organisation_id: 
+    None if request.args else response_cache.row_key('organisation', organisation_id))
 def get_organisation(organisation_id):
-    organisation = Organisation.query.get_or_404(organisation_id)
-
-    data = organisation.format()
-    past_events = []
-    upcoming_events = []
-    for event in organisation.events:
-        if event.end_datetime <= datetime.now():
-            past_events.append(event.format(include_org=False))
-        else:
-            upcoming_events.append(event.format(include_org=False))
-    data['past_events'] = past_events
-    data['upcoming_events'] = upcoming_events
+    past_limit = get_page_limit('past_limit')
+    upcoming_limit = get_page_limit('upcoming_limit')
+    now = datetime.now()
+
+    #the end of the latest past event changes whenever an event ends, 
+    #it is part of the etag
+    latest_past_end = db.session.query(func.max(Event.end_datetime)).filter(
+        Event.organisation_id == Organisation.id,
+        Event.end_datetime <= now
+    ).scalar_subquery()
+    row = query_organisations().add_columns(
+        Organisation.version, latest_past_end.label('latest_past_end')
+    ).filter(Organisation.id == organisation_id).first()
+    if row is None:
+        abort(404)
+    etag = organisation_etag(organisation_id, row.version, row.latest_past_end)
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    events = query_events(include_org=False) \
+        .filter(Event.organisation_id == organisation_id)
+
+    #most recently ended first
+    past = events.filter(Event.end_datetime <= now)
+    cursor = request.args.get('past_cursor', None)
+    if cursor:
+        try:
+            past = past.filter(before_cursor(Event.end_datetime, Event.id, cursor))
+        except ValueError:
+            abort(400)
+    past_rows, past_cursor = split_page(
+        past.order_by(Event.end_datetime.desc(), Event.id.desc())
+            .limit(past_limit + 1).all(), 
+        past_limit, lambda row: [row.end_datetime, row.id])
+
+    #ending soonest first, events without an end date are listed as upcoming
+    upcoming = events.filter(or_(Event.end_datetime > now, Event.end_datetime.is_(None)))
+    cursor = request.args.get('upcoming_cursor', None)
+    if cursor:
+        try:
+            upcoming = upcoming.filter(after_cursor(Event.end_datetime, Event.id, cursor))
+        except ValueError:
+            abort(400)
+    upcoming_rows, upcoming_cursor = split_page(
+        upcoming.order_by(Event.end_datetime.asc().nullslast(), Event.id.asc())
+            .limit(upcoming_limit + 1).all(), 
+        upcoming_limit, lambda row: [row.end_datetime, row.id])
+
+    #the cached response is out of date once the first upcoming event ends
+    if upcoming_rows and upcoming_rows[0].end_datetime is not None:
+        expire_cached_response_at(upcoming_rows[0].end_datetime)
+
+    data = format_organisation_row(row)
+    data['past_events'] = [format_event_row(r, include_org=False) for r in past_rows]
+    data['past_events_next_cursor'] = past_cursor
+    data['upcoming_events'] = [format_event_row(r, include_org=False) for r in upcoming_rows]
+    data['upcoming_events_next_cursor'] = upcoming_cursor
     
-    return jsonify({
+    response = jsonify({
         'success': True, 
         'data': data 
     })
+    response.set_etag(etag)
+    return response
+
+#----------------------------------------------------------------------------#
+# Health check
+#----------------------------------------------------------------------------#
+"""
+Check the database is reachable, with the connection pool metrics of this 
+worker
+"""
+@app.route('/health', methods=['GET'])
+def health():
+    try:
+        db.session.execute(text('SELECT 1'))
+        database_ok = True
+    except Exception as e:
+        print(e)
+        database_ok = False
+
+    return jsonify({
+        'success': database_ok,
+        'pools': pool_stats(),
+        'replicas': replica_set.stats()
+    }), 200 if database_ok else 503
+
+"""
+Request metrics of this worker in the Prometheus text format, only with
+METRICS_ENABLED
+"""
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.is_enabled(app):
+        abort(404)
+    return app.response_class(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+"""
+Sample the stacks of every thread of this worker for `seconds` (10 by
+default), returned as collapsed stacks for flamegraph tools
+"""
+@app.route('/admin/profile', methods=['GET'])
+@requires_auth(permission=profiler.PROFILE_PERMISSION)
+def profile_worker(jwt_payload):
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        abort(400)
+    if not 0 < seconds <= profiler.PROFILER_MAX_SECONDS:
+        abort(400)
+
+    try:
+        stacks = profiler.profile_worker(seconds)
+    except profiler.ProfilerBusy:
+        abort(409)
+    return app.response_class(stacks, mimetype='text/plain')
 
 #---------------------------------------
 # Custom error handlers
@@ -318,6 +886,14 @@ def not_found(error):
         "message": "resource not found"
     }), 404
 
+@app.errorhandler(409)
+def conflict(error):
+    return jsonify({
+        "success": False,
+        "error": 409,
+        "message": "conflict"
+    }), 409
+
 @app.errorhandler(422)
 def unprocessable(error):
     return jsonify({
@@ -0,0 +1,209 @@
+"""Asynchronous serving mode, an alternative to the gunicorn entry point:
+
+    uvicorn asgi:application
+
+Serves the same flask app, with the same routes, error handlers and
+requires_auth checks, from an event loop. Each request runs in its own
+greenlet: the database is reached through asyncpg and the Auth0 signing keys
+through httpx, and whenever a request waits on either, its greenlet yields to
+the loop (the same bridge SQLAlchemy's asyncio extension is built on). One
+process can then serve hundreds of concurrent slow requests, bounded by the
+connection pool instead of a number of threads.
+"""
+import os
+#engines are created for asyncpg, this must happen before the app is imported
+os.environ['DB_ASYNC'] = 'true'
+
+import sys
+import asyncio
+
+import httpx
+from sqlalchemy.util import greenlet_spawn, await_only
+from sqlalchemy.util.concurrency import AsyncAdaptedLock
+
+import auth
+import profiler
+import replicas
+from app import app
+
+
+class RequestBody(object):
+    """wsgi.input reading the body from the ASGI receive channel as the
+    application consumes it"""
+    def __init__(self, receive):
+        self.receive = receive
+        self.buffer = b''
+        self.more_body = True
+
+    def _fill(self, size):
+        while self.more_body and (size < 0 or len(self.buffer) < size):
+            message = await_only(self.receive())
+            if message['type'] == 'http.disconnect':
+                self.more_body = False
+                break
+            self.buffer += message.get('body', b'')
+            self.more_body = message.get('more_body', False)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        while b'\n' not in self.buffer and self.more_body and \
+                (size < 0 or len(self.buffer) < size):
+            self._fill(len(self.buffer) + 1)
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def build_environ(scope, body):
+    """WSGI environ of an ASGI http scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        #the body ends with the last ASGI message, not at a content length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+class ASGIAdapter(object):
+    """Run a WSGI application, one greenlet per request, as an ASGI application
+
+    The whole request, including the iteration of streamed responses, runs
+    in one greenlet so flask's request context stays with it.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await greenlet_spawn(self.handle, scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def handle(self, scope, receive, send):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]), [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ]]
+
+        def send_start():
+            await_only(send({'type': 'http.response.start',
+                'status': started[0], 'headers': started[1]}))
+
+        body = self.wsgi_app(build_environ(scope, RequestBody(receive)), start_response)
+        try:
+            sent_start = False
+            for chunk in body:
+                if not chunk:
+                    continue
+                if not sent_start:
+                    send_start()
+                    sent_start = True
+                await_only(send({'type': 'http.response.body', 'body': chunk,
+                    'more_body': True}))
+            if not sent_start:
+                send_start()
+            await_only(send({'type': 'http.response.body', 'body': b''}))
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+#----------------------------------------------------------------------------#
+# JWKS key store
+#----------------------------------------------------------------------------#
+async def get_jwks():
+    async with httpx.AsyncClient(timeout=5) as client:
+        response = await client.get(f'https://{auth.AUTH0_DOMAIN}/.well-known/jwks.json')
+        response.raise_for_status()
+        return response.json()
+
+
+def fetch_jwks_async():
+    """auth.fetch_jwks_from_url, yielding to the event loop while waiting
+
+    Returns:
+        dict: the jwks document
+    """
+    return await_only(get_jwks())
+
+
+class AsyncJWKSKeyStore(auth.JWKSKeyStore):
+    """JWKSKeyStore for requests sharing the event loop: a request waiting on
+    a fetch yields to the loop instead of blocking it, background refreshes
+    run as tasks of the loop"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._refresh_lock = AsyncAdaptedLock()
+
+    def _refresh_in_background(self):
+        if self._background is not None and not self._background.done():
+            return
+        if not self._can_refetch():
+            return
+        self._background = asyncio.get_running_loop().create_task(
+            greenlet_spawn(self.refresh))
+
+
+if not auth.JWKS_FILE:
+    auth.jwks_store = AsyncJWKSKeyStore(fetch_jwks_async)
+#the other requests keep being served while a worker is profiled
+profiler.sleep = lambda seconds: await_only(asyncio.sleep(seconds))
+#replica health checks run as a task of the loop, as their engines do
+replicas.spawn = lambda target: asyncio.get_running_loop().create_task(greenlet_spawn(target))
+replicas.sleep = lambda seconds: await_only(asyncio.sleep(seconds))
+
+application = ASGIAdapter(app)
@@ -1,15 +1,29 @@
 import os
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from functools import wraps
 from urllib.request import urlopen
 
 from flask import request, _request_ctx_stack
-from jose import jwt
+from jose import jwk, jwt
+from jose.exceptions import JWKError
 
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN', 'dev--3lz2zai.us.auth0.com')
 API_AUDIENCE = os.getenv('API_AUDIENCE', 'volunteer_app')
 ALGORITHMS = os.getenv('ALGORITHMS', 'RS256')
 
+#seconds the cached jwks is considered fresh
+JWKS_TTL = int(os.getenv('JWKS_TTL', 600))
+#minimum seconds between two fetches of the jwks
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30))
+#read jwks from a local file instead of Auth0 (i.e. tests, offline dev)
+JWKS_FILE = os.getenv('JWKS_FILE', None)
+#max number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
@@ -83,13 +97,220 @@ def check_permissions(permission, payload):
         }, 403)
     return True
 
+#----------------------------------------------------------------------------#
+# JWKS key store
+#----------------------------------------------------------------------------#
+def fetch_jwks_from_url():
+    """Fetch the json web key set from Auth0
+
+    Returns:
+        dict: the jwks document
+    """
+    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json', timeout=5)
+    return json.loads(jsonurl.read())
+
+
+def make_file_fetcher(path):
+    """Build a jwks fetcher reading from a local json file
+
+    Args:
+        path (str): path to a jwks json document
+
+    Returns:
+        function: fetcher to pass to JWKSKeyStore
+    """
+    def fetch_jwks_from_file():
+        with open(path) as f:
+            return json.load(f)
+    return fetch_jwks_from_file
+
+
+def construct_public_key(key):
+    """Build a ready-to-use public key object from a jwks entry
+
+    Args:
+        key (dict): a single json web key
+
+    Returns:
+        jose Key: key object that can be passed straight to jwt.decode,
+            None if the key can't be used to verify our tokens
+    """
+    if key.get('use', 'sig') != 'sig':
+        return None
+    try:
+        return jwk.construct(key, key.get('alg', ALGORITHMS))
+    except JWKError as e:
+        print(e)
+        return None
+
+
+class JWKSKeyStore(object):
+    """Process-wide cache of the signing keys, keyed by key id (kid).
+
+    jwks entries are parsed into public key objects once per fetch, so token
+    verification doesn't rebuild the key from the jwk on every request.
+
+    - keys are served from memory for `ttl` seconds
+    - once the ttl has passed, the stale keys are still served while a
+      single background thread refreshes them (stale-while-revalidate)
+    - a kid that is not in the cache triggers a synchronous refresh. 
+      Concurrent misses share one fetch (single-flight) and refetches are 
+      limited to one every `min_refresh_interval` seconds
+    """
+    def __init__(self, fetcher, ttl=JWKS_TTL, 
+            min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, clock=time.monotonic):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._generation = 0
+        self._refresh_lock = threading.Lock()
+        self._background = None
+
+    def get_key(self, kid):
+        """Return the public key for kid, or None if the jwks doesn't contain it"""
+        if self._fetched_at is None:
+            self.refresh()
+        elif self._is_stale():
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._can_refetch():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self):
+        """Fetch the jwks and replace the cached keys.
+
+        Callers arriving while a fetch is in flight wait for it and reuse 
+        its result instead of fetching again. If the fetch fails the 
+        previous keys are kept, if there are none the error is raised.
+        """
+        generation = self._generation
+        with self._refresh_lock:
+            if self._generation != generation:
+                #a fetch completed while we were waiting for the lock
+                return
+            self._last_attempt = self.clock()
+            try:
+                self.fetch_count += 1
+                jwks = self.fetcher()
+                keys = {}
+                for key in jwks.get('keys', []):
+                    public_key = construct_public_key(key) if 'kid' in key else None
+                    if public_key is not None:
+                        keys[key['kid']] = public_key
+                self._keys = keys
+                self._fetched_at = self.clock()
+            except Exception as e:
+                if not self._keys:
+                    raise
+                print(e)
+            finally:
+                self._generation += 1
+
+    def _is_stale(self):
+        return self.clock() - self._fetched_at >= self.ttl
+
+    def _can_refetch(self):
+        return self._last_attempt is None or \
+            self.clock() - self._last_attempt >= self.min_refresh_interval
+
+    def _refresh_in_background(self):
+        if self._background is not None and self._background.is_alive():
+            return
+        if not self._can_refetch():
+            return
+        self._background = threading.Thread(target=self.refresh, daemon=True)
+        self._background.start()
+
+
+jwks_store = JWKSKeyStore(
+    make_file_fetcher(JWKS_FILE) if JWKS_FILE else fetch_jwks_from_url
+)
+
+
+#----------------------------------------------------------------------------#
+# Verified token cache
+#----------------------------------------------------------------------------#
+class TokenCache(object):
+    """Bounded LRU cache of decoded payloads for tokens that already passed
+    verification.
+
+    Entries are keyed by a sha256 of the token so raw tokens are not kept in
+    memory, and are evicted once the token's `exp` is reached so an expired
+    token is always verified (and rejected) again.
+    """
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).hexdigest()
+
+    def get(self, token):
+        """Return a copy of the cached payload for token, or None"""
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() >= entry[1]:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[0])
+
+    def set(self, token, payload):
+        """Cache a verified payload until its exp claim"""
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (dict(payload), exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache()
+
+
 def verify_decode_jwt(token):
     """Verify jwt against Auth0.
 
     the jwt should
     - be an Auth0 token with key id (kid)
-    - verfied using Auth0 /.well-known/jwks.json
+    - verfied using Auth0 /.well-known/jwks.json, served from jwks_store
     - contain payload
+    tokens that were verified before are served from token_cache until they
+    expire
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 
     Args:
@@ -103,34 +324,28 @@ def verify_decode_jwt(token):
     Returns:
         dict: decode payload from the jwt 
     """    
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    public_key = jwks_store.get_key(unverified_header['kid'])
+    if public_key is not None:
         try:
             payload = jwt.decode(
                 token,
-                rsa_key,
+                public_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
+            token_cache.set(token, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -154,6 +369,14 @@ def verify_decode_jwt(token):
         }, 400)
 
 
+'''
+verify_listeners
+    functions called with the seconds verify_decode_jwt took in requires_auth,
+    empty unless request metrics are enabled, see metrics
+'''
+verify_listeners = []
+
+
 def requires_auth(permission=''):
     """decorate route to enable authorization and authentication via jwt and Auth0.
 
@@ -165,7 +388,15 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            if verify_listeners:
+                started_at = time.perf_counter()
+                try:
+                    payload = verify_decode_jwt(token)
+                finally:
+                    for listener in verify_listeners:
+                        listener(time.perf_counter() - started_at)
+            else:
+                payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
         return wrapper
@@ -0,0 +1,72 @@
+"""Micro-benchmark of per-request token verification.
+
+Compares the previous verify path (linear scan of the jwks, a fresh rsa_key
+dict and a jwk re-parse on every decode) against verify_decode_jwt with
+precompiled public keys. The verified token cache is disabled so both sides
+do the full signature check.
+
+run from the repository root:
+    python benchmarks/bench_auth.py [iterations]
+"""
+import os
+import sys
+import json
+import timeit
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jose import jwt
+
+import auth
+from auth import JWKSKeyStore, TokenCache, make_file_fetcher
+from test_keys import JWKS_ROTATED_PATH, make_token
+
+
+def legacy_verify_decode_jwt(token, jwks):
+    """verify_decode_jwt as it was before keys were precompiled"""
+    unverified_header = jwt.get_unverified_header(token)
+    rsa_key = {}
+    for key in jwks['keys']:
+        if key['kid'] == unverified_header['kid']:
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return jwt.decode(
+        token,
+        rsa_key,
+        algorithms=auth.ALGORITHMS,
+        audience=auth.API_AUDIENCE,
+        issuer='https://' + auth.AUTH0_DOMAIN + '/'
+    )
+
+
+def main(iterations=2000):
+    with open(JWKS_ROTATED_PATH) as f:
+        jwks = json.load(f)
+    #the matching key is last in the jwks, worst case for the linear scan
+    token = make_token(kid='test-key-2')
+
+    store = JWKSKeyStore(make_file_fetcher(JWKS_ROTATED_PATH))
+    with patch.object(auth, 'jwks_store', store), \
+            patch.object(auth, 'token_cache', TokenCache(maxsize=0)):
+        assert auth.verify_decode_jwt(token) == legacy_verify_decode_jwt(token, jwks)
+
+        results = {
+            'legacy': timeit.timeit(
+                lambda: legacy_verify_decode_jwt(token, jwks), number=iterations),
+            'precompiled': timeit.timeit(
+                lambda: auth.verify_decode_jwt(token), number=iterations),
+        }
+
+    for name, total in results.items():
+        print(f'{name:>12}: {total / iterations * 1e6:8.1f} us/verify')
+    print(f'{"speedup":>12}: {results["legacy"] / results["precompiled"]:8.2f}x')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
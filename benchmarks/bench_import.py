@@ -0,0 +1,63 @@
+"""Throughput of the bulk event import against one insert per event, the way
+POST /events writes them.
+
+!!NOTE this resets the database configured through setup.sh with
+reset_db_with_fixtures before each run.
+
+run from the repository root:
+    python benchmarks/bench_import.py [n_events]
+"""
+import os
+import sys
+import json
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from models import db, Event
+from fixtures import reset_db_with_fixtures
+from bulk_events import read_ndjson, import_events
+
+
+def make_lines(n_events):
+    start = datetime(2021, 1, 1)
+    return [json.dumps({
+        'name': f'imported event {i}',
+        'description': 'partner organisation event',
+        'start_datetime': (start + timedelta(hours=i)).isoformat(),
+        'end_datetime': (start + timedelta(hours=i + 2)).isoformat(),
+        'address': 'London SW1A 0AA, UK',
+        'organisation_id': 1 + i % 3,
+    }) for i in range(n_events)]
+
+
+def per_event(lines):
+    """what importing through create_event costs, minus http and auth"""
+    for line in lines:
+        body = json.loads(line)
+        Event(**body).insert()
+
+
+def bulk(lines):
+    for result in import_events(read_ndjson(lines)):
+        pass
+    assert result['failed'] == 0, result
+
+
+def main(n_events=10000):
+    lines = make_lines(n_events)
+    print(f'{n_events} events')
+    with app.app_context():
+        for name, fn in (('per event', per_event), ('bulk', bulk)):
+            db.session.remove()
+            reset_db_with_fixtures(db)
+            start = time.perf_counter()
+            fn(lines)
+            elapsed = time.perf_counter() - start
+            print(f'{name:>9}: {elapsed:8.2f} s, {n_events / elapsed:10.0f} events/s')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,65 @@
+"""Encode throughput of a large event list with each json backend.
+
+`flask.jsonify` is the previous path: datetimes pre-formatted with
+isoformat() then encoded by Flask's default encoder. The json_backend
+rows pass datetime objects straight to the encoder.
+
+run from the repository root:
+    python benchmarks/bench_json.py [n_events]
+"""
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask
+
+import json_backend
+
+
+def make_events(n_events, n_participants=5):
+    start = datetime(2021, 1, 1, 10, 0, 0)
+    return [{
+        'id': i,
+        'name': f'event {i}',
+        'description': 'a volunteering event with a reasonably long description',
+        'start_datetime': start + timedelta(hours=i),
+        'end_datetime': start + timedelta(hours=i + 2),
+        'address': 'London SW1A 0AA, UK',
+        'organisation': {'id': i % 10, 'name': f'organisation {i % 10}'},
+        'participants': [{'id': j, 'name': f'user {j}'} for j in range(n_participants)],
+    } for i in range(n_events)]
+
+
+def legacy_jsonify(events):
+    formatted = [dict(e,
+        start_datetime=e['start_datetime'].isoformat(),
+        end_datetime=e['end_datetime'].isoformat()) for e in events]
+    return flask.jsonify({'success': True, 'data': formatted})
+
+
+def main(n_events=20000, repeat=5):
+    events = make_events(n_events)
+    app = flask.Flask(__name__)
+
+    candidates = [('flask.jsonify', legacy_jsonify)]
+    for name in json_backend.BACKENDS:
+        backend = json_backend.make_backend(name)
+        if backend.name != name:
+            print(f'{name} not installed, skipped')
+            continue
+        candidates.append((name, lambda events, backend=backend: 
+            app.response_class(backend.dumps({'success': True, 'data': events}) + b'\n')))
+
+    with app.app_context():
+        for name, encode in candidates:
+            size = len(encode(events).get_data())
+            best = min(timeit.repeat(lambda: encode(events), number=1, repeat=repeat))
+            print(f'{name:>14}: {best * 1000:8.1f} ms, {size / 1e6 / best:8.1f} MB/s, '
+                f'{n_events / best:10.0f} events/s')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,614 @@
+"""Load test of every route of the API under read, write and mixed workloads.
+
+The database is seeded at a configurable scale on top of the fixtures
+(organisations x events per organisation, users, participants per event).
+Auth0 is replaced by the local test keys in test_keys/: the app reads them
+as its jwks and tokens are signed in-process, so tokens go through the full
+verification path. `concurrency` threads each drive their own flask test
+client, and every request is timed until its body is fully read.
+
+Reports p50/p95/p99 latency, throughput and SQL statements per request,
+overall and per route, to a json file (keys sorted, to diff between
+commits) along with the parameters of the run.
+
+!!NOTE this resets the database configured through setup.sh with
+reset_db_with_fixtures.
+
+run from the repository root:
+    python benchmarks/bench_load.py --workload mixed --concurrency 8 \\
+        --requests 2000 --output load.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jose import jwk, jwt
+from sqlalchemy import event as sa_event
+from sqlalchemy.engine import Engine
+
+import auth
+from auth import JWKSKeyStore, make_file_fetcher
+from app import app
+from models import db, add_events, add_participants, Organisation, User
+from fixtures import reset_db_with_fixtures
+from test_keys import KEYS_DIR, JWKS_PATH
+
+PERMISSIONS = ['create:event', 'update:event', 'delete:event',
+    'add:event-participant', 'remove:event-participant', 'read:profile', 'search:users']
+
+SEED_BATCH_SIZE = 1000
+TOKEN_KID = 'test-key-1'
+
+
+'''
+Request
+    one request of a workload, labelled with its flask route. on_response,
+    if set, is called with the response, i.e. to remember created events
+'''
+Request = namedtuple('Request', ['route', 'method', 'url', 'kwargs', 'on_response'],
+    defaults=[None])
+
+
+#----------------------------------------------------------------------------#
+# Seeding
+#----------------------------------------------------------------------------#
+_signing_key = []
+
+
+def signing_key():
+    """Private test key matching the jwks of JWKS_PATH, parsed once"""
+    if not _signing_key:
+        with open(os.path.join(KEYS_DIR, f'{TOKEN_KID}.pem')) as f:
+            _signing_key.append(jwk.construct(f.read(), 'RS256'))
+    return _signing_key[0]
+
+
+def seed(orgs, events_per_org, users, participants_per_event, rng):
+    """Reset the database to the fixtures and add the benchmark rows
+
+    Returns:
+        BenchState: ids and token subjects of the seeded rows
+    """
+    db.session.remove()
+    reset_db_with_fixtures(db)
+    org_table, user_table = Organisation.__table__, User.__table__
+    org_ids = db.session.execute(org_table.insert().values([{
+        'auth0_id': f'bench|org-{i}',
+        'name': f'bench organisation {i}',
+        'description': 'benchmark organisation',
+        'website': f'https://org-{i}.example.org',
+        'email_contact': f'org-{i}@example.org',
+    } for i in range(orgs)]).returning(org_table.c.id)).scalars().all()
+
+    user_ids = []
+    for offset in range(0, users, SEED_BATCH_SIZE):
+        user_ids += db.session.execute(user_table.insert().values([{
+            'auth0_id': f'bench|user-{i}',
+            'name': f'bench user {i}',
+            'age': 18 + i % 60,
+            'email_contact': f'user-{i}@example.org',
+            'join_date': datetime(2020, 1, 1) + timedelta(hours=i),
+            'skills': rng.sample(['cooking', 'first aid', 'driving', 'teaching',
+                'web development', 'gardening'], 2),
+        } for i in range(offset, min(offset + SEED_BATCH_SIZE, users))])
+            .returning(user_table.c.id)).scalars().all()
+    db.session.commit()
+
+    #events spread over a year either side of now, so listings have both
+    #past and upcoming events
+    now = datetime.now().replace(microsecond=0)
+    rows = []
+    for i in range(orgs * events_per_org):
+        start = now + timedelta(hours=rng.randint(-24 * 365, 24 * 365))
+        rows.append({
+            'name': f'bench event {i}',
+            'description': 'benchmark event',
+            'start_datetime': start,
+            'end_datetime': start + timedelta(hours=rng.randint(1, 8)),
+            'address': 'London SW1A 0AA, UK',
+            'organisation_id': org_ids[i % orgs],
+            #around London, for the nearby searches
+            'latitude': round(rng.uniform(51.3, 51.7), 5),
+            'longitude': round(rng.uniform(-0.5, 0.3), 5),
+        })
+    event_ids = []
+    for offset in range(0, len(rows), SEED_BATCH_SIZE):
+        event_ids += add_events(rows[offset:offset + SEED_BATCH_SIZE])
+
+    pairs = [(event_id, user_id) for event_id in event_ids
+        for user_id in rng.sample(user_ids, min(participants_per_event, len(user_ids)))]
+    for offset in range(0, len(pairs), SEED_BATCH_SIZE * 5):
+        add_participants(pairs[offset:offset + SEED_BATCH_SIZE * 5])
+    db.session.remove()
+
+    return BenchState(org_ids, event_ids, user_ids, events_per_org)
+
+
+class BenchState(object):
+    """Seeded ids, the tokens of their subjects, and the events and
+    registrations made by the workload, so later requests can undo them"""
+    def __init__(self, org_ids, event_ids, user_ids, events_per_org):
+        self.org_ids = org_ids
+        self.event_ids = event_ids
+        self.user_ids = user_ids
+        #seeded events are assigned to the organisations round robin
+        self.org_events = {org_id: event_ids[i::len(org_ids)] for i, org_id in enumerate(org_ids)}
+        self.org_tokens = {org_id: self.make_header(f'bench|org-{i}')
+            for i, org_id in enumerate(org_ids)}
+        self.user_tokens = {user_id: self.make_header(f'bench|user-{i}')
+            for i, user_id in enumerate(user_ids)}
+
+        self.created = []
+        self.registered = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_header(sub):
+        """Authorization header of a token of sub, with every permission,
+        signed like test_keys.make_token but without parsing the key again"""
+        now = int(time.time())
+        token = jwt.encode({
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'aud': auth.API_AUDIENCE,
+            'sub': sub,
+            'iat': now,
+            'exp': now + 3600,
+            'permissions': PERMISSIONS,
+        }, signing_key(), algorithm='RS256', headers={'kid': TOKEN_KID})
+        return {'Authorization': 'Bearer ' + token}
+
+    def push(self, items, item):
+        with self._lock:
+            items.append(item)
+
+    def pop(self, items, rng):
+        with self._lock:
+            if not items:
+                return None
+            return items.pop(rng.randrange(len(items)))
+
+
+#----------------------------------------------------------------------------#
+# Requests
+#----------------------------------------------------------------------------#
+def event_body(rng, org_id, name='load test event'):
+    start = datetime.now().replace(microsecond=0) + timedelta(days=rng.randint(1, 60))
+    return {
+        'name': name,
+        'description': 'created by the load test',
+        'start_datetime': start.isoformat(),
+        'end_datetime': (start + timedelta(hours=2)).isoformat(),
+        'address': 'London SW1A 0AA, UK',
+        'organisation_id': org_id,
+    }
+
+
+def get_index(state, rng):
+    return Request('GET /', 'GET', '/', {})
+
+
+def get_login_results(state, rng):
+    return Request('GET /login-results', 'GET', '/login-results', {})
+
+
+def get_events(state, rng):
+    query = rng.choice(['limit=20', 'limit=50&upcoming=true',
+        f'limit=20&organisation_id={rng.choice(state.org_ids)}'])
+    return Request('GET /events', 'GET', f'/events?{query}', {})
+
+
+def stream_events(state, rng):
+    return Request('GET /events?stream=true', 'GET',
+        f'/events?stream=true&organisation_id={rng.choice(state.org_ids)}', {})
+
+
+def get_event(state, rng):
+    return Request('GET /events/<int:event_id>', 'GET',
+        f'/events/{rng.choice(state.event_ids)}', {})
+
+
+def get_events_summary(state, rng):
+    return Request('GET /events/summary', 'GET', '/events/summary?limit=100', {})
+
+
+def search_events(state, rng):
+    q = rng.choice(['bench', 'event', '"bench event"', 'benchmark -london'])
+    return Request('GET /events/search', 'GET', f'/events/search?q={q}&limit=20', {})
+
+
+def nearby_events(state, rng):
+    lat, lng = rng.uniform(51.3, 51.7), rng.uniform(-0.5, 0.3)
+    query = rng.choice([f'lat={lat:.4f}&lng={lng:.4f}&radius_km=5',
+        f'lat={lat:.4f}&lng={lng:.4f}&radius_km=25&upcoming=true',
+        f'bbox={lng - 0.1:.4f},{lat - 0.1:.4f},{lng + 0.1:.4f},{lat + 0.1:.4f}'])
+    return Request('GET /events/nearby', 'GET', f'/events/nearby?{query}&limit=20', {})
+
+
+def export_events(state, rng):
+    fmt = rng.choice(['ndjson', 'csv'])
+    return Request('GET /events/export', 'GET',
+        f'/events/export?format={fmt}&organisation_id={rng.choice(state.org_ids)}', {})
+
+
+def get_organisations(state, rng):
+    return Request('GET /organisations', 'GET', '/organisations?limit=20', {})
+
+
+def get_organisations_summary(state, rng):
+    return Request('GET /organisations/summary', 'GET', '/organisations/summary?limit=100', {})
+
+
+def get_organisation(state, rng):
+    return Request('GET /organisations/<int:organisation_id>', 'GET',
+        f'/organisations/{rng.choice(state.org_ids)}', {})
+
+
+def search_users(state, rng):
+    skills = rng.choice(['cooking', 'first aid,driving', 'teaching,gardening&match=any'])
+    return Request('GET /users/search', 'GET', f'/users/search?skills={skills}&limit=20', {
+        'headers': state.org_tokens[rng.choice(state.org_ids)],
+    })
+
+
+def get_health(state, rng):
+    return Request('GET /health', 'GET', '/health', {})
+
+
+def get_metrics(state, rng):
+    return Request('GET /metrics', 'GET', '/metrics', {})
+
+
+def profile_worker(state, rng):
+    return Request('GET /admin/profile', 'GET', '/admin/profile?seconds=0.05', {
+        'headers': state.org_tokens[rng.choice(state.org_ids)],
+    })
+
+
+def create_event(state, rng):
+    org_id = rng.choice(state.org_ids)
+
+    def on_response(res):
+        if res.status_code == 200:
+            state.push(state.created, (org_id, res.get_json()['created']['id']))
+    return Request('POST /events', 'POST', '/events', {
+        'json': event_body(rng, org_id),
+        'headers': state.org_tokens[org_id],
+    }, on_response)
+
+
+def update_event(state, rng):
+    org_id = rng.choice(state.org_ids)
+    event_id = rng.choice(state.org_events[org_id])
+    return Request('PATCH /events/<int:event_id>', 'PATCH', f'/events/{event_id}', {
+        'json': {'description': f'updated by the load test {rng.random()}'},
+        'headers': state.org_tokens[org_id],
+    })
+
+
+def delete_event(state, rng):
+    """deletes an event created by the workload, creates one if there is none"""
+    created = state.pop(state.created, rng)
+    if created is None:
+        return create_event(state, rng)
+    org_id, event_id = created
+    return Request('DELETE /events/<int:event_id>', 'DELETE', f'/events/{event_id}', {
+        'headers': state.org_tokens[org_id],
+    })
+
+
+def import_events(state, rng):
+    org_id = rng.choice(state.org_ids)
+    body = ''.join(json.dumps(event_body(rng, org_id, f'imported event {i}')) + '\n'
+        for i in range(20))
+    return Request('POST /events/import', 'POST', '/events/import', {
+        'data': body,
+        'content_type': 'application/x-ndjson',
+        'headers': state.org_tokens[org_id],
+    })
+
+
+def add_participant(state, rng):
+    user_id = rng.choice(state.user_ids)
+    event_id = rng.choice(state.event_ids)
+
+    def on_response(res):
+        if res.status_code == 200:
+            state.push(state.registered, (event_id, user_id))
+    return Request('POST /events/<int:event_id>/participants', 'POST',
+        f'/events/{event_id}/participants', {
+            'json': {'user_id': user_id},
+            'headers': state.user_tokens[user_id],
+        }, on_response)
+
+
+def remove_participant(state, rng):
+    """removes a registration made by the workload, registers one if there
+    is none"""
+    registered = state.pop(state.registered, rng)
+    if registered is None:
+        return add_participant(state, rng)
+    event_id, user_id = registered
+    return Request('DELETE /events/<int:event_id>/participants', 'DELETE',
+        f'/events/{event_id}/participants', {
+            'json': {'user_id': user_id},
+            'headers': state.user_tokens[user_id],
+        })
+
+
+def add_participants_bulk(state, rng):
+    org_id = rng.choice(state.org_ids)
+    event_id = rng.choice(state.org_events[org_id])
+    return Request('POST /events/<int:event_id>/participants/bulk', 'POST',
+        f'/events/{event_id}/participants/bulk', {
+            'json': {'user_ids': rng.sample(state.user_ids, min(10, len(state.user_ids)))},
+            'headers': state.org_tokens[org_id],
+        })
+
+
+def add_user_to_events(state, rng):
+    user_id = rng.choice(state.user_ids)
+    return Request('POST /users/<int:user_id>/events', 'POST', f'/users/{user_id}/events', {
+        'json': {'event_ids': rng.sample(state.event_ids, min(10, len(state.event_ids)))},
+        'headers': state.user_tokens[user_id],
+    })
+
+
+'''
+WORKLOADS
+    relative weight of each request, by workload
+'''
+READS = {
+    get_events: 20, get_event: 30, get_events_summary: 5, stream_events: 2,
+    export_events: 2, get_organisations: 10, get_organisations_summary: 5,
+    get_organisation: 20, get_health: 2, get_metrics: 1, get_index: 2,
+    get_login_results: 2, profile_worker: 0.2, search_events: 5, search_users: 2,
+    nearby_events: 5,
+}
+WRITES = {
+    create_event: 10, update_event: 10, delete_event: 8, import_events: 2,
+    add_participant: 20, remove_participant: 15, add_participants_bulk: 5,
+    add_user_to_events: 5,
+}
+WORKLOADS = {
+    'read': READS,
+    'write': WRITES,
+    'mixed': {**READS, **{request: weight * 0.2 for request, weight in WRITES.items()}},
+}
+
+
+def covered_routes(workload):
+    """Routes of the app the workload sends requests to, and the ones it
+    doesn't"""
+    state = DryRunState()
+    covered = {request(state, random.Random(0)).route.split('?')[0] for request in workload}
+    routes = {f'{method} {rule.rule}' for rule in app.url_map.iter_rules()
+        if rule.endpoint != 'static'
+        for method in rule.methods - {'HEAD', 'OPTIONS'}}
+    return sorted(covered & routes), sorted(routes - covered)
+
+
+class DryRunState(BenchState):
+    """BenchState for building requests without a database"""
+    def __init__(self):
+        self.org_ids = self.event_ids = self.user_ids = [1]
+        self.org_events = {1: [1]}
+        self.org_tokens = self.user_tokens = {1: {}}
+        self.created, self.registered = [(1, 1)], [(1, 1)]
+        self._lock = threading.Lock()
+
+
+#----------------------------------------------------------------------------#
+# Load
+#----------------------------------------------------------------------------#
+class QueryCounter(object):
+    """Statements sent to any database by the current thread"""
+    def __init__(self):
+        self.local = threading.local()
+        sa_event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+
+    def _before_cursor_execute(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+
+def run_load(state, workload, concurrency, n_requests, warmup, seed):
+    """Send n_requests (after warmup ones that aren't recorded) from
+    concurrency threads
+
+    Returns:
+        tuple: ([(route, status, seconds, queries)], wall clock seconds)
+    """
+    requests, weights = zip(*workload.items())
+    counter = QueryCounter()
+    results = []
+    remaining = [warmup + n_requests]
+    lock = threading.Lock()
+    started = threading.Barrier(concurrency + 1)
+
+    def worker(worker_id):
+        rng = random.Random(seed * 1000 + worker_id)
+        client = app.test_client()
+        own = []
+        started.wait()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+                recorded = remaining[0] < n_requests
+            request = rng.choices(requests, weights)[0](state, rng)
+            counter.reset()
+            start = time.perf_counter()
+            res = client.open(request.url, method=request.method, **request.kwargs)
+            res.get_data()
+            elapsed = time.perf_counter() - start
+            if request.on_response is not None:
+                request.on_response(res)
+            res.close()
+            if recorded:
+                own.append((request.route, res.status_code, elapsed, counter.count))
+        db.session.remove()
+        with lock:
+            results.extend(own)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+#----------------------------------------------------------------------------#
+# Report
+#----------------------------------------------------------------------------#
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarise(results, duration=None):
+    latencies = sorted(elapsed * 1000 for _, _, elapsed, _ in results)
+    queries = [count for _, _, _, count in results]
+    summary = {
+        'requests': len(results),
+        'errors': sum(1 for _, status, _, _ in results if status >= 500),
+        'statuses': dict(sorted(Counter(str(status) for _, status, _, _ in results).items())),
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'mean': sum(latencies) / len(latencies),
+            'max': latencies[-1],
+        },
+        'queries_per_request': {
+            'mean': sum(queries) / len(queries),
+            'max': max(queries),
+        },
+    }
+    if duration is not None:
+        summary['duration_s'] = duration
+        summary['throughput_rps'] = len(results) / duration
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_report(args, results, duration, uncovered):
+    routes = {}
+    for result in results:
+        routes.setdefault(result[0], []).append(result)
+    return {
+        'run': {
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'workload': args.workload,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'scale': {
+                'organisations': args.orgs,
+                'events_per_organisation': args.events_per_org,
+                'users': args.users,
+                'participants_per_event': args.participants_per_event,
+            },
+            'response_cache': os.getenv('RESPONSE_CACHE_BACKEND', 'memory'),
+            'uncovered_routes': uncovered,
+        },
+        'total': summarise(results, duration),
+        'routes': {route: summarise(route_results)
+            for route, route_results in sorted(routes.items())},
+    }
+
+
+def print_report(report):
+    total = report['total']
+    print(f"{total['requests']} requests in {total['duration_s']:.2f} s, "
+        f"{total['throughput_rps']:.0f} requests/s, {total['errors']} errors")
+    print(f"{'route':<50} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for route, summary in list(report['routes'].items()) + [('total', total)]:
+        latency = summary['latency_ms']
+        print(f"{route:<50} {summary['requests']:>6} {latency['p50']:>8.2f} "
+            f"{latency['p95']:>8.2f} {latency['p99']:>8.2f} "
+            f"{summary['queries_per_request']['mean']:>8.2f}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='mixed')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000,
+        help='recorded requests, on top of the warmup ones')
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--orgs', type=int, default=10)
+    parser.add_argument('--events-per-org', type=int, default=100)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--participants-per-event', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_load.json',
+        help='json report, - for stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workload = WORKLOADS[args.workload]
+    _, uncovered = covered_routes(workload)
+    if uncovered:
+        print(f'not covered by the {args.workload} workload: {", ".join(uncovered)}')
+
+    #Auth0 is replaced by the local test keys
+    auth.jwks_store = JWKSKeyStore(make_file_fetcher(JWKS_PATH))
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    with app.app_context():
+        state = seed(args.orgs, args.events_per_org, args.users,
+            args.participants_per_event, rng)
+    print(f'seeded in {time.perf_counter() - start:.1f} s')
+
+    results, duration = run_load(state, workload, args.concurrency, args.requests,
+        args.warmup, args.seed)
+    report = make_report(args, results, duration, uncovered)
+    print_report(report)
+
+    encoded = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(encoded)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(encoded + '\n')
+        print(f'report written to {args.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
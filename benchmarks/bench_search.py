@@ -0,0 +1,169 @@
+"""Latency of GET /events/search and GET /users/search on a large database,
+served by the GIN indexes of migration 7e3b9a1c5d62, against a sequential
+ILIKE scan of the same columns.
+
+Event words are drawn from a skewed vocabulary, so searches range from a
+handful of matches to a large share of the table: ranking reads every match,
+the latency of a search grows with its number of matches, not with the size
+of the table.
+
+!!NOTE this resets the database configured through setup.sh with
+reset_db_with_fixtures, then adds `n_events` events and `n_users` users,
+generated by postgres.
+
+run from the repository root:
+    python benchmarks/bench_search.py [n_events] [n_users] [repeat]
+"""
+import os
+import sys
+import time
+from urllib.parse import quote
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from app import app
+from models import db
+from fixtures import reset_db_with_fixtures
+
+SKILLS = ['cooking', 'first aid', 'driving', 'teaching', 'web development', 'gardening',
+    'counselling', 'fundraising', 'photography', 'translation', 'carpentry', 'coaching',
+    'accounting', 'nursing', 'music', 'sign language', 'plumbing', 'design', 'writing', 'law']
+WORDS = ['community', 'garden', 'food', 'bank', 'beach', 'cleanup', 'charity', 'run',
+    'animal', 'shelter', 'library', 'reading', 'tutoring', 'elderly', 'visit', 'park',
+    'river', 'tree', 'planting', 'recycling', 'festival', 'kitchen', 'soup', 'clothes',
+    'donation', 'school', 'repair', 'cafe', 'hospital', 'youth', 'sports', 'mural']
+CITIES = ['London', 'Manchester', 'Bristol', 'Leeds', 'Glasgow', 'Cardiff', 'Belfast',
+    'Brighton', 'York', 'Oxford', 'Cambridge', 'Norwich', 'Exeter', 'Bath', 'Durham']
+#synthetic words making the long tail of the vocabulary
+N_RARE_WORDS = 5000
+
+EVENT_SEARCHES = ['community', 'garden', 'soup kitchen', '"beach cleanup"',
+    'mural -london', 'word4321', 'word17 or word18']
+SKILL_SEARCHES = ['cooking', 'sign language', 'cooking,first aid', 'law,plumbing&match=any']
+
+
+def sql_array(values):
+    return 'ARRAY[' + ', '.join("'" + value.replace("'", "''") + "'" for value in values) + ']'
+
+
+def seed(n_events, n_users):
+    """Fixtures plus n_events and n_users generated in SQL, with the same
+    random words on every run"""
+    reset_db_with_fixtures(db)
+    words = WORDS + [f'word{i}' for i in range(N_RARE_WORDS)]
+    #cube of a uniform number: the first words are by far the most frequent
+    word = f"w[1 + floor(power(random(), 3) * {len(words)})::int]"
+    with db.engine.begin() as conn:
+        conn.execute(text('SELECT setseed(0.42)'))
+        conn.execute(text(f"""
+            INSERT INTO event (name, description, start_datetime, end_datetime, address,
+                organisation_id)
+            SELECT {word} || ' ' || {word} || ' ' || {word},
+                concat_ws(' ', {', '.join([word] * 8)}),
+                start, start + interval '2 hours',
+                (floor(random() * 200) + 1)::int || ' High Street, ' ||
+                    c[1 + floor(random() * {len(CITIES)})::int],
+                1 + i % 3
+            FROM generate_series(1, :n_events) AS i,
+                (SELECT {sql_array(words)} AS w, {sql_array(CITIES)} AS c) AS vocabulary,
+                LATERAL (SELECT now()::timestamp(0) + (i % 17520 - 8760) * interval '1 hour'
+                    AS start) AS starts
+        """), {'n_events': n_events})
+        #`0 * i` correlates the skills subquery, else it is run once for every user
+        conn.execute(text(f"""
+            INSERT INTO "user" (name, join_date, skills)
+            SELECT 'bench user ' || i, now(), ARRAY(
+                SELECT DISTINCT s[1 + floor(power(random(), 2) * {len(SKILLS)})::int]
+                FROM generate_series(1, 1 + (random() * 3)::int + 0 * i))
+            FROM generate_series(1, :n_users) AS i, (SELECT {sql_array(SKILLS)} AS s) AS skills
+        """), {'n_users': n_users})
+        conn.execute(text("""
+            UPDATE organisation SET event_count = counts.n
+            FROM (SELECT organisation_id, count(*) AS n FROM event GROUP BY organisation_id) AS counts
+            WHERE organisation.id = counts.organisation_id
+        """))
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('VACUUM ANALYZE event'))
+        conn.execute(text('VACUUM ANALYZE "user"'))
+
+
+def timed(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return durations[len(durations) // 2], durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+
+
+def fetch_pages(client, url, pages, headers=None):
+    """Follow the cursors of url for up to pages pages"""
+    cursor = ''
+    for _ in range(pages):
+        res = client.get(f'{url}&cursor={cursor}', headers=headers)
+        assert res.status_code == 200, res.data
+        cursor = res.get_json()['next_cursor']
+        if cursor is None:
+            return
+
+
+def uses_index(conn, statement, index, **params):
+    plan = '\n'.join(row[0] for row in conn.execute(text('EXPLAIN ' + statement), params))
+    return index in plan
+
+
+def print_row(label, matches, first, deep, extra=''):
+    print(f'{label:>32}: {matches:>8} matches, first page p50 {first[0] * 1000:7.1f} ms '
+        f'p95 {first[1] * 1000:7.1f} ms, 5 pages p50 {deep[0] * 1000:7.1f} ms{extra}')
+
+
+def main(n_events=1000000, n_users=100000, repeat=20):
+    start = time.perf_counter()
+    seed(n_events, n_users)
+    print(f'{n_events} events and {n_users} users seeded in {time.perf_counter() - start:.1f} s')
+    client = app.test_client()
+
+    print('GET /events/search')
+    with db.engine.connect() as conn:
+        for q in EVENT_SEARCHES:
+            matches = conn.execute(text("SELECT count(*) FROM event WHERE search_vector @@ "
+                "websearch_to_tsquery('english', :q)"), {'q': q}).scalar()
+            indexed = uses_index(conn, "SELECT id FROM event WHERE search_vector @@ "
+                "websearch_to_tsquery('english', :q)", 'ix_event_search_vector', q=q)
+            url = f'/events/search?q={quote(q)}&limit=20'
+            first = timed(lambda: fetch_pages(client, url, 1), repeat)
+            deep = timed(lambda: fetch_pages(client, url, 5), max(1, repeat // 4))
+            print_row(q, matches, first, deep, '' if indexed else ', seq scan')
+
+        #what a search without the index costs, a sequential scan
+        q = 'word4321'
+        baseline = timed(lambda: conn.execute(text(
+            "SELECT id FROM event WHERE name ILIKE :p OR description ILIKE :p "
+            "OR address ILIKE :p ORDER BY id LIMIT 21"), {'p': f'%{q}%'}).all(),
+            max(1, repeat // 4))
+        print(f'{"ILIKE " + q:>32}: p50 {baseline[0] * 1000:7.1f} ms')
+
+    print('GET /users/search')
+    headers = {'Authorization': 'Bearer bench'}
+    payload = {'sub': 'bench', 'permissions': ['search:users']}
+    with db.engine.connect() as conn, patch('auth.verify_decode_jwt', return_value=payload):
+        for query in SKILL_SEARCHES:
+            skills, _, match = query.partition('&match=')
+            skills = skills.split(',')
+            operator = '&&' if match == 'any' else '@>'
+            statement = f'SELECT id FROM "user" WHERE skills {operator} CAST(:skills AS varchar[])'
+            matches = conn.execute(text(statement.replace('id', 'count(*)', 1)),
+                {'skills': skills}).scalar()
+            url = f'/users/search?skills={quote(query, safe=",&=")}&limit=20'
+            first = timed(lambda: fetch_pages(client, url, 1, headers), repeat)
+            deep = timed(lambda: fetch_pages(client, url, 5, headers), max(1, repeat // 4))
+            indexed = uses_index(conn, statement, 'ix_user_skills', skills=skills)
+            print_row(query, matches, first, deep, '' if indexed else ', seq scan')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
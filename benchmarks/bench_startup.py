@@ -0,0 +1,55 @@
+"""Cold start of a worker: time to import the app and to answer its first
+request, in fresh processes. `create_all` adds the db.create_all() that
+setup_db used to run on import.
+
+run from the repository root, with the database of setup.sh migrated:
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = """
+import sys, json, time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+start = time.perf_counter()
+from app import app, db
+if sys.argv[1] == 'create_all':
+    with app.app_context():
+        db.create_all()
+imported = time.perf_counter()
+boot_statements = len(statements)
+res = app.test_client().get('/events?limit=1')
+assert res.status_code == 200, res.status_code
+first_request = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_request': first_request - imported,
+    'boot_statements': boot_statements}))
+"""
+
+
+def run(mode):
+    output = subprocess.run([sys.executable, '-c', WORKER, mode], cwd=ROOT,
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(runs=10):
+    for mode in ('create_all', 'lazy'):
+        timings = [run(mode) for _ in range(runs)]
+        imported = statistics.median(t['import'] for t in timings)
+        first = statistics.median(t['first_request'] for t in timings)
+        print(f'{mode:>10}: import {imported * 1000:7.1f} ms, first request '
+            f'{first * 1000:7.1f} ms, ready after {(imported + first) * 1000:7.1f} ms '
+            f'(median of {runs}), {timings[0]["boot_statements"]} queries before serving')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,96 @@
+"""Time-to-first-byte and peak memory of GET /events?stream=true against
+building the same envelope in memory with jsonify.
+
+!!NOTE this resets the database configured through setup.sh with
+reset_db_with_fixtures, then adds `n_events` extra events.
+
+run from the repository root:
+    python benchmarks/bench_streaming.py [n_events]
+"""
+import os
+import sys
+import time
+import random
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify
+
+from app import app
+from models import db, event_users, Event, User
+from fixtures import reset_db_with_fixtures
+from queries import query_events, format_event_row
+
+
+def seed_events(n_events, participants_per_event=5):
+    reset_db_with_fixtures(db)
+    user_ids = [u.id for u in User.query.all()]
+    start = datetime(2021, 1, 1)
+    for offset in range(0, n_events, 1000):
+        batch = [{
+            'name': f'bench event {i}',
+            'description': 'benchmark event',
+            'start_datetime': start + timedelta(hours=i),
+            'end_datetime': start + timedelta(hours=i + 2),
+            'address': 'London SW1A 0AA, UK',
+            'organisation_id': 1 + i % 3,
+        } for i in range(offset, min(offset + 1000, n_events))]
+        ids = db.session.execute(
+            Event.__table__.insert().values(batch).returning(Event.__table__.c.id)
+        ).scalars().all()
+        db.session.execute(event_users.insert(), [
+            {'event_id': event_id, 'user_id': user_id}
+            for event_id in ids
+            for user_id in random.sample(user_ids, min(participants_per_event, len(user_ids)))
+        ])
+        db.session.commit()
+
+
+def buffered():
+    """what GET /events did before pagination and streaming"""
+    start = time.perf_counter()
+    with app.test_request_context():
+        rows = query_events().order_by(Event.start_datetime, Event.id).all()
+        body = jsonify({
+            'success': True,
+            'data': [format_event_row(row) for row in rows],
+            'next_cursor': None
+        }).get_data()
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, len(body)
+
+
+def streamed():
+    start = time.perf_counter()
+    res = app.test_client().get('/events?stream=true', buffered=False)
+    chunks = iter(res.response)
+    size = len(next(chunks))
+    ttfb = time.perf_counter() - start
+    for chunk in chunks:
+        size += len(chunk)
+    res.close()
+    return ttfb, time.perf_counter() - start, size
+
+
+def measure(fn):
+    db.session.remove()
+    tracemalloc.start()
+    ttfb, total, size = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ttfb, total, size, peak
+
+
+def main(n_events=20000):
+    seed_events(n_events)
+    print(f'{n_events} events')
+    for name, fn in (('buffered', buffered), ('streamed', streamed)):
+        ttfb, total, size, peak = measure(fn)
+        print(f'{name:>9}: ttfb {ttfb * 1000:8.1f} ms, total {total * 1000:8.1f} ms, '
+            f'{size / 1e6:6.1f} MB body, peak python memory {peak / 1e6:6.1f} MB')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
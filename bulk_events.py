@@ -0,0 +1,353 @@
+"""Bulk import and export of events as NDJSON or CSV.
+
+Imports are read record by record, then validated and written in batches:
+each batch is checked against the organisations with one IN query and
+written with one multi-row INSERT and one commit, see models.add_events.
+The outcome is reported while the import runs, one json object per line: an
+error for every rejected record and a summary per batch, so large imports
+can be followed and only the failed records retried.
+
+Both directions are available through the API (POST /events/import,
+GET /events/export) and the `flask import-events` / `flask export-events`
+commands.
+"""
+import os
+import io
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask import current_app, stream_with_context
+from flask.cli import with_appcontext
+from sqlalchemy.exc import SQLAlchemyError
+
+import json_backend
+from models import db, add_events, Organisation, Event
+from geocoding import check_coordinates
+from streaming import STREAM_BATCH_SIZE, STREAM_CHUNK_SIZE
+
+#records validated and written per insert / commit
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+
+FORMATS = ('ndjson', 'csv')
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+#fields read by the import, exported in this order after the id
+EVENT_FIELDS = ('name', 'description', 'start_datetime', 'end_datetime',
+    'address', 'organisation_id', 'latitude', 'longitude')
+#exported for reference, ignored on import as ids are assigned by the database
+IGNORED_FIELDS = ('id',)
+
+
+def read_ndjson(lines):
+    """Parse newline delimited json, blank lines are skipped
+
+    Args:
+        lines (iterable): text lines
+
+    Yields:
+        tuple: (line number, record dict or error message)
+    """
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_no, 'invalid json'
+            continue
+        if not isinstance(record, dict):
+            yield line_no, 'expected a json object'
+            continue
+        yield line_no, record
+
+
+def read_csv(lines):
+    """Parse csv with a header row, empty cells are read as null
+
+    Args:
+        lines (iterable): text lines
+
+    Yields:
+        tuple: (line number, record dict or error message)
+    """
+    reader = csv.DictReader(lines)
+    for record in reader:
+        if None in record:
+            yield reader.line_num, 'more cells than header columns'
+            continue
+        yield reader.line_num, {
+            field: value if value != '' else None
+            for field, value in record.items()
+        }
+
+
+def read_records(lines, fmt):
+    if fmt == 'csv':
+        return read_csv(lines)
+    return read_ndjson(lines)
+
+
+def guess_format(filename):
+    return 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+
+
+def _parse_datetime(record, field):
+    value = record.get(field, None)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} is not an iso formatted datetime')
+
+
+def _parse_number(record, field):
+    value = record.get(field, None)
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f'{field} must be a number')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be a number')
+
+
+def validate_record(record, default_organisation_id=None):
+    """Check an imported record and convert it to Event column values
+
+    Args:
+        record (dict): parsed record, values are strings in csv imports
+        default_organisation_id (int): organisation of records without one
+
+    Raises:
+        ValueError: the first problem found in the record
+
+    Returns:
+        dict: value of every column in EVENT_FIELDS
+    """
+    unknown = set(record) - set(EVENT_FIELDS) - set(IGNORED_FIELDS)
+    if unknown:
+        raise ValueError(f'unknown fields: {", ".join(sorted(unknown))}')
+
+    name = record.get('name', None)
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required')
+    for field in ('description', 'address'):
+        if not isinstance(record.get(field, None), (str, type(None))):
+            raise ValueError(f'{field} must be a string')
+
+    start_datetime = _parse_datetime(record, 'start_datetime')
+    end_datetime = _parse_datetime(record, 'end_datetime')
+    #same check as the table constraint, so a bad row can't fail its batch
+    if start_datetime and end_datetime and end_datetime <= start_datetime:
+        raise ValueError('start date must be earlier than end date')
+
+    organisation_id = record.get('organisation_id', None)
+    if organisation_id is None:
+        organisation_id = default_organisation_id
+    if isinstance(organisation_id, str) and organisation_id.isdigit():
+        organisation_id = int(organisation_id)
+    if type(organisation_id) is not int:
+        raise ValueError('organisation_id is required')
+
+    #records without coordinates are geocoded by add_events
+    latitude = _parse_number(record, 'latitude')
+    longitude = _parse_number(record, 'longitude')
+    check_coordinates(latitude, longitude)
+
+    return {
+        'name': name,
+        'description': record.get('description', None),
+        'start_datetime': start_datetime,
+        'end_datetime': end_datetime,
+        'address': record.get('address', None),
+        'organisation_id': organisation_id,
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+
+
+def _import_batch(batch, default_organisation_id, organisation_ids, known_org_ids):
+    """Validate and insert one batch
+
+    Returns:
+        tuple: (errors in line order, number of events inserted)
+    """
+    errors = []
+    valid = []
+    for line, record in batch:
+        if isinstance(record, str):
+            errors.append({'line': line, 'error': record})
+            continue
+        try:
+            values = validate_record(record, default_organisation_id)
+        except ValueError as e:
+            errors.append({'line': line, 'error': str(e)})
+            continue
+        if organisation_ids is not None and values['organisation_id'] not in organisation_ids:
+            errors.append({'line': line, 'error': 'organisation not permitted'})
+            continue
+        valid.append((line, values))
+
+    #organisations seen in earlier batches aren't looked up again
+    unknown = {values['organisation_id'] for _, values in valid} - known_org_ids
+    if unknown:
+        known_org_ids.update(row.id for row in
+            db.session.query(Organisation.id).filter(Organisation.id.in_(unknown)))
+
+    rows = []
+    for line, values in valid:
+        if values['organisation_id'] in known_org_ids:
+            rows.append((line, values))
+        else:
+            errors.append({'line': line, 'error': 'organisation not found'})
+
+    try:
+        add_events([values for _, values in rows])
+    except SQLAlchemyError as e:
+        print(e)
+        db.session.rollback()
+        errors += [{'line': line, 'error': 'rejected by the database'} for line, _ in rows]
+        rows = []
+
+    errors.sort(key=lambda error: error['line'])
+    return errors, len(rows)
+
+
+def import_events(records, default_organisation_id=None, organisation_ids=None,
+        batch_size=None):
+    """Validate and insert records, one transaction per batch
+
+    Args:
+        records (iterable): (line number, record or error) from read_records
+        default_organisation_id (int): organisation of records without one
+        organisation_ids (set): if given, records of other organisations
+            are rejected
+        batch_size (int): records per batch, defaults to IMPORT_BATCH_SIZE
+
+    Yields:
+        dict: {line, error} for every rejected record, {batch, imported,
+            failed} after each batch and the {imported, failed} totals last
+    """
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    records = iter(records)
+    known_org_ids = set()
+    totals = {'imported': 0, 'failed': 0}
+    batch_no = 0
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        batch_no += 1
+        errors, imported = _import_batch(batch, default_organisation_id,
+            organisation_ids, known_org_ids)
+        yield from errors
+        yield {'batch': batch_no, 'imported': imported, 'failed': len(errors)}
+        totals['imported'] += imported
+        totals['failed'] += len(errors)
+    yield totals
+
+
+def query_export(organisation_id=None):
+    """Rows of every event, or an organisation's, in id order"""
+    query = db.session.query(Event.id, *[getattr(Event, field) for field in EVENT_FIELDS])
+    if organisation_id is not None:
+        query = query.filter(Event.organisation_id == organisation_id)
+    return query.order_by(Event.id).yield_per(STREAM_BATCH_SIZE)
+
+
+def generate_export(rows, fmt):
+    """Encode exported rows in chunks, in a format read back by read_records
+
+    Yields:
+        bytes: chunks of about STREAM_CHUNK_SIZE
+    """
+    backend = json_backend.backend
+    fields = IGNORED_FIELDS + EVENT_FIELDS
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+
+    def encode_csv(values):
+        writer.writerow(values)
+        encoded = out.getvalue().encode('utf-8')
+        out.seek(0)
+        out.truncate()
+        return encoded
+
+    buffer = [encode_csv(fields)] if fmt == 'csv' else []
+    size = 0
+    for row in rows:
+        if fmt == 'csv':
+            encoded = encode_csv(['' if value is None else
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in row])
+        else:
+            encoded = backend.dumps(dict(zip(fields, row))) + b'\n'
+        buffer.append(encoded)
+        size += len(encoded)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    yield b''.join(buffer)
+
+
+def ndjson_response(results):
+    """Stream import results back, one json object per line"""
+    backend = json_backend.backend
+    return current_app.response_class(
+        stream_with_context(backend.dumps(result) + b'\n' for result in results),
+        mimetype=MIMETYPES['ndjson']
+    )
+
+
+def export_response(fmt, organisation_id=None):
+    return current_app.response_class(
+        stream_with_context(generate_export(query_export(organisation_id), fmt)),
+        mimetype=MIMETYPES[fmt]
+    )
+
+
+@click.command('import-events')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+    help='Defaults to csv for .csv files, ndjson otherwise.')
+@click.option('--organisation-id', type=int, default=None,
+    help='Organisation of the records without an organisation_id.')
+@click.option('--batch-size', type=int, default=None,
+    help=f'Records per transaction, defaults to {IMPORT_BATCH_SIZE}.')
+@with_appcontext
+def import_events_command(source, fmt, organisation_id, batch_size):
+    """Import events from an NDJSON or CSV file ('-' for stdin).
+
+    Prints a json line per rejected record and per batch, exits with 1 if
+    any record was rejected.
+    """
+    fmt = fmt or guess_format(source.name)
+    result = None
+    for result in import_events(read_records(source, fmt), organisation_id,
+            batch_size=batch_size):
+        click.echo(json.dumps(result))
+    if result and result['failed']:
+        raise click.exceptions.Exit(1)
+
+
+@click.command('export-events')
+@click.argument('destination', type=click.File('wb'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+    help='Defaults to csv for .csv files, ndjson otherwise.')
+@click.option('--organisation-id', type=int, default=None,
+    help='Only export the events of this organisation.')
+@with_appcontext
+def export_events_command(destination, fmt, organisation_id):
+    """Export events as NDJSON or CSV to a file, stdout by default"""
+    fmt = fmt or guess_format(destination.name)
+    for chunk in generate_export(query_export(organisation_id), fmt):
+        destination.write(chunk)
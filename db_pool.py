@@ -0,0 +1,198 @@
+"""Connection pool configuration and metrics.
+
+Every worker keeps a pool of DB_POOL_SIZE connections, growing by up to
+DB_MAX_OVERFLOW under bursts. Connections are pinged before use and recycled
+after DB_POOL_RECYCLE seconds, so the ones broken by a failover are replaced
+instead of failing a request.
+
+With DB_EXTERNAL_POOLER=true the workers sit behind a transaction pooling
+proxy (i.e. pgbouncer): they don't pool connections themselves and keep no
+session state on the server, the statement timeout is set per transaction
+with SET LOCAL instead of as a connection option.
+
+With DB_ASYNC=true (set by the ASGI entry point, see asgi.py) engines connect
+with asyncpg instead of psycopg2. They are used the same way, from code
+running in a greenlet on the event loop, which waits on the database without
+blocking the loop.
+"""
+import os
+import time
+import threading
+
+from sqlalchemy import create_engine as sa_create_engine, event as sa_event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+
+def get_bool_env(name, default):
+    return os.getenv(name, str(default)).lower() in ('true', '1')
+
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+#seconds to wait for a connection when the pool is exhausted
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = get_bool_env('DB_POOL_PRE_PING', True)
+#milliseconds, 0 disables the timeout
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+DB_APPLICATION_NAME = os.getenv('DB_APPLICATION_NAME', 'volunteer_app')
+DB_EXTERNAL_POOLER = get_bool_env('DB_EXTERNAL_POOLER', False)
+DB_ASYNC = get_bool_env('DB_ASYNC', False)
+#tests only: async connections also usable outside of requests, each query
+#then runs the event loop until it completes
+DB_ASYNC_FALLBACK = get_bool_env('DB_ASYNC_FALLBACK', False)
+
+
+def engine_options(external_pooler=DB_EXTERNAL_POOLER, statement_timeout=DB_STATEMENT_TIMEOUT,
+        async_driver=DB_ASYNC):
+    """create_engine() keyword arguments for the configured pool
+
+    Args:
+        external_pooler (bool): connect through a transaction pooling proxy
+        statement_timeout (int): milliseconds, 0 for no timeout
+        async_driver (bool): connect with asyncpg instead of psycopg2
+
+    Returns:
+        dict: i.e. for SQLALCHEMY_ENGINE_OPTIONS
+    """
+    if async_driver:
+        settings = {'application_name': DB_APPLICATION_NAME}
+        connect_args = {'server_settings': settings}
+    else:
+        connect_args = {'application_name': DB_APPLICATION_NAME}
+
+    if external_pooler:
+        if async_driver:
+            #prepared statements don't outlive a transaction behind the proxy
+            connect_args['statement_cache_size'] = 0
+            connect_args['prepared_statement_cache_size'] = 0
+        #the proxy owns the pool, startup options would be rejected by it
+        return {'poolclass': NullPool, 'connect_args': connect_args}
+
+    if statement_timeout:
+        if async_driver:
+            settings['statement_timeout'] = str(statement_timeout)
+        else:
+            connect_args['options'] = f'-c statement_timeout={statement_timeout}'
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'connect_args': connect_args,
+    }
+
+
+def database_url(url, async_driver=DB_ASYNC, async_fallback=DB_ASYNC_FALLBACK):
+    """url with the driver of the serving mode"""
+    url = make_url(url)
+    if not async_driver:
+        return url
+    url = url.set(drivername='postgresql+asyncpg')
+    if async_fallback:
+        url = url.update_query_dict({'async_fallback': 'true'})
+    return url
+
+
+def create_engine(url, **options):
+    """create_engine() for the driver of the serving mode. Async engines are
+    returned as their sync facade, used like any other engine from greenlets
+    on the event loop"""
+    url = database_url(url)
+    if DB_ASYNC:
+        return create_async_engine(url, **options).sync_engine
+    return sa_create_engine(url, **options)
+
+
+class PoolMetrics(object):
+    """Counters of the connection pool events of one engine"""
+    def __init__(self, engine, clock=time.perf_counter):
+        self.engine = engine
+        self.clock = clock
+
+        #new database connections opened
+        self.connects = 0
+        self.checkouts = 0
+        #connections discarded, i.e. found dead by the pre-ping
+        self.invalidations = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        #total seconds connections were held by the application
+        self.hold_time = 0.0
+        self._lock = threading.Lock()
+        #several PoolMetrics may watch the same pool
+        self._info_key = ('checked_out_at', id(self))
+
+        pool = engine.pool
+        sa_event.listen(pool, 'connect', self._on_connect)
+        sa_event.listen(pool, 'checkout', self._on_checkout)
+        sa_event.listen(pool, 'checkin', self._on_checkin)
+        sa_event.listen(pool, 'invalidate', self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info[self._info_key] = self.clock()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop(self._info_key, None)
+        if checked_out_at is None:
+            return
+        with self._lock:
+            self.checked_out -= 1
+            self.hold_time += self.clock() - checked_out_at
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        pool = self.engine.pool
+        return {
+            'pool': type(pool).__name__,
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+            'connects': self.connects,
+            'checkouts': self.checkouts,
+            'invalidations': self.invalidations,
+            'checked_out': self.checked_out,
+            'max_checked_out': self.max_checked_out,
+            'mean_hold_time': self.hold_time / self.checkouts if self.checkouts else 0.0,
+        }
+
+
+def set_local_statement_timeout(statement_timeout):
+    """Engine 'begin' listener applying the timeout to each transaction"""
+    def on_begin(conn):
+        conn.exec_driver_sql(f'SET LOCAL statement_timeout = {int(statement_timeout)}')
+    return on_begin
+
+
+'''
+pool_metrics
+    PoolMetrics of every engine set up by configure_engine, by url
+'''
+pool_metrics = {}
+
+
+def configure_engine(engine, external_pooler=DB_EXTERNAL_POOLER,
+        statement_timeout=DB_STATEMENT_TIMEOUT):
+    """Attach the pool metrics, and the per transaction settings when
+    connecting through an external pooler, to a new engine"""
+    if external_pooler and statement_timeout:
+        sa_event.listen(engine, 'begin', set_local_statement_timeout(statement_timeout))
+    pool_metrics[engine.url.render_as_string(hide_password=True)] = PoolMetrics(engine)
+    return engine
+
+
+def pool_stats():
+    return {url: metrics.stats() for url, metrics in pool_metrics.items()}
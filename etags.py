@@ -0,0 +1,28 @@
+"""Strong ETags for event and organisation reads, derived from the row
+version columns bumped by ModelMixin.touch().
+"""
+from flask import request, current_app
+
+
+def event_etag(event_id, version):
+    return f'event-{event_id}-v{version}'
+
+
+def organisation_etag(organisation_id, version, latest_past_end):
+    """The organisation payload splits its events into past and upcoming, so
+    the etag also carries the end of the latest past event, which moves
+    whenever an event ends"""
+    past = latest_past_end.isoformat() if latest_past_end else 'none'
+    return f'organisation-{organisation_id}-v{version}-p{past}'
+
+
+def is_not_modified(etag):
+    """Whether the request's If-None-Match matches etag"""
+    return etag is not None and request.if_none_match.contains_weak(etag)
+
+
+def not_modified(etag):
+    """Empty 304 response carrying etag"""
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
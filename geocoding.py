@@ -0,0 +1,114 @@
+"""Coordinates of event addresses.
+
+Events written with an address and without coordinates are geocoded by
+`geocoder`, any callable address -> (latitude, longitude), or None for an
+unknown address. No network service is called by default: with
+GEOCODE_TABLE set, addresses are looked up in a local csv file of
+`address,latitude,longitude` rows, without it new events are left without
+coordinates and aren't found by GET /events/nearby, and events changing
+address keep theirs. Another geocoder can be
+installed by assigning geocoding.geocoder.
+
+`flask geocode-events` geocodes the events written before.
+"""
+import os
+import csv
+
+#csv file of address,latitude,longitude rows, with a header
+GEOCODE_TABLE = os.getenv('GEOCODE_TABLE', None)
+
+
+def normalize_address(address):
+    """Address compared case, comma and whitespace insensitively"""
+    return ' '.join(address.lower().replace(',', ' ').split())
+
+
+def check_coordinates(latitude, longitude):
+    """Same checks as the table constraints on Event coordinates
+
+    Raises:
+        ValueError: coordinates out of range, or only one of them
+    """
+    if (latitude is None) != (longitude is None):
+        raise ValueError('latitude and longitude go together')
+    if latitude is None:
+        return
+    if not -90 <= latitude <= 90:
+        raise ValueError('latitude must be between -90 and 90')
+    if not -180 <= longitude <= 180:
+        raise ValueError('longitude must be between -180 and 180')
+
+
+class LookupGeocoder(object):
+    """Geocoder answering from a table of known addresses
+
+    Args:
+        table (dict): address -> (latitude, longitude)
+    """
+    def __init__(self, table):
+        self.table = {normalize_address(address): (float(latitude), float(longitude))
+            for address, (latitude, longitude) in table.items()}
+
+    @classmethod
+    def from_csv(cls, path):
+        with open(path, newline='', encoding='utf-8') as f:
+            return cls({row['address']: (row['latitude'], row['longitude'])
+                for row in csv.DictReader(f)})
+
+    def __call__(self, address):
+        return self.table.get(normalize_address(address), None)
+
+
+'''
+geocoder
+    callable address -> (latitude, longitude) or None, None to leave events
+    without coordinates
+'''
+geocoder = LookupGeocoder.from_csv(GEOCODE_TABLE) if GEOCODE_TABLE else None
+
+
+def geocoder_configured():
+    """Whether addresses can be geocoded at all"""
+    return geocoder is not None
+
+
+def geocode(address):
+    """Coordinates of an address, None if it is unknown or no geocoder is set.
+    Geocoder failures are logged, never raised: the event is written
+    without coordinates
+
+    Returns:
+        tuple: (latitude, longitude) or None
+    """
+    if geocoder is None or not address:
+        return None
+    try:
+        coordinates = geocoder(address)
+        if coordinates is None:
+            return None
+        latitude, longitude = float(coordinates[0]), float(coordinates[1])
+        check_coordinates(latitude, longitude)
+        return latitude, longitude
+    except Exception as e:
+        print(e)
+        return None
+
+
+def fill_coordinates(values):
+    """Event column values with latitude and longitude set, geocoded from
+    the address unless one of them is given
+
+    Args:
+        values (dict): Event column values
+
+    Returns:
+        dict: a copy of values, with both keys
+    """
+    values = dict(values)
+    if values.get('latitude', None) is None and values.get('longitude', None) is None:
+        values['latitude'], values['longitude'] = \
+            geocode(values.get('address', None)) or (None, None)
+    else:
+        values.setdefault('latitude', None)
+        values.setdefault('longitude', None)
+    return values
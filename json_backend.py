@@ -0,0 +1,113 @@
+"""Pluggable JSON encoding for API responses.
+
+orjson is used when it is installed, the stdlib json module otherwise.
+Both backends encode datetime / date objects as iso 8601 strings, so models
+can hand datetimes straight to the encoder. Select a backend explicitly
+with the JSON_BACKEND environment variable ('orjson' or 'stdlib').
+"""
+import os
+import json
+import uuid
+from datetime import date, datetime
+
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'orjson' if orjson else 'stdlib')
+
+
+def _default(obj):
+    """Encode the types the stdlib json module doesn't know about"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class StdlibBackend(object):
+    name = 'stdlib'
+    #separators used when pretty printing, the item one is needed to
+    #splice streamed output together the same way
+    pretty_separators = (', ', ': ')
+
+    def dumps(self, obj, pretty=False, sort_keys=True, ensure_ascii=True):
+        """Encode obj to utf-8 json bytes"""
+        if pretty:
+            indent, separators = 2, self.pretty_separators
+        else:
+            indent, separators = None, (',', ':')
+        return json.dumps(obj, indent=indent, separators=separators,
+            sort_keys=sort_keys, ensure_ascii=ensure_ascii,
+            default=_default).encode('utf-8')
+
+
+class OrjsonBackend(object):
+    name = 'orjson'
+    pretty_separators = (',', ': ')
+
+    def dumps(self, obj, pretty=False, sort_keys=True, ensure_ascii=True):
+        """Encode obj to utf-8 json bytes. orjson never escapes non-ascii
+        characters, ensure_ascii is accepted for interface compatibility"""
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_default, option=option)
+
+
+BACKENDS = {
+    'stdlib': StdlibBackend,
+    'orjson': OrjsonBackend,
+}
+
+
+def make_backend(name):
+    """Instantiate a backend by name, falling back to stdlib if the encoder
+    isn't installed"""
+    if name not in BACKENDS:
+        raise ValueError(f'unknown json backend: {name}')
+    if name == 'orjson' and orjson is None:
+        name = 'stdlib'
+    return BACKENDS[name]()
+
+
+backend = make_backend(JSON_BACKEND)
+
+
+def set_backend(name):
+    """Switch the process-wide backend, returns the previous one"""
+    global backend
+    previous = backend
+    backend = make_backend(name)
+    return previous
+
+
+def dumps(obj):
+    """Encode obj with the app's json settings (pretty printing in debug,
+    JSON_SORT_KEYS, JSON_AS_ASCII)"""
+    config = current_app.config
+    return backend.dumps(obj,
+        pretty=config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug,
+        sort_keys=config['JSON_SORT_KEYS'],
+        ensure_ascii=config['JSON_AS_ASCII'])
+
+
+def jsonify(*args, **kwargs):
+    """Drop-in replacement for flask.jsonify using the configured backend"""
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    return current_app.response_class(
+        dumps(data) + b'\n',
+        mimetype=current_app.config['JSONIFY_MIMETYPE']
+    )
@@ -0,0 +1,248 @@
+"""Opt-in instrumentation of requests, enabled with METRICS_ENABLED=true.
+
+For every route: a latency histogram, the number of SQL statements and the
+time spent running them, and the time requires_auth spent verifying tokens.
+Metrics are kept per worker process and exposed at GET /metrics in the
+Prometheus text format. Each response also carries a Server-Timing header
+(db, auth and total durations, up to the first byte for streamed responses)
+shown by browser dev tools.
+
+Disabled, nothing is hooked: no engine listener, no request hook, and
+requires_auth only checks an empty list.
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from flask import g, request, has_request_context
+from sqlalchemy import event as sa_event
+from sqlalchemy.engine import Engine
+
+import auth
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() in ('true', '1')
+#upper bounds of the histogram buckets, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+clock = time.perf_counter
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        #observations per bucket, the last one above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """(upper bound, observations up to it) per bucket, +Inf last"""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+def format_labels(labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry(object):
+    """Metrics of the requests served by this process, by method and route"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.clear()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        self.requests = Counter()
+        self.latency = {}
+        self.auth_latency = {}
+        self.queries = Counter()
+        self.db_seconds = Counter()
+
+    def observe(self, method, route, status, seconds, queries=0, db_seconds=0.0,
+            auth_seconds=None):
+        """Record a finished request
+
+        Args:
+            method (str): http method
+            route (str): url rule of the request, i.e. '/events/<int:event_id>'
+            status (int): response status code
+            seconds (float): time from the start to the end of the request
+            queries (int): SQL statements run
+            db_seconds (float): time spent running them
+            auth_seconds (float): time spent verifying the token, None if
+                the request wasn't authenticated
+        """
+        key = (method, route)
+        with self._lock:
+            self.requests[key + (status,)] += 1
+            self.latency.setdefault(key, Histogram(self.buckets)).observe(seconds)
+            self.queries[key] += queries
+            self.db_seconds[key] += db_seconds
+            if auth_seconds is not None:
+                self.auth_latency.setdefault(key, Histogram(self.buckets)).observe(auth_seconds)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+
+        def counter(name, help_text, values, label_names):
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} counter'])
+            for key, value in sorted(values.items()):
+                lines.append(f'{name}{format_labels(dict(zip(label_names, key)))} '
+                    f'{format_value(value)}')
+
+        def histogram(name, help_text, histograms):
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} histogram'])
+            for (method, route), hist in sorted(histograms.items()):
+                labels = {'method': method, 'route': route}
+                for bound, count in hist.cumulative_counts():
+                    lines.append(f'{name}_bucket'
+                        f'{format_labels({**labels, "le": format_value(bound)})} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(hist.sum)}')
+                lines.append(f'{name}_count{format_labels(labels)} {hist.count}')
+
+        with self._lock:
+            counter('http_requests_total', 'Requests served, by route and status.',
+                self.requests, ('method', 'route', 'status'))
+            histogram('http_request_duration_seconds', 'Time to serve a request.', self.latency)
+            counter('db_queries_total', 'SQL statements run by requests.',
+                self.queries, ('method', 'route'))
+            counter('db_query_duration_seconds_total', 'Time requests spent running SQL statements.',
+                self.db_seconds, ('method', 'route'))
+            histogram('auth_verify_duration_seconds', 'Time requires_auth spent verifying the token.',
+                self.auth_latency)
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetrics(object):
+    """Measurements of the current request, kept in g"""
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.auth_seconds = None
+        self.status = None
+
+    def server_timing(self, now):
+        timings = [f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"']
+        if self.auth_seconds is not None:
+            timings.append(f'auth;dur={self.auth_seconds * 1000:.1f}')
+        timings.append(f'total;dur={(now - self.started_at) * 1000:.1f}')
+        return ', '.join(timings)
+
+
+def current_metrics():
+    if not has_request_context():
+        return None
+    return g.get('request_metrics', None)
+
+
+#----------------------------------------------------------------------------#
+# Hooks
+#----------------------------------------------------------------------------#
+def start_request():
+    g.request_metrics = RequestMetrics(clock())
+
+
+def add_server_timing(response):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.status = response.status_code
+        response.headers['Server-Timing'] = metrics.server_timing(clock())
+    return response
+
+
+def finish_request(exception):
+    """teardown hook, runs once streamed responses are sent"""
+    metrics = current_metrics()
+    if metrics is None:
+        return
+    rule = request.url_rule
+    registry.observe(request.method, rule.rule if rule is not None else 'unmatched',
+        metrics.status or 500, clock() - metrics.started_at, metrics.queries,
+        metrics.db_seconds, metrics.auth_seconds)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    #statements of a connection run one at a time
+    conn.info['metrics_started_at'] = clock()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = current_metrics()
+    started_at = conn.info.pop('metrics_started_at', None)
+    if metrics is not None and started_at is not None:
+        metrics.queries += 1
+        metrics.db_seconds += clock() - started_at
+
+
+def record_verify(seconds):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.auth_seconds = (metrics.auth_seconds or 0.0) + seconds
+
+
+'''
+HOOKS
+    flask request hook lists and the functions added to them
+'''
+HOOKS = (
+    ('before_request_funcs', start_request),
+    ('after_request_funcs', add_server_timing),
+    ('teardown_request_funcs', finish_request),
+)
+
+
+def is_enabled(app):
+    return 'metrics' in app.extensions
+
+
+def enable(app):
+    """Start instrumenting app. The hooks are added to flask's lists directly
+    so instrumentation can be switched at runtime, after the first request"""
+    if is_enabled(app):
+        return
+    for attribute, hook in HOOKS:
+        getattr(app, attribute).setdefault(None, []).append(hook)
+    sa_event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    sa_event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    auth.verify_listeners.append(record_verify)
+    app.extensions['metrics'] = registry
+
+
+def disable(app):
+    if not is_enabled(app):
+        return
+    for attribute, hook in HOOKS:
+        getattr(app, attribute)[None].remove(hook)
+    sa_event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+    sa_event.remove(Engine, 'after_cursor_execute', after_cursor_execute)
+    auth.verify_listeners.remove(record_verify)
+    del app.extensions['metrics']
+
+
+def init_app(app, enabled=METRICS_ENABLED):
+    if enabled:
+        enable(app)
@@ -0,0 +1,37 @@
+"""add event coordinates
+
+Revision ID: 1a4f7c3e9b25
+Revises: 7e3b9a1c5d62
+Create Date: 2026-10-17 17:48:09.360751
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a4f7c3e9b25'
+down_revision = '7e3b9a1c5d62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('event', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('event', sa.Column('longitude', sa.Float(), nullable=True))
+    op.create_check_constraint('latitude and longitude go together', 'event',
+        '(latitude IS NULL) = (longitude IS NULL)')
+    op.create_check_constraint('coordinates must be in range', 'event',
+        'latitude BETWEEN -90 AND 90 AND longitude BETWEEN -180 AND 180')
+
+    #existing events are geocoded by `flask geocode-events`
+    op.create_index('ix_event_location', 'event',
+        [sa.text('point(longitude, latitude)')], unique=False, postgresql_using='gist')
+
+
+def downgrade():
+    op.drop_index('ix_event_location', table_name='event')
+    op.drop_constraint('coordinates must be in range', 'event', type_='check')
+    op.drop_constraint('latitude and longitude go together', 'event', type_='check')
+    op.drop_column('event', 'longitude')
+    op.drop_column('event', 'latitude')
@@ -0,0 +1,31 @@
+"""add event listing indexes
+
+Revision ID: 3f1c2a9d8e41
+Revises: 
+Create Date: 2026-10-17 10:12:03.512411
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d8e41'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_event_start_datetime_id', 'event',
+        ['start_datetime', 'id'], unique=False)
+    op.create_index('ix_event_organisation_id_start_datetime_id', 'event',
+        ['organisation_id', 'start_datetime', 'id'], unique=False)
+    op.create_index('ix_event_end_datetime', 'event',
+        ['end_datetime'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_event_end_datetime', table_name='event')
+    op.drop_index('ix_event_organisation_id_start_datetime_id', table_name='event')
+    op.drop_index('ix_event_start_datetime_id', table_name='event')
@@ -0,0 +1,25 @@
+"""add organisation events index
+
+Revision ID: 5c9e0b1d7f28
+Revises: 8b7d4e2f6a13
+Create Date: 2026-10-17 13:05:27.160933
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c9e0b1d7f28'
+down_revision = '8b7d4e2f6a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_event_organisation_id_end_datetime_id', 'event',
+        ['organisation_id', 'end_datetime', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_event_organisation_id_end_datetime_id', table_name='event')
@@ -0,0 +1,36 @@
+"""add event and skills search
+
+Revision ID: 7e3b9a1c5d62
+Revises: d2a6f4c8b390
+Create Date: 2026-10-17 16:02:37.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3b9a1c5d62'
+down_revision = 'd2a6f4c8b390'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    #generated columns are computed for the existing rows, the table is rewritten
+    op.add_column('event', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(address, '')), 'C')",
+        persisted=True)))
+    op.create_index('ix_event_search_vector', 'event', ['search_vector'],
+        unique=False, postgresql_using='gin')
+    op.create_index('ix_user_skills', 'user', ['skills'],
+        unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_user_skills', table_name='user')
+    op.drop_index('ix_event_search_vector', table_name='event')
+    op.drop_column('event', 'search_vector')
@@ -0,0 +1,28 @@
+"""add row versions
+
+Revision ID: 8b7d4e2f6a13
+Revises: 3f1c2a9d8e41
+Create Date: 2026-10-17 11:40:52.804316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b7d4e2f6a13'
+down_revision = '3f1c2a9d8e41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('event', sa.Column('version', sa.Integer(), 
+        server_default='1', nullable=False))
+    op.add_column('organisation', sa.Column('version', sa.Integer(), 
+        server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('organisation', 'version')
+    op.drop_column('event', 'version')
@@ -1,9 +1,20 @@
 import os
 import json
+from collections import Counter
 
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, ARRAY, CheckConstraint
+from sqlalchemy import Column, String, Integer, Float, DateTime, ForeignKey, CheckConstraint, \
+    Index, Computed, inspect, update, delete, select, tuple_, func
+from sqlalchemy.dialects.postgresql import insert, ARRAY, TSVECTOR
+from sqlalchemy.orm import joinedload, lazyload, selectinload, sessionmaker, deferred
 from sqlalchemy.sql.sqltypes import DateTime
-from flask_sqlalchemy import SQLAlchemy
+import click
+import flask_migrate
+from flask.cli import with_appcontext
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+
+from db_pool import engine_options, configure_engine, create_engine
+from geocoding import geocode, geocoder_configured, fill_coordinates
+from replicas import REPLICA_URLS, replica_set, use_replica, request_replica
 
 if os.getenv('FLASK_ENV', None) == 'development':
     DB_HOST = os.environ['DB_HOST']
@@ -22,38 +33,103 @@ else:
     DB_PATH = DB_PATH.replace("postgres://", "postgresql://", 1) 
 
 
-def format_datetime(dt):
-    """Ensure datetime objects are formatted consistently 
-    in the API returns
-    """
-    return dt.isoformat() if dt else None
+'''
+write_listeners
+    callables notified with the set of (table, id) written through ModelMixin,
+    once the write is committed (i.e. response cache invalidation)
+'''
+write_listeners = []
+
+
+def notify_written(written):
+    written = {(table, row_id) for table, row_id in written if row_id is not None}
+    for listener in write_listeners:
+        listener(written)
+
 
 class ModelMixin(object):
+    def touch(self, deleted=False):
+        """Bump the version of this row, and of the rows whose representation
+        embeds it, so ETags derived from the versions change on every write.
+        New rows start at the column default.
+
+        Returns:
+            set: (table, id) of the rows whose representation changed
+        """
+        if not deleted and 'version' in self.__table__.c and inspect(self).persistent:
+            #incremented in SQL so concurrent writers can't lose a bump
+            self.version = self.__class__.version + 1
+        return {(self.__tablename__, self.id)}
+
     def insert(self):
         db.session.add(self)
+        written = self.touch()
+        #the id is read before the commit expires it, saving a refresh
+        db.session.flush()
+        written.add((self.__tablename__, self.id))
         db.session.commit()
+        notify_written(written)
     
     def delete(self):
+        written = self.touch(deleted=True)
         db.session.delete(self)
         db.session.commit()
+        notify_written(written)
     
     def update(self):
+        written = self.touch()
         db.session.commit()
+        notify_written(written)
+
+class RoutingSession(SignallingSession):
+    """Session running the queries of replica_reads requests on a replica,
+    see replicas. Flushes always go to the primary"""
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and use_replica():
+            engine = request_replica()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy service configuring the pools of the engines it creates,
+    see db_pool, and routing reads to replicas"""
+    def create_engine(self, sa_url, engine_opts):
+        return configure_engine(create_engine(sa_url, **engine_opts))
 
-db = SQLAlchemy()
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = PooledSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
 '''
-def setup_db(app, database_path=DB_PATH):
+def setup_db(app, database_path=DB_PATH, replica_paths=REPLICA_URLS):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    #pool size, timeouts and application_name from the DB_* env variables
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+    #optional read replicas for GET requests
+    replica_set.configure(replica_paths)
     db.app = app
+    #the engine is created on first use, the schema by `flask init-db`
     db.init_app(app)
-    db.create_all()
     return db
 
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create the tables of an empty database and stamp it with the latest
+    migration, or apply the pending migrations of an existing one."""
+    if inspect(db.engine).has_table(Event.__tablename__):
+        flask_migrate.upgrade()
+    else:
+        db.create_all()
+        flask_migrate.stamp()
+
 '''
 event_users association table
     each user can have multiple events and vice-versa 
@@ -77,6 +153,10 @@ class Organisation(ModelMixin, db.Model):
     website = Column(String)
     phone_contact = Column(String)
     email_contact = Column(String)
+    #bumped on every write to the organisation or its events, see ModelMixin.touch
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    #number of events, maintained by Event.touch
+    event_count = Column(Integer, nullable=False, default=0, server_default='0')
 
     #an organisation can create multiple events
     events = db.relationship('Event', lazy=True, 
@@ -91,6 +171,13 @@ class Organisation(ModelMixin, db.Model):
             'phone_contact': self.phone_contact,
             'email_contact': self.email_contact,
         }
+'''
+SEARCH_CONFIG
+    postgres text search configuration of the event search vector, queries
+    must be parsed with the same one
+'''
+SEARCH_CONFIG = 'english'
+
 '''
 Event
     a volunteering / charity event 
@@ -100,6 +187,24 @@ class Event(ModelMixin, db.Model):
     __table_args__ = (
         CheckConstraint('end_datetime > start_datetime', 
             name='start date must be earlier than end date'),
+        #keyset pagination of event listings, see migration 3f1c2a9d8e41
+        Index('ix_event_organisation_id_start_datetime_id', 
+            'organisation_id', 'start_datetime', 'id'),
+        Index('ix_event_end_datetime', 'end_datetime'),
+        #past / upcoming split of an organisation's events, see migration 5c9e0b1d7f28
+        Index('ix_event_organisation_id_end_datetime_id', 
+            'organisation_id', 'end_datetime', 'id'),
+        #keyset pagination of event listings and index-only scans of the
+        #events summary, see migration d2a6f4c8b390
+        Index('ix_event_start_datetime_id_counts', 'start_datetime', 'id',
+            postgresql_include=['organisation_id', 'participant_count']),
+        #full text search, see migration 7e3b9a1c5d62
+        Index('ix_event_search_vector', 'search_vector', postgresql_using='gin'),
+        #see geocoding.check_coordinates
+        CheckConstraint('(latitude IS NULL) = (longitude IS NULL)',
+            name='latitude and longitude go together'),
+        CheckConstraint('latitude BETWEEN -90 AND 90 AND longitude BETWEEN -180 AND 180',
+            name='coordinates must be in range'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -108,22 +213,105 @@ class Event(ModelMixin, db.Model):
     start_datetime = Column(DateTime)
     end_datetime = Column(DateTime)
     address = Column(String)
+    #degrees, geocoded from the address unless given, see Event.touch
+    latitude = Column(Float)
+    longitude = Column(Float)
 
     #event is child of organisation 
     organisation_id = Column(Integer, ForeignKey('organisation.id'), nullable=False)
+    #bumped on every write to the event or its participants, see ModelMixin.touch
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    #number of participants, maintained by Event.touch
+    participant_count = Column(Integer, nullable=False, default=0, server_default='0')
+    #weighted words of the name, description and address, computed by postgres.
+    #Deferred, it is only read by the searches, see queries.event_search_query
+    #and queries.event_search_rank
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(name, '')), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(description, '')), 'B') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(address, '')), 'C')",
+        persisted=True)))
 
     #events and users: many-to-many
     participants = db.relationship('User', secondary=event_users,
-        backref=db.backref('events', lazy="joined"))
+        order_by='User.id', backref=db.backref('events', lazy=True))
+
+    def touch(self, deleted=False):
+        """Also bump the organisations listing this event, including the
+        previous one if the event moved. Those are reported as
+        ('organisation.events', id) as only their event lists changed.
+
+        The participant_count of the event and the event_count of the 
+        organisations are kept in step, in SQL for existing rows.
+        """
+        written = super().touch(deleted)
+        state = inspect(self)
+        new = not state.persistent
+
+        #a new address is geocoded, unless coordinates are written with it.
+        #Without a geocoder the coordinates are kept rather than cleared
+        if not deleted and geocoder_configured() and \
+                (state.attrs.address.history.added or new) and \
+                not state.attrs.latitude.history.added and \
+                not state.attrs.longitude.history.added:
+            self.latitude, self.longitude = geocode(self.address) or (None, None)
+
+        #before any statement is executed, autoflush would reset the history
+        if new:
+            self.participant_count = len(self.participants)
+        elif not deleted:
+            history = state.attrs.participants.history
+            change = len(history.added or ()) - len(history.deleted or ())
+            if change:
+                self.participant_count = Event.participant_count + change
+
+        org_id = self.organisation_id
+        if org_id is None and self.organisation is not None:
+            #new event attached through the relationship, not flushed yet
+            org_id = self.organisation.id
+        previous_org_ids = set(state.attrs.organisation_id.history.deleted or ()) 
+        previous_org_ids -= {None, org_id}
+
+        #change of event_count per organisation
+        event_counts = {org_id: -1 if deleted else int(new or bool(previous_org_ids))}
+        for previous_org_id in previous_org_ids:
+            event_counts[previous_org_id] = -1
+        event_counts.pop(None, None)
+        for changed_org_id, change in event_counts.items():
+            db.session.execute(update(Organisation)
+                .where(Organisation.id == changed_org_id)
+                .values(version=Organisation.version + 1,
+                    event_count=Organisation.event_count + change)
+                .execution_options(synchronize_session=False))
+
+        return written | {('organisation.events', org_id) for org_id in event_counts}
+
+    @staticmethod
+    def format_options(include_org=True):
+        """Loader options loading everything format() touches in a fixed
+        number of queries: the organisation name is joined and the 
+        participants' (id, name) are fetched with one extra SELECT ... IN
+        for all events at once
+        """
+        options = [selectinload(Event.participants).load_only(User.id, User.name)]
+        if include_org:
+            options.append(joinedload(Event.organisation)
+                .load_only(Organisation.id, Organisation.name))
+        else:
+            options.append(lazyload(Event.organisation))
+        return options
 
     def format(self, include_org=True, include_participants=True):
         formatted = {
             'id': self.id,
             'name': self.name,
             'description': self.description,
-            'start_datetime': format_datetime(self.start_datetime),
-            'end_datetime': format_datetime(self.end_datetime),
+            #datetimes are encoded as iso 8601 by json_backend
+            'start_datetime': self.start_datetime,
+            'end_datetime': self.end_datetime,
             'address': self.address,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
         }
         if include_org:
             formatted.update({
@@ -140,12 +328,22 @@ class Event(ModelMixin, db.Model):
                 } for user in self.participants]
             })
         return formatted 
+
+#nearby searches: GiST index of the (longitude, latitude) points of events, 
+#see queries.event_location and migration 1a4f7c3e9b25
+Index('ix_event_location', func.point(Event.longitude, Event.latitude),
+    postgresql_using='gist')
+
 '''
 User
     entity that can participate in events
 '''
 class User(ModelMixin, db.Model):
     __tablename__ = 'user'
+    __table_args__ = (
+        #skills containment (@>) and overlap (&&) searches, see migration 7e3b9a1c5d62
+        Index('ix_user_skills', 'skills', postgresql_using='gin'),
+    )
     
     id = Column(Integer, primary_key=True)
     auth0_id = Column(String, unique=True)
@@ -155,6 +353,157 @@ class User(ModelMixin, db.Model):
     phone_contact = Column(String)
 
     join_date = Column(DateTime)
+    #postgres ARRAY, for its containment (@>) and overlap (&&) operators
     skills = Column(ARRAY(String))
 
 
+'''
+add_events(rows)
+    inserts many events with one multi-row statement, the event_count and
+    version of their organisations are bumped in the same transaction
+'''
+def add_events(rows):
+    """Insert events in one statement and commit, events without coordinates
+    are geocoded from their address
+
+    Args:
+        rows (list): dicts of Event column values, all with the same keys
+
+    Returns:
+        list: ids of the new events
+    """
+    if not rows:
+        return []
+    inserted = db.session.execute(insert(Event)
+        .values([fill_coordinates(row) for row in rows])
+        .returning(Event.id, Event.organisation_id)).all()
+
+    event_counts = Counter(row.organisation_id for row in inserted)
+    for change in sorted(set(event_counts.values())):
+        org_ids = sorted(org_id for org_id, c in event_counts.items() if c == change)
+        db.session.execute(update(Organisation)
+            .where(Organisation.id.in_(org_ids))
+            .values(version=Organisation.version + 1,
+                event_count=Organisation.event_count + change)
+            .execution_options(synchronize_session=False))
+    db.session.commit()
+
+    notify_written({('event', row.id) for row in inserted} |
+        {('organisation.events', org_id) for org_id in event_counts})
+    return [row.id for row in inserted]
+
+
+'''
+add_participants(pairs) / remove_participants(pairs)
+    set-based writes to event_users that never load a participant list.
+    Existing / missing rows are skipped, the counters and versions of the
+    events and organisations are bumped in the same transaction.
+'''
+def _participants_changed(changes):
+    """Apply participant_count changes and bump the versions they imply
+
+    Args:
+        changes (dict): event id -> change of participant_count
+
+    Returns:
+        set: (table, id) of the rows whose representation changed
+    """
+    written = set()
+    org_ids = set()
+    #one statement per distinct change, rows are locked in id order
+    for change in sorted(set(changes.values()) - {0}):
+        event_ids = sorted(event_id for event_id, c in changes.items() if c == change)
+        rows = db.session.execute(update(Event)
+            .where(Event.id.in_(event_ids))
+            .values(version=Event.version + 1,
+                participant_count=Event.participant_count + change)
+            .returning(Event.organisation_id)
+            .execution_options(synchronize_session=False))
+        org_ids.update(row.organisation_id for row in rows)
+        written.update(('event', event_id) for event_id in event_ids)
+    if org_ids:
+        db.session.execute(update(Organisation)
+            .where(Organisation.id.in_(sorted(org_ids)))
+            .values(version=Organisation.version + 1)
+            .execution_options(synchronize_session=False))
+    return written | {('organisation.events', org_id) for org_id in org_ids}
+
+
+def add_participants(pairs):
+    """Insert (event_id, user_id) rows into event_users in one statement,
+    pairs that are already registered are left alone
+
+    Args:
+        pairs (iterable): (event_id, user_id) to register
+
+    Returns:
+        list: (event_id, user_id) actually inserted
+    """
+    pairs = sorted(set(pairs))
+    if not pairs:
+        return []
+    added = [tuple(row) for row in db.session.execute(insert(event_users)
+        .values([{'event_id': event_id, 'user_id': user_id} for event_id, user_id in pairs])
+        .on_conflict_do_nothing()
+        .returning(event_users.c.event_id, event_users.c.user_id))]
+    written = _participants_changed(Counter(event_id for event_id, _ in added))
+    db.session.commit()
+    notify_written(written)
+    return added
+
+
+def remove_participants(pairs):
+    """Delete (event_id, user_id) rows from event_users in one statement
+
+    Args:
+        pairs (iterable): (event_id, user_id) to unregister
+
+    Returns:
+        list: (event_id, user_id) actually deleted
+    """
+    pairs = sorted(set(pairs))
+    if not pairs:
+        return []
+    removed = [tuple(row) for row in db.session.execute(delete(event_users)
+        .where(tuple_(event_users.c.event_id, event_users.c.user_id).in_(pairs))
+        .returning(event_users.c.event_id, event_users.c.user_id))]
+    written = _participants_changed({event_id: -n for event_id, n
+        in Counter(event_id for event_id, _ in removed).items()})
+    db.session.commit()
+    notify_written(written)
+    return removed
+
+
+def participant_ids(event_id):
+    """Ids of the participants of an event, read from the event_users
+    primary key index"""
+    return db.session.execute(select(event_users.c.user_id)
+        .where(event_users.c.event_id == event_id)
+        .order_by(event_users.c.user_id)).scalars().all()
+
+
+@click.command('geocode-events')
+@click.option('--batch-size', type=int, default=500, show_default=True,
+    help='Events geocoded per transaction.')
+@with_appcontext
+def geocode_events_command(batch_size):
+    """Geocode the events with an address and without coordinates, i.e.
+    after setting up GEOCODE_TABLE"""
+    last_id = 0
+    located = 0
+    while True:
+        events = Event.query.filter(Event.id > last_id, Event.latitude.is_(None),
+            Event.address.isnot(None)).order_by(Event.id).limit(batch_size).all()
+        if not events:
+            break
+        written = set()
+        for event in events:
+            coordinates = geocode(event.address)
+            if coordinates is not None:
+                event.latitude, event.longitude = coordinates
+                written |= event.touch()
+        db.session.commit()
+        notify_written(written)
+        located += sum(1 for table, _ in written if table == 'event')
+        last_id = events[-1].id
+    click.echo(f'{located} events geocoded')
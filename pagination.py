@@ -0,0 +1,222 @@
+import json
+import base64
+from datetime import datetime
+
+from flask import request, abort
+from sqlalchemy import and_, or_, tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row of a page into an opaque string
+
+    Args:
+        values (list): sort key values, datetimes are stored as iso strings
+
+    Returns:
+        string: url safe cursor
+    """
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor built by encode_cursor
+
+    Raises:
+        ValueError: cursor is malformed
+
+    Returns:
+        list: the sort key values, as stored
+    """
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('malformed cursor')
+    if not isinstance(values, list):
+        raise ValueError('malformed cursor')
+    return values
+
+
+def get_page_limit(name='limit'):
+    """Read a page size query parameter, abort with 400 if invalid"""
+    try:
+        limit = int(request.args.get(name, DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+    return limit
+
+
+def get_datetime_arg(name):
+    """Read an iso formatted datetime query parameter, abort with 400 if invalid"""
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def get_float_arg(name, minimum, maximum):
+    """Read a number query parameter between minimum and maximum, abort with
+    400 if invalid"""
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except ValueError:
+        abort(400)
+    #nan fails every comparison
+    if not minimum <= value <= maximum:
+        abort(400)
+    return value
+
+
+def get_bool_arg(name):
+    """Read a true/false query parameter, abort with 400 if invalid"""
+    value = request.args.get(name, 'false').lower()
+    if value not in ('true', 'false', '1', '0'):
+        abort(400)
+    return value in ('true', '1')
+
+
+def split_page(rows, limit, sort_key):
+    """Trim rows fetched with limit + 1 to a page
+
+    Args:
+        rows (list): rows of the page, plus one if there are more
+        limit (int): page size
+        sort_key (function): row -> sort key values stored in the cursor
+
+    Returns:
+        tuple: (rows of the page, next_cursor or None on the last page)
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(sort_key(rows[-1]))
+
+
+def split_nearest_page(rows, limit, distance):
+    """split_page for rows fetched with limit + 1 in distance order alone,
+    the order of a nearest neighbour index scan, which leaves the order of
+    rows at the same distance undefined. The page is sorted by (distance,
+    id) and ends before the distance of the first row of the next page, as
+    some of the rows at that distance may not have been fetched: a page can
+    hold less than limit rows
+
+    Args:
+        rows (list): rows of the page, plus one if there are more
+        limit (int): page size
+        distance (function): row -> distance
+
+    Returns:
+        tuple: (rows of the page, next_cursor or None on the last page), or
+            None if every row is at the same distance: the page must be
+            read in (distance, id) order
+    """
+    rows = sorted(rows, key=lambda row: (distance(row), row.id))
+    if len(rows) <= limit:
+        return rows, None
+    boundary = distance(rows[limit])
+    page = [row for row in rows[:limit] if distance(row) < boundary]
+    if not page:
+        return None
+    return page, encode_cursor([distance(page[-1]), page[-1].id])
+
+
+def _decode_keyset_cursor(cursor):
+    values = decode_cursor(cursor)
+    if len(values) != 2 or not isinstance(values[1], int):
+        raise ValueError('malformed cursor')
+    if values[0] is not None and not isinstance(values[0], str):
+        raise ValueError('malformed cursor')
+    return values
+
+
+def before_cursor(column, id_column, cursor):
+    """Build the keyset condition selecting rows after the cursor, for rows
+    ordered by (column DESC, id DESC) where column is never NULL
+
+    Raises:
+        ValueError: cursor is malformed
+
+    Returns:
+        sql condition
+    """
+    value, last_id = _decode_keyset_cursor(cursor)
+    if value is None:
+        raise ValueError('malformed cursor')
+    value = datetime.fromisoformat(value)
+    return tuple_(column, id_column) < tuple_(value, last_id)
+
+
+def after_cursor(nullable_column, id_column, cursor):
+    """Build the keyset condition selecting rows after the cursor
+
+    Rows are expected to be ordered by (nullable_column ASC NULLS LAST, id ASC)
+    which is the order of a default btree index on both columns.
+
+    Args:
+        nullable_column: first sort column, may contain NULLs
+        id_column: unique tie breaker
+        cursor (str): cursor of the last row of the previous page
+
+    Raises:
+        ValueError: cursor is malformed
+
+    Returns:
+        sql condition
+    """
+    value, last_id = _decode_keyset_cursor(cursor)
+    if value is None:
+        return and_(nullable_column.is_(None), id_column > last_id)
+    value = datetime.fromisoformat(value)
+    return or_(
+        tuple_(nullable_column, id_column) > tuple_(value, last_id),
+        nullable_column.is_(None)
+    )
+
+
+def _decode_number_cursor(cursor):
+    values = decode_cursor(cursor)
+    if len(values) != 2 or not isinstance(values[1], int) or \
+            isinstance(values[0], bool) or not isinstance(values[0], (int, float)):
+        raise ValueError('malformed cursor')
+    return values
+
+
+def ranked_after_cursor(rank, id_column, cursor):
+    """Build the keyset condition selecting rows after the cursor, for rows
+    ordered by (rank DESC, id ASC) where rank is a number never NULL
+
+    Raises:
+        ValueError: cursor is malformed
+
+    Returns:
+        sql condition
+    """
+    value, last_id = _decode_number_cursor(cursor)
+    return or_(rank < value, and_(rank == value, id_column > last_id))
+
+
+def nearest_after_cursor(distance, id_column, cursor):
+    """Build the keyset condition selecting rows after the cursor, for rows
+    ordered by (distance ASC, id ASC) where distance is a number never NULL
+
+    Raises:
+        ValueError: cursor is malformed
+
+    Returns:
+        sql condition
+    """
+    value, last_id = _decode_number_cursor(cursor)
+    return or_(distance > value, and_(distance == value, id_column > last_id))
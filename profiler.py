@@ -0,0 +1,183 @@
+"""Sampling profiler of live workers.
+
+A background thread records the stack of the profiled threads every few
+milliseconds. The samples are returned as collapsed stacks, one
+`frame;frame;frame count` line per distinct stack, the input of flamegraph
+tools (flamegraph.pl, speedscope, ...).
+
+- GET /admin/profile?seconds=N samples every thread of the worker that
+  answers for N seconds. The worker needs other threads serving traffic
+  meanwhile (i.e. gunicorn --threads, or the ASGI mode)
+- a request with an `X-Profile` header is profiled on its own, its response
+  is replaced by the stacks sampled while it ran (the status it had is in
+  `X-Profiled-Status`). Streamed bodies aren't sampled
+
+Both need the PROFILE_PERMISSION permission, without it the header is
+ignored. In the ASGI mode requests share
+the event loop thread, so the samples of a request include the others.
+"""
+import os
+import sys
+import time
+import threading
+from functools import lru_cache
+from collections import Counter
+
+from flask import g, request, current_app
+
+import auth
+
+PROFILE_PERMISSION = 'read:profile'
+PROFILE_HEADER = 'X-Profile'
+#seconds between two samples, of a worker and of a single request
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL_MS', 5)) / 1000
+PROFILER_REQUEST_INTERVAL = float(os.getenv('PROFILER_REQUEST_INTERVAL_MS', 1)) / 1000
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', 60))
+
+'''
+sleep
+    waits while a worker is profiled, replaced in the ASGI mode to let the
+    event loop run meanwhile, see asgi.py
+'''
+sleep = time.sleep
+
+
+class ProfilerBusy(Exception):
+    """A profile of the worker is already running"""
+
+
+@lru_cache(maxsize=4096)
+def short_filename(filename):
+    """filename relative to the longest sys.path entry containing it"""
+    prefixes = [path for path in sys.path if path and filename.startswith(path + os.sep)]
+    if not prefixes:
+        return filename
+    return filename[len(max(prefixes, key=len)) + 1:]
+
+
+def frame_label(code):
+    label = f'{code.co_name} ({short_filename(code.co_filename)}:{code.co_firstlineno})'
+    #';' separates the frames of a collapsed stack
+    return label.replace(';', ':')
+
+
+def collapse(frame):
+    """'outermost;...;innermost' labels of the frames of a stack"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler(object):
+    """Counts the stacks of threads, sampled from a background thread
+
+    Args:
+        interval (float): seconds between two samples
+        thread_ids (set): idents of the sampled threads, None for all
+        exclude (set): idents of threads never sampled
+    """
+    def __init__(self, interval=PROFILER_INTERVAL, thread_ids=None, exclude=()):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.exclude = set(exclude)
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        self.exclude.add(threading.get_ident())
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for ident, frame in sys._current_frames().items():
+            if ident in self.exclude or \
+                    (self.thread_ids is not None and ident not in self.thread_ids):
+                continue
+            self.stacks[collapse(frame)] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+
+_worker_profile = threading.Lock()
+
+
+def profile_worker(seconds, interval=PROFILER_INTERVAL):
+    """Sample every other thread of this worker for seconds
+
+    Raises:
+        ProfilerBusy: another profile of the worker is running
+
+    Returns:
+        str: collapsed stacks
+    """
+    if not _worker_profile.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        sampler = Sampler(interval, exclude={threading.get_ident()}).start()
+        try:
+            sleep(seconds)
+        finally:
+            sampler.stop()
+        return sampler.collapsed()
+    finally:
+        _worker_profile.release()
+
+
+#----------------------------------------------------------------------------#
+# Per request profiles
+#----------------------------------------------------------------------------#
+def start_request_profile():
+    """before_request hook profiling requests with the X-Profile header,
+    checked like requires_auth(PROFILE_PERMISSION). Without the permission
+    the header is ignored and the request served as usual"""
+    if PROFILE_HEADER not in request.headers:
+        return
+    try:
+        payload = auth.verify_decode_jwt(auth.get_token_auth_header())
+        auth.check_permissions(PROFILE_PERMISSION, payload)
+    except auth.AuthError:
+        return
+    g.profile_sampler = Sampler(PROFILER_REQUEST_INTERVAL,
+        thread_ids={threading.get_ident()}).start()
+
+
+def finish_request_profile(response):
+    sampler = g.pop('profile_sampler', None)
+    if sampler is None:
+        return response
+    stacks = sampler.stop().collapsed()
+    response.close()
+    profiled = current_app.response_class(stacks, mimetype='text/plain')
+    profiled.headers['X-Profiled-Status'] = str(response.status_code)
+    profiled.headers['X-Profile-Samples'] = str(sampler.samples)
+    return profiled
+
+
+def stop_request_profile(exception):
+    """teardown hook, stops the sampler of a request that failed before its
+    response was made"""
+    sampler = g.pop('profile_sampler', None)
+    if sampler is not None:
+        sampler.stop()
+
+
+def init_app(app):
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    app.teardown_request(stop_request_profile)
@@ -0,0 +1,182 @@
+"""Read-only query layer for the public GET endpoints.
+
+Selects only the columns that Event.format() / Organisation.format() emit
+and builds the response dicts straight from the result rows, skipping ORM
+object hydration. Participants are aggregated in SQL with json_agg, so an
+event listing is a single SELECT. The dicts are identical to the ones
+format() returns.
+"""
+import math
+from functools import reduce
+
+from sqlalchemy import func, select, literal_column, cast, Float, Integer
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from models import db, event_users, User, Organisation, Event, SEARCH_CONFIG
+
+
+def participants_column():
+    """Correlated subquery aggregating an event's participants into a json
+    list of {id, name}, ordered like Event.participants"""
+    participant = func.json_build_object('id', User.id, 'name', User.name)
+    return select(
+        func.coalesce(
+            func.json_agg(aggregate_order_by(participant, User.id)),
+            literal_column("'[]'::json")
+        )
+    ).select_from(
+        event_users.join(User, User.id == event_users.c.user_id)
+    ).where(
+        event_users.c.event_id == Event.id
+    ).correlate(Event).scalar_subquery()
+
+
+def query_events(include_org=True, include_participants=True):
+    """Query of event rows carrying exactly the fields of Event.format().
+    Filters and ordering on Event columns can be chained as usual.
+    """
+    columns = [
+        Event.id,
+        Event.name,
+        Event.description,
+        Event.start_datetime,
+        Event.end_datetime,
+        Event.address,
+        Event.latitude,
+        Event.longitude,
+        #not part of format(), used for the ETag
+        Event.version,
+    ]
+    if include_org:
+        columns += [
+            Event.organisation_id,
+            Organisation.name.label('organisation_name'),
+        ]
+    if include_participants:
+        columns.append(participants_column().label('participants'))
+
+    query = db.session.query(*columns)
+    if include_org:
+        query = query.join(Organisation, Organisation.id == Event.organisation_id)
+    return query
+
+
+def format_event_row(row, include_org=True, include_participants=True):
+    """Build the Event.format() dict from a query_events() row"""
+    formatted = {
+        'id': row.id,
+        'name': row.name,
+        'description': row.description,
+        'start_datetime': row.start_datetime,
+        'end_datetime': row.end_datetime,
+        'address': row.address,
+        'latitude': row.latitude,
+        'longitude': row.longitude,
+    }
+    if include_org:
+        formatted.update({
+            'organisation': {
+                'id': row.organisation_id,
+                'name': row.organisation_name,
+            }
+        })
+    if include_participants:
+        formatted.update({
+            'participants': row.participants
+        })
+    return formatted
+
+
+def query_organisations():
+    """Query of organisation rows carrying exactly the fields of
+    Organisation.format()"""
+    return db.session.query(
+        Organisation.id,
+        Organisation.name,
+        Organisation.description,
+        Organisation.website,
+        Organisation.phone_contact,
+        Organisation.email_contact,
+    )
+
+
+def format_organisation_row(row):
+    """Build the Organisation.format() dict from a query_organisations() row"""
+    return {
+        'id': row.id,
+        'name': row.name,
+        'description': row.description,
+        'website': row.website,
+        'phone_contact': row.phone_contact,
+        'email_contact': row.email_contact,
+    }
+
+
+def event_search_query(text):
+    """tsquery of a search box input, parsed like a web search engine does:
+    words, "quoted phrases", `or` and -excluded words. Never raises on
+    malformed input"""
+    return func.websearch_to_tsquery(
+        literal_column(f"'{SEARCH_CONFIG}'::regconfig"), text)
+
+
+def event_search_rank(tsquery):
+    """Relevance of an event to tsquery, name matches weigh more than the
+    description's and those more than the address'. Cast to double precision
+    so a rank stored in a cursor compares equal to the row it came from"""
+    return cast(func.ts_rank(Event.search_vector, tsquery), Float)
+
+
+def skills_match_count(skills):
+    """Number of the given skills a user has, to rank users found by a
+    containment or overlap filter"""
+    return reduce(lambda a, b: a + b,
+        [cast(User.skills.contains([skill]), Integer) for skill in skills])
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def event_location():
+    """(longitude, latitude) point of an event, the expression of the GiST
+    index ix_event_location: queries must use it as is to be served by it"""
+    return func.point(Event.longitude, Event.latitude)
+
+
+def within_box(min_lng, min_lat, max_lng, max_lat):
+    """Events located in a box, an index scan of ix_event_location"""
+    return event_location().op('<@', is_comparison=True)(
+        func.box(func.point(min_lng, min_lat), func.point(max_lng, max_lat)))
+
+
+def location_order(lng, lat):
+    """Distance in degrees of (longitude, latitude) planes from an event
+    to a point. Ordering by it is a nearest neighbour scan of
+    ix_event_location"""
+    return event_location().op('<->', return_type=Float)(func.point(lng, lat))
+
+
+def distance_km(lat, lng):
+    """Great circle (haversine) distance from an event to a point, km"""
+    half_dlat = func.radians(Event.latitude - lat) / 2
+    half_dlng = func.radians(Event.longitude - lng) / 2
+    a = func.power(func.sin(half_dlat), 2) + \
+        func.cos(func.radians(Event.latitude)) * math.cos(math.radians(lat)) * \
+        func.power(func.sin(half_dlng), 2)
+    return 2 * EARTH_RADIUS_KM * func.asin(func.least(1.0, func.sqrt(a)))
+
+
+def radius_box(lat, lng, radius_km):
+    """(min_lng, min_lat, max_lng, max_lat) of a box containing every point
+    within radius_km of (lat, lng). Boxes reaching a pole or the 180th
+    meridian span every longitude"""
+    dlat = radius_km / KM_PER_DEGREE
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        return -180.0, max(min_lat, -90.0), 180.0, min(max_lat, 90.0)
+    #widest at the latitude of the box closest to a pole
+    dlng = dlat / math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if lng - dlng < -180 or lng + dlng > 180:
+        return -180.0, min_lat, 180.0, max_lat
+    return lng - dlng, min_lat, lng + dlng, max_lat
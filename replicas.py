@@ -0,0 +1,260 @@
+"""Routing of read-only requests to read replicas.
+
+GET handlers decorated with replica_reads run their queries on one of the
+replicas configured with DATABASE_REPLICA_URLS (comma separated), picked
+round robin, everything else runs on the primary. See models.RoutingSession.
+
+Read-your-writes: after a successful write, requests carrying a token of the
+same subject read from the primary for REPLICA_STICKY_SECONDS. Subjects are
+tracked per worker process.
+
+A request reads a single replica, picked on its first query. Replicas are
+checked every REPLICA_CHECK_INTERVAL seconds in the background of each
+worker. Replicas losing their connection, failing a health check or lagging
+more than REPLICA_MAX_LAG seconds behind the primary are ejected for
+REPLICA_EJECT_SECONDS, then checked again before their next use. Until their
+first check passes, or with every replica ejected, reads go to the primary.
+"""
+import os
+import time
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+from flask import request, g, has_request_context
+from jose import jwt
+from sqlalchemy import event as sa_event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from db_pool import engine_options, configure_engine, create_engine
+
+REPLICA_URLS = [url.strip().replace('postgres://', 'postgresql://', 1)
+    for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+REPLICA_EJECT_SECONDS = float(os.getenv('REPLICA_EJECT_SECONDS', 30))
+#seconds between two health checks of a replica
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', 10))
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 10))
+
+#seconds the replica is behind, 0 when it has replayed everything it received
+#or isn't replicating at all
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+'''
+spawn
+    runs the health checks of the replicas in the background of a worker,
+    replaced in the ASGI mode by a task of the event loop, see asgi.py
+'''
+def spawn(target):
+    threading.Thread(target=target, name='replica-checks', daemon=True).start()
+
+'''
+sleep
+    waits between two rounds of health checks, replaced in the ASGI mode
+'''
+sleep = time.sleep
+
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.ejected_until = 0
+        self.checked_at = None
+        #set by the health checks, replicas are used once one passed
+        self.healthy = False
+
+
+class ReplicaSet(object):
+    """Healthy replicas, handed out round robin. Health checks run in the
+    background, never on the request path"""
+    def __init__(self, eject_seconds=REPLICA_EJECT_SECONDS,
+            check_interval=REPLICA_CHECK_INTERVAL, max_lag=REPLICA_MAX_LAG,
+            clock=time.monotonic):
+        self.eject_seconds = eject_seconds
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.clock = clock
+
+        self.replicas = []
+        self.ejections = 0
+        self._next = 0
+        self._lock = threading.Lock()
+        self._checks_pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    def configure(self, urls):
+        """Replace the replicas with engines connected to urls"""
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = [self.add_engine(configure_engine(
+            create_engine(url, **engine_options()))) for url in urls]
+
+    def add_engine(self, engine):
+        replica = Replica(engine)
+        #connection errors eject the replica straight away
+        sa_event.listen(engine, 'handle_error',
+            lambda context: self.eject(replica) if context.is_disconnect else None)
+        return replica
+
+    def eject(self, replica):
+        with self._lock:
+            replica.ejected_until = self.clock() + self.eject_seconds
+            replica.healthy = False
+            self.ejections += 1
+
+    def check(self, replica):
+        """Run a health check, ejecting the replica if it fails or lags
+
+        Returns:
+            bool: replica is healthy
+        """
+        replica.checked_at = self.clock()
+        try:
+            with replica.engine.connect() as conn:
+                lag = conn.execute(LAG_QUERY).scalar()
+        except SQLAlchemyError as e:
+            print(e)
+            lag = None
+        if lag is None or lag > self.max_lag:
+            self.eject(replica)
+            return False
+        replica.healthy = True
+        return True
+
+    def check_all(self):
+        """Check every replica that isn't ejected"""
+        for replica in list(self.replicas):
+            if self.clock() >= replica.ejected_until:
+                self.check(replica)
+
+    def run_checks(self):
+        while True:
+            self.check_all()
+            sleep(self.check_interval)
+
+    def start_checks(self):
+        """Start the background health checks, once per worker process"""
+        with self._lock:
+            if self._checks_pid == os.getpid():
+                return
+            self._checks_pid = os.getpid()
+        spawn(self.run_checks)
+
+    def is_healthy(self, replica):
+        return replica.healthy and self.clock() >= replica.ejected_until
+
+    def choose(self):
+        """Engine of the next healthy replica, None if none is"""
+        self.start_checks()
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+            if self.is_healthy(replica):
+                return replica.engine
+        return None
+
+    def stats(self):
+        return {
+            'replicas': len(self.replicas),
+            'healthy': sum(1 for r in self.replicas if self.is_healthy(r)),
+            'ejections': self.ejections,
+        }
+
+
+class StickySubjects(object):
+    """Subjects that wrote recently, at most maxsize of them"""
+    def __init__(self, window=REPLICA_STICKY_SECONDS, maxsize=10000, clock=time.monotonic):
+        self.window = window
+        self.maxsize = maxsize
+        self.clock = clock
+        self._until = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mark(self, subject):
+        with self._lock:
+            self._until[subject] = self.clock() + self.window
+            self._until.move_to_end(subject)
+            while len(self._until) > self.maxsize:
+                self._until.popitem(last=False)
+
+    def is_sticky(self, subject):
+        until = self._until.get(subject, None)
+        return until is not None and self.clock() < until
+
+    def clear(self):
+        with self._lock:
+            self._until.clear()
+
+
+replica_set = ReplicaSet()
+sticky_subjects = StickySubjects()
+
+
+def request_subject():
+    """Subject of the bearer token of the request, if any. The token isn't
+    verified, the subject is only used to pick a database"""
+    parts = request.headers.get('Authorization', '').split()
+    if len(parts) != 2 or parts[0].lower() != 'bearer':
+        return None
+    try:
+        return jwt.get_unverified_claims(parts[1]).get('sub', None)
+    except Exception:
+        return None
+
+
+def use_replica():
+    """Whether queries of the current request may run on a replica"""
+    return has_request_context() and g.get('read_replica', False)
+
+
+def is_sticky_request():
+    """Whether the current request reads from the primary because its
+    subject wrote within REPLICA_STICKY_SECONDS"""
+    return has_request_context() and g.get('sticky_read', False)
+
+
+def request_replica():
+    """Engine of the replica serving the current request, chosen on its first
+    query so every query of the request reads the same replica. None when no
+    replica is healthy"""
+    if 'replica_engine' not in g:
+        g.replica_engine = replica_set.choose()
+    return g.replica_engine
+
+
+def replica_reads(f):
+    """Run the queries of the decorated GET handler on a replica, unless the
+    requesting subject wrote within REPLICA_STICKY_SECONDS. Goes above
+    cached_response, which looks at the routing to decide what it serves
+    and stores"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if replica_set.enabled and request.method == 'GET':
+            subject = request_subject()
+            g.sticky_read = subject is not None and sticky_subjects.is_sticky(subject)
+            g.read_replica = not g.sticky_read
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def stick_after_writes(response):
+    """after_request hook sending the subject of a successful write to the
+    primary for the next REPLICA_STICKY_SECONDS"""
+    if replica_set.enabled and request.method not in ('GET', 'HEAD', 'OPTIONS') \
+            and response.status_code < 400:
+        subject = request_subject()
+        if subject is not None:
+            sticky_subjects.mark(subject)
+    return response
+
+
+def init_app(app):
+    app.after_request(stick_after_writes)
@@ -0,0 +1,280 @@
+"""Read-through cache of the public GET responses.
+
+Responses are stored with a TTL in a pluggable backend: a size-bounded LRU
+in process memory by default, or a shared store with a redis-like client
+(get / set(ex=) / delete / incr) so invalidations reach every worker.
+
+Writes through ModelMixin are reported to invalidate_rows() after commit,
+which bumps the generation of the written rows and of the listings. The
+generation is part of every key and is read before the response is built,
+so a read that started before a write stores its body under a key that is
+never looked up again.
+
+Responses read from a replica are stored for at most REPLICA_MAX_LAG
+seconds: a replica lagging behind a write may put the old rows back in the
+cache, for no longer than it could serve them itself. Subjects that wrote
+recently skip the lookup and read the primary, see replicas.replica_reads.
+"""
+import os
+import math
+import time
+import pickle
+import threading
+from functools import wraps
+from datetime import datetime
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from flask import request, current_app, g
+
+import models
+from etags import is_not_modified, not_modified
+from replicas import REPLICA_MAX_LAG, is_sticky_request, use_replica
+
+#'memory', 'redis' (needs REDIS_URL and the redis package) or 'none'
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 30))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+REDIS_URL = os.getenv('REDIS_URL', None)
+
+#seconds a response read from a replica is stored, no longer than a replica may lag
+REPLICA_RESPONSE_TTL = max(1, int(min(RESPONSE_CACHE_TTL, REPLICA_MAX_LAG)))
+
+#response headers kept with the cached body
+CACHED_HEADERS = ('Content-Type', 'ETag')
+
+
+class MemoryBackend(object):
+    """LRU of at most maxsize entries, each expiring ttl seconds after set.
+    Generations are kept apart so they are never evicted."""
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+            clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.clock() >= entry[0]:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (self.clock() + (ttl or self.ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def generation(self, name):
+        return self._generations.get(name, 0)
+
+    def incr(self, name):
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedBackend(object):
+    """Backend storing entries in a shared store through a redis-like client.
+    Size bounds and eviction are left to the store (i.e. redis maxmemory)."""
+    def __init__(self, client, ttl=RESPONSE_CACHE_TTL, prefix='response-cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        #evictions happen inside the store and aren't observable from here
+        self.evictions = None
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def generation(self, name):
+        value = self.client.get(self.prefix + 'generation:' + name)
+        return int(value) if value is not None else 0
+
+    def incr(self, name):
+        self.client.incr(self.prefix + 'generation:' + name)
+
+    def clear(self):
+        #entries expire on their own, moving every generation orphans listings
+        for name in ('events', 'organisations'):
+            self.incr(name)
+
+    def __len__(self):
+        return 0
+
+
+class ResponseCache(object):
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store value for ttl seconds, or the TTL of the backend"""
+        self.backend.set(key, value, ttl)
+
+    def row_key(self, table, row_id):
+        """Key of the response of a single row, invalidated by bumping the
+        generation of the row"""
+        name = f'{table}:{row_id}'
+        return f'{name}:g{self.backend.generation(name)}'
+
+    def listing_key(self, name):
+        """Key of a listing request, unique per query string and invalidated
+        as a whole by bumping the listing generation"""
+        args = urlencode(sorted(request.args.items(multi=True)))
+        return f'{name}:g{self.backend.generation(name)}:{args}'
+
+    def invalidate_rows(self, written):
+        """Invalidate the responses embedding the written rows
+
+        Args:
+            written (set): (table, id) reported by ModelMixin writes
+        """
+        if not self.enabled:
+            return
+        rows = set()
+        listings = set()
+        for table, row_id in written:
+            if table == 'event':
+                rows.add(('event', row_id))
+                listings.add('events')
+            elif table == 'organisation':
+                rows.add(('organisation', row_id))
+                listings.add('organisations')
+            elif table == 'organisation.events':
+                rows.add(('organisation', row_id))
+        #the current entries are dropped, later ones get the next generation
+        self.backend.delete(*sorted(self.row_key(*row) for row in rows))
+        for table, row_id in sorted(rows):
+            self.backend.incr(f'{table}:{row_id}')
+        for name in sorted(listings):
+            self.backend.incr(name)
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__ if self.enabled else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': getattr(self.backend, 'evictions', None),
+            'size': len(self.backend) if self.enabled else 0,
+        }
+
+
+def make_backend(name=RESPONSE_CACHE_BACKEND):
+    if name == 'none':
+        return None
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'redis':
+        import redis
+        return SharedBackend(redis.Redis.from_url(REDIS_URL))
+    raise ValueError(f'unknown response cache backend: {name}')
+
+
+response_cache = ResponseCache(make_backend())
+models.write_listeners.append(response_cache.invalidate_rows)
+
+
+def expire_cached_response_at(when):
+    """Keep the response being built in the cache until when at the latest,
+    for responses depending on the current time
+
+    Args:
+        when (datetime): local time the response gets out of date
+    """
+    g.cache_expires_in = (when - datetime.now()).total_seconds()
+
+
+def cached_response(key_func):
+    """Serve the decorated GET route from response_cache. Goes below
+    replica_reads.
+
+    Args:
+        key_func (function): called with the route arguments, returns the
+            cache key or None to bypass the cache for this request
+    """
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = key_func(*args, **kwargs) if response_cache.enabled else None
+            if key is None:
+                return f(*args, **kwargs)
+
+            #read-your-writes: an entry stored before the write committed may be stale
+            cached = None if is_sticky_request() else response_cache.get(key)
+            if cached is not None:
+                body, headers = cached
+                etag = headers.get('ETag', '').strip('"') or None
+                if is_not_modified(etag):
+                    return not_modified(etag)
+                response = current_app.response_class(body, headers=headers)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = current_app.make_response(f(*args, **kwargs))
+            ttl = REPLICA_RESPONSE_TTL if use_replica() else None
+            if 'cache_expires_in' in g:
+                ttl = min(ttl or RESPONSE_CACHE_TTL, math.floor(g.cache_expires_in))
+            if response.status_code == 200 and not response.is_streamed \
+                    and (ttl is None or ttl > 0):
+                response_cache.set(key, (response.get_data(), {
+                    name: response.headers[name]
+                    for name in CACHED_HEADERS if name in response.headers
+                }), ttl)
+                response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return cached_response_decorator
@@ -0,0 +1,258 @@
+"""Log of the SQL statements slower than SLOW_QUERY_MS.
+
+Each slow statement is logged as one json object per line, to SLOW_QUERY_LOG
+or stderr, with its duration, bind parameters, fingerprint and the route of
+the request that ran it. A SLOW_QUERY_EXPLAIN_SAMPLE fraction of the slow
+SELECTs is run again under EXPLAIN (ANALYZE, BUFFERS), in a savepoint, and
+the plan added to the entry. The plan costs another run of the query, keep
+the fraction low in production. Plans that can't be captured (asyncpg can't
+always type the parameters of an EXPLAIN) are logged as an error instead.
+
+Statements differing only by their values share a fingerprint, so the lazy
+loads of a relationship (i.e. the participants of many events) are grouped.
+`flask slow-queries` summarises a log by fingerprint.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+from datetime import datetime, date
+from collections import defaultdict
+
+import click
+from flask import request, has_request_context
+from sqlalchemy import event as sa_event
+from sqlalchemy.engine import Engine
+
+#milliseconds, 0 disables the log
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 0))
+#file the entries are appended to, stderr if unset
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', None)
+#fraction of the slow SELECTs logged with their plan
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv('SLOW_QUERY_EXPLAIN_SAMPLE', 0))
+
+#bind parameters logged per statement, and characters per value
+MAX_LOGGED_PARAMS = 50
+MAX_PARAM_LENGTH = 200
+
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\$\d+|\?")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize(statement):
+    """Statement with values, bind parameters and lists of them replaced by
+    placeholders: '?' for a value, '(...)' for a list of values"""
+    statement = _STRING.sub('?', statement)
+    statement = _PLACEHOLDER.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _LIST.sub('(...)', statement)
+    #multi-row VALUES
+    statement = _ROWS.sub('(...)', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+def fingerprint(statement):
+    return hashlib.sha1(normalize(statement).encode('utf-8')).hexdigest()[:16]
+
+
+def format_param(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list, tuple)):
+        return format_params(value)
+    if value is not None and not isinstance(value, (str, int, float, bool)):
+        value = str(value)
+    if isinstance(value, str) and len(value) > MAX_PARAM_LENGTH:
+        return value[:MAX_PARAM_LENGTH] + '...'
+    return value
+
+
+def format_params(parameters):
+    """json-ready bind parameters, at most MAX_LOGGED_PARAMS of them"""
+    if isinstance(parameters, dict):
+        return {name: format_param(value)
+            for name, value in list(parameters.items())[:MAX_LOGGED_PARAMS]}
+    return [format_param(value) for value in list(parameters)[:MAX_LOGGED_PARAMS]]
+
+
+def request_info():
+    if not has_request_context():
+        return {'route': None}
+    rule = request.url_rule
+    return {
+        'method': request.method,
+        'route': rule.rule if rule is not None else None,
+        'path': request.path,
+    }
+
+
+def make_logger(path):
+    logger = logging.getLogger('slow_queries')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+
+class SlowQueryLog(object):
+    """Engine listeners logging the statements slower than threshold_ms"""
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, explain_sample=SLOW_QUERY_EXPLAIN_SAMPLE,
+            logger=None, clock=time.perf_counter, rng=random.random):
+        self.threshold_ms = threshold_ms
+        self.explain_sample = explain_sample
+        self.logger = logger
+        self.clock = clock
+        self.rng = rng
+        self.attached = False
+
+    def attach(self):
+        if self.attached:
+            return
+        if self.logger is None:
+            self.logger = make_logger(SLOW_QUERY_LOG)
+        sa_event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        sa_event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        self.attached = True
+
+    def detach(self):
+        if not self.attached:
+            return
+        sa_event.remove(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        sa_event.remove(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        self.attached = False
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['slow_query_started_at'] = self.clock()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info.pop('slow_query_started_at', None)
+        if started_at is None:
+            return
+        duration_ms = (self.clock() - started_at) * 1000
+        if duration_ms < self.threshold_ms:
+            return
+
+        entry = {
+            'time': datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+            'duration_ms': round(duration_ms, 3),
+            'fingerprint': fingerprint(statement),
+            'statement': statement,
+            'params': format_params(parameters) if parameters else None,
+            'executemany': executemany,
+        }
+        entry.update(request_info())
+        if not executemany and self.explain_sample > 0 and self.rng() < self.explain_sample \
+                and statement.lstrip()[:6].upper() == 'SELECT':
+            entry['plan'] = self.explain(conn, statement, parameters)
+        self.logger.info(json.dumps(entry, default=str))
+
+    def explain(self, conn, statement, parameters):
+        """EXPLAIN (ANALYZE, BUFFERS) plan of the statement, run on the
+        DBAPI connection so it isn't logged itself. A savepoint keeps a
+        failing EXPLAIN from aborting the transaction of the request
+
+        Returns:
+            the json plan, or {'error': message}
+        """
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement,
+                    parameters)
+                plan = cursor.fetchone()[0]
+                return json.loads(plan) if isinstance(plan, str) else plan
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                return {'error': str(e).strip()}
+            finally:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        except Exception as e:
+            #i.e. outside of a transaction, where savepoints don't exist
+            print(e)
+            return {'error': str(e).strip()}
+        finally:
+            cursor.close()
+
+
+slow_query_log = SlowQueryLog()
+
+
+#----------------------------------------------------------------------------#
+# Summary
+#----------------------------------------------------------------------------#
+def read_log(lines):
+    """Entries of a slow query log, lines that aren't json are skipped"""
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(entry, dict) and 'fingerprint' in entry:
+            yield entry
+
+
+def summarise(entries):
+    """Slow queries grouped by fingerprint, slowest total first
+
+    Returns:
+        list: dicts of fingerprint, count, total/mean/max duration_ms, the
+            routes that ran it, a normalized statement and whether a plan
+            was captured
+    """
+    groups = defaultdict(list)
+    for entry in entries:
+        groups[entry['fingerprint']].append(entry)
+
+    summary = []
+    for key, group in groups.items():
+        durations = [entry['duration_ms'] for entry in group]
+        summary.append({
+            'fingerprint': key,
+            'count': len(group),
+            'total_ms': round(sum(durations), 3),
+            'mean_ms': round(sum(durations) / len(durations), 3),
+            'max_ms': max(durations),
+            'routes': sorted({f"{entry.get('method')} {entry['route']}"
+                for entry in group if entry.get('route')}),
+            'statement': normalize(group[0]['statement']),
+            'plans': sum(1 for entry in group if 'plan' in entry and 'error' not in entry['plan']),
+        })
+    return sorted(summary, key=lambda row: (-row['total_ms'], row['fingerprint']))
+
+
+@click.command('slow-queries')
+@click.argument('log', type=click.File('r', encoding='utf-8'),
+    default=SLOW_QUERY_LOG or '-')
+@click.option('--top', type=int, default=20, help='Fingerprints shown, slowest total first.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the summary as json.')
+def slow_queries_command(log, top, as_json):
+    """Summarise a slow query log (SLOW_QUERY_LOG by default, '-' for stdin)
+    by query fingerprint"""
+    summary = summarise(read_log(log))[:top]
+    if as_json:
+        click.echo(json.dumps(summary, indent=2))
+        return
+    for row in summary:
+        click.echo(f"{row['fingerprint']}  {row['count']:>6} x  total {row['total_ms']:.1f} ms  "
+            f"mean {row['mean_ms']:.1f} ms  max {row['max_ms']:.1f} ms  plans {row['plans']}")
+        if row['routes']:
+            click.echo(f"    routes: {', '.join(row['routes'])}")
+        click.echo(f"    {row['statement']}")
+
+
+def init_app(app, threshold_ms=SLOW_QUERY_MS):
+    if threshold_ms > 0:
+        slow_query_log.attach()
+    app.cli.add_command(slow_queries_command)
@@ -0,0 +1,90 @@
+"""Streaming JSON responses for large collections.
+
+The response envelope is encoded key by key and the collection item by
+item, so the full list and the full encoded string never have to be held in
+memory. The output is byte-identical to jsonify() of the same envelope with
+the collection materialised, including the pretty printed debug format.
+"""
+from flask import current_app, stream_with_context
+
+import json_backend
+
+#rows fetched per round trip of the server-side cursor
+STREAM_BATCH_SIZE = 500
+#approximate bytes buffered before a chunk is sent to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def generate_json(envelope, stream_key='data'):
+    """Generate the json encoding of envelope in chunks
+
+    Args:
+        envelope (dict): response body, envelope[stream_key] may be any
+            iterable of json serialisable items
+        stream_key (str): key of the collection to stream
+
+    Yields:
+        bytes: chunks of the encoded envelope
+    """
+    config = current_app.config
+    backend = json_backend.backend
+    pretty = config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+    sort_keys = config['JSON_SORT_KEYS']
+
+    if pretty:
+        item, key = backend.pretty_separators
+        open_obj, close_obj, field_sep = b'{\n  ', b'\n}\n', f'{item}\n  '.encode()
+        open_list, close_list, item_sep = b'[\n    ', b'\n  ]', f'{item}\n    '.encode()
+        key_sep = key.encode()
+    else:
+        open_obj, close_obj, field_sep = b'{', b'}\n', b','
+        open_list, close_list, item_sep = b'[', b']', b','
+        key_sep = b':'
+
+    def dumps(value, prefix):
+        encoded = backend.dumps(value, pretty=pretty, sort_keys=sort_keys,
+            ensure_ascii=config['JSON_AS_ASCII'])
+        #nested lines are indented relative to their position in the envelope
+        return encoded.replace(b'\n', b'\n' + prefix) if pretty else encoded
+
+    keys = list(envelope)
+    if sort_keys:
+        keys.sort()
+
+    buffer = [open_obj]
+    size = 0
+    for i, key in enumerate(keys):
+        if i:
+            buffer.append(field_sep)
+        buffer.append(dumps(key, b'') + key_sep)
+        if key != stream_key:
+            buffer.append(dumps(envelope[key], b'  '))
+            continue
+
+        empty = True
+        for item in envelope[key]:
+            encoded = dumps(item, b'    ')
+            buffer.append(open_list if empty else item_sep)
+            buffer.append(encoded)
+            empty = False
+            size += len(encoded)
+            if size >= STREAM_CHUNK_SIZE:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        buffer.append(b'[]' if empty else close_list)
+    buffer.append(close_obj)
+    yield b''.join(buffer)
+
+
+def stream_json_response(envelope, stream_key='data'):
+    """Build a streamed response for envelope, see generate_json.
+
+    The request context (and with it the database session) is kept alive
+    until the last chunk is sent, so stream_key can be backed by a
+    server-side cursor i.e. query.yield_per().
+    """
+    return current_app.response_class(
+        stream_with_context(generate_json(envelope, stream_key)),
+        mimetype=current_app.config['JSONIFY_MIMETYPE']
+    )
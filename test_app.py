@@ -1,16 +1,42 @@
 
 import os
 import json
+import asyncio
+import tempfile
+import threading
 import unittest
+from datetime import datetime, timedelta
 from unittest.mock import patch
 
 
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
+from sqlalchemy import event as sa_event, create_engine, inspect, text
+from sqlalchemy.engine import Engine, make_url
+from flask_migrate import Migrate
+from werkzeug.http import HTTP_STATUS_CODES
+from werkzeug.test import Client
+
+#APP_MODE=asgi runs the suite against the asynchronous serving mode
+APP_MODE = os.getenv('APP_MODE', 'wsgi')
+if APP_MODE == 'asgi':
+    #the tests also query the database outside of requests
+    os.environ['DB_ASYNC_FALLBACK'] = 'true'
+    import asgi
 
 from app import app
-from models import setup_db, User, Organisation, Event
+from models import setup_db, init_db_command, geocode_events_command, add_events, \
+    User, Organisation, Event
 from fixtures import reset_db_with_fixtures
+import json_backend
+from json_backend import jsonify
+from response_cache import response_cache, MemoryBackend, SharedBackend
+from bulk_events import import_events_command, export_events_command
+from queries import format_event_row
+import auth
+import metrics
+import profiler
+import geocoding
 
 DB_HOST = os.environ['DB_HOST']
 DB_USER = os.environ['DB_USER']
@@ -19,18 +45,140 @@ DB_NAME = os.environ['DB_NAME']
 DB_PATH = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
 
 db = setup_db(app,  database_path=DB_PATH)
-client = app.test_client
+
+
+class ASGITestApp(object):
+    """WSGI callable running an ASGI application to completion on the event
+    loop, so the werkzeug test client can drive the asynchronous mode"""
+    def __init__(self, application, chunk_size=64 * 1024):
+        self.application = application
+        self.chunk_size = chunk_size
+        self.loop = asyncio.new_event_loop()
+        #shared with the queries run outside of requests
+        asyncio.set_event_loop(self.loop)
+
+    def __call__(self, environ, start_response):
+        headers = [(name[5:].replace('_', '-').lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in environ.items() if name.startswith('HTTP_')]
+        for name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if environ.get(name):
+                headers.append((name.replace('_', '-').lower().encode('latin-1'),
+                    environ[name].encode('latin-1')))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': environ['REQUEST_METHOD'],
+            'scheme': environ['wsgi.url_scheme'],
+            'path': environ['PATH_INFO'].encode('latin-1').decode('utf-8'),
+            'query_string': environ.get('QUERY_STRING', '').encode('latin-1'),
+            'root_path': '',
+            'headers': headers,
+            'server': (environ['SERVER_NAME'], int(environ['SERVER_PORT'])),
+            'client': ('127.0.0.1', 0),
+        }
+        body = environ['wsgi.input'].read()
+        #the body is received in several messages, like from a real server
+        received = [{'type': 'http.request', 'body': body[i:i + self.chunk_size],
+            'more_body': i + self.chunk_size < len(body)}
+            for i in range(0, max(len(body), 1), self.chunk_size)]
+        sent = []
+
+        async def receive():
+            return received.pop(0) if received else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.application(scope, receive, send))
+        status = sent[0]['status']
+        start_response(f'{status} {HTTP_STATUS_CODES.get(status, "")}',
+            [(name.decode('latin-1'), value.decode('latin-1')) for name, value in sent[0]['headers']])
+        return (message['body'] for message in sent[1:] if message.get('body'))
+
+
+if APP_MODE == 'asgi':
+    asgi_test_app = ASGITestApp(asgi.application)
+    client = lambda: Client(asgi_test_app, app.response_class)
+else:
+    client = app.test_client
+
+
+class FakeRedis(object):
+    """Local stand-in for the redis client used by SharedBackend"""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+
+
+class QueryCounter(object):
+    """Count the SQL statements sent to the database while active"""
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        sa_event.listen(self.engine, 'before_cursor_execute', 
+            self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        sa_event.remove(self.engine, 'before_cursor_execute', 
+            self._before_cursor_execute)
+
+    @property
+    def count(self):
+        return len(self.statements)
 
 
 class VolunteerAppTest(unittest.TestCase):
     def setUp(self):
         """reset test db with fixtures before each run"""
         reset_db_with_fixtures(db=db)
+        response_cache.clear()
 
     def tearDown(self):
         """Executed after each test"""
         db.session.close()
 
+    def assertQueryCount(self, expected, url):
+        """GET url with an empty session and fail if it doesn't run exactly
+        `expected` SQL statements"""
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            res = client().get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(counter.count, expected, 
+            f'{url} ran {counter.count} queries:\n' + '\n'.join(counter.statements))
+        return res
+
+    def add_events_with_participants(self, organisation_id, n_events):
+        """Add events joined by every user, to check query counts don't grow"""
+        users = User.query.all()
+        for i in range(n_events):
+            Event(
+                name=f'extra event {i}',
+                organisation_id=organisation_id,
+                start_datetime=datetime(2022, 1, 1, 10, 0, 0),
+                end_datetime=datetime(2022, 1, 1, 12, 0, 0),
+                participants=users
+            ).insert()
+
     def test_get_events(self):
         res = client().get('/events')
         data = json.loads(res.data)
@@ -40,6 +188,425 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(data['data']), len(events))
 
+    def test_get_events_paginated(self):
+        #event without dates is ordered last
+        Event(name='undated event', organisation_id=1).insert()
+
+        ids = []
+        cursor = None
+        for _ in range(10):
+            url = '/events?limit=2' + (f'&cursor={cursor}' if cursor else '')
+            res = client().get(url)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['data']), 2)
+            ids += [e['id'] for e in data['data']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+
+        self.assertEqual(ids, [1, 2, 3, 4, 5, 6])
+
+    def test_get_events_filters(self):
+        Event(
+            name='upcoming event',
+            organisation_id=3,
+            start_datetime=datetime.now() + timedelta(days=1),
+            end_datetime=datetime.now() + timedelta(days=2)
+        ).insert()
+
+        def event_ids(query):
+            res = client().get('/events?' + query)
+            self.assertEqual(res.status_code, 200)
+            return [e['id'] for e in json.loads(res.data)['data']]
+
+        self.assertEqual(event_ids('organisation_id=3'), [3, 4, 5, 6])
+        self.assertEqual(
+            event_ids('start_from=2021-02-01T00:00:00&start_to=2021-04-15'), [3, 4])
+        self.assertEqual(event_ids('upcoming=true'), [6])
+        self.assertEqual(event_ids('upcoming=true&organisation_id=1'), [])
+
+    def test_get_events_bad_request(self):
+        for query in ['limit=0', 'limit=abc', 'limit=100000', 'cursor=notacursor',
+                'start_from=yesterday', 'organisation_id=abc', 'upcoming=maybe']:
+            res = client().get('/events?' + query)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400, query)
+            self.assertEqual(data['success'], False)
+
+    def test_get_events_query_count(self):
+        self.assertQueryCount(1, '/events')
+        self.add_events_with_participants(organisation_id=2, n_events=10)
+        res = self.assertQueryCount(1, '/events')
+        self.assertEqual(len(json.loads(res.data)['data']), 15)
+
+    def test_get_event_query_count(self):
+        self.add_events_with_participants(organisation_id=1, n_events=3)
+        res = self.assertQueryCount(1, '/events/6')
+        self.assertEqual(len(json.loads(res.data)['data']['participants']), 4)
+
+    def test_projected_payloads_match_format(self):
+        """the column-projected read endpoints must return byte-identical
+        payloads to the ORM format() path"""
+        Event(name='undated event', organisation_id=1).insert()
+        self.add_events_with_participants(organisation_id=2, n_events=2)
+
+        events = Event.query.options(*Event.format_options()).order_by(
+            Event.start_datetime.asc().nullslast(), Event.id.asc()).all()
+        organisations = Organisation.query.order_by(Organisation.id).all()
+        with app.test_request_context():
+            expected = {
+                '/events': jsonify({
+                    'success': True,
+                    'data': [e.format() for e in events],
+                    'next_cursor': None
+                }).get_data(),
+                '/events/1': jsonify({
+                    'success': True,
+                    'data': events[0].format()
+                }).get_data(),
+                '/events/6': jsonify({
+                    'success': True,
+                    'data': events[-1].format()
+                }).get_data(),
+                '/organisations': jsonify({
+                    'success': True,
+                    'data': [org.format() for org in organisations]
+                }).get_data(),
+            }
+
+        for url, payload in expected.items():
+            res = client().get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, payload, url)
+
+    def test_streamed_payloads_match_jsonify(self):
+        self.add_events_with_participants(organisation_id=2, n_events=3)
+
+        debug = app.debug
+        self.addCleanup(setattr, app, 'debug', debug)
+        self.addCleanup(setattr, json_backend, 'backend', json_backend.backend)
+        for backend, pretty in [(b, p) for b in json_backend.BACKENDS for p in (True, False)]:
+            json_backend.set_backend(backend)
+            app.debug = pretty
+            with patch.dict(app.config, {'JSONIFY_PRETTYPRINT_REGULAR': pretty}):
+                for url in ['/events?limit=200', '/events?organisation_id=1',
+                        '/events?organisation_id=100', '/organisations']:
+                    response_cache.clear()
+                    res = client().get(url)
+                    streamed = client().get(url + ('&' if '?' in url else '?') + 'stream=true')
+
+                    self.assertEqual(streamed.status_code, 200)
+                    self.assertEqual(streamed.mimetype, 'application/json')
+                    self.assertEqual(streamed.data, res.data, (backend, url))
+
+    def test_json_backends_encode_same_payload(self):
+        self.addCleanup(setattr, json_backend, 'backend', json_backend.backend)
+        payloads = {}
+        for backend in json_backend.BACKENDS:
+            json_backend.set_backend(backend)
+            response_cache.clear()
+            res = client().get('/events')
+            self.assertEqual(res.status_code, 200)
+            payloads[backend] = json.loads(res.data)
+
+        self.assertEqual(payloads['stdlib'], payloads['orjson'])
+        self.assertEqual(payloads['stdlib']['data'][0]['start_datetime'], 
+            '2021-01-12T10:00:00')
+
+    def test_streamed_response_is_chunked(self):
+        self.add_events_with_participants(organisation_id=2, n_events=20)
+        with patch('streaming.STREAM_CHUNK_SIZE', 100):
+            res = client().get('/events?stream=true', buffered=False)
+            chunks = list(res.response)
+            res.close()
+
+        self.assertGreater(len(chunks), 20)
+        self.assertEqual(len(json.loads(b''.join(chunks))['data']), 25)
+
+    def assertCountsConsistent(self):
+        """denormalised counters match the rows they count"""
+        db.session.expire_all()
+        for event in Event.query.all():
+            self.assertEqual(event.participant_count, len(event.participants), event.id)
+        for org in Organisation.query.all():
+            self.assertEqual(org.event_count, len(org.events), org.id)
+
+    def test_get_events_summary(self):
+        self.assertCountsConsistent()
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            res = client().get('/events/summary?limit=3')
+        self.assertEqual(counter.count, 1)
+        data = json.loads(res.data)
+        self.assertEqual([(e['id'], e['participant_count']) for e in data['data']],
+            [(1, 2), (2, 1), (3, 2)])
+
+        res = client().get('/events/summary?limit=3&cursor=' + data['next_cursor'])
+        data = json.loads(res.data)
+        self.assertEqual([(e['id'], e['participant_count']) for e in data['data']],
+            [(4, 3), (5, 3)])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_get_organisations_summary(self):
+        res = client().get('/organisations/summary')
+        data = json.loads(res.data)
+        self.assertEqual([(o['id'], o['event_count']) for o in data['data']],
+            [(1, 1), (2, 1), (3, 3)])
+
+    def test_search_events(self):
+        for name, description, address in (
+                ('beach cleanup', 'bring gloves', 'Brighton'),
+                ('park picnic', 'then a beach cleanup', 'Hyde Park'),
+                ('food bank', 'sorting donations', 'Beach Road')):
+            Event(name=name, description=description, address=address,
+                organisation_id=1).insert()
+
+        #name matches rank above description matches, above address matches
+        res = client().get('/events/search?q=beach&limit=2')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual([e['name'] for e in data['data']], ['beach cleanup', 'park picnic'])
+        self.assertEqual(data['data'][0]['organisation']['id'], 1)
+        res = client().get('/events/search?q=beach&limit=2&cursor=' + data['next_cursor'])
+        data = json.loads(res.data)
+        self.assertEqual([e['name'] for e in data['data']], ['food bank'])
+        self.assertIsNone(data['next_cursor'])
+
+        #web search syntax, stemming
+        res = client().get('/events/search?q="beach cleanup" -gloves')
+        self.assertEqual([e['name'] for e in json.loads(res.data)['data']], ['park picnic'])
+        res = client().get('/events/search?q=donation')
+        self.assertEqual([e['name'] for e in json.loads(res.data)['data']], ['food bank'])
+
+        #equal ranks are paged in id order
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            data = json.loads(client().get(f'/events/search?q=test&limit=2&cursor={cursor}').data)
+            ids += [e['id'] for e in data['data']]
+            cursor = data['next_cursor']
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+        for url in ('/events/search', '/events/search?q=%20', '/events/search?q=a&cursor=xyz',
+                '/events/search?q=' + 'a' * 201):
+            self.assertEqual(client().get(url).status_code, 400, url)
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_search_vector_follows_updates(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['update:event']
+        }
+        res = client().patch('/events/1', json={'description': 'knitting for charity'})
+        self.assertEqual(res.status_code, 200)
+        res = client().get('/events/search?q=knitting')
+        self.assertEqual([e['id'] for e in json.loads(res.data)['data']], [1])
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_search_users(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['search:users']
+        }
+        res = client().get('/users/search?skills=counselling')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual([(u['id'], u['skills']) for u in data['data']],
+            [(2, ['counselling']), (4, ['counselling'])])
+
+        res = client().get('/users/search?skills=cooking,%20web%20development')
+        self.assertEqual([u['id'] for u in json.loads(res.data)['data']], [1])
+        res = client().get('/users/search?skills=cooking,counselling')
+        self.assertEqual(json.loads(res.data)['data'], [])
+
+        #users with the most of the skills first
+        User(name='all rounder', skills=['counselling', 'cooking']).insert()
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            res = client().get('/users/search?skills=cooking,counselling&match=any'
+                f'&limit=2&cursor={cursor}')
+            data = json.loads(res.data)
+            ids += [u['id'] for u in data['data']]
+            cursor = data['next_cursor']
+        self.assertEqual(ids, [5, 1, 2, 4])
+
+        for query in ('', 'skills=,', 'skills=a&match=some', 'skills=a&cursor=xyz',
+                'skills=' + ','.join(str(i) for i in range(21))):
+            res = client().get('/users/search?' + query)
+            self.assertEqual(res.status_code, 400, query)
+
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': ['add:event-participant']
+        }
+        res = client().get('/users/search?skills=cooking')
+        self.assertEqual(res.status_code, 403)
+
+    def use_geocoder(self, table):
+        self.addCleanup(setattr, geocoding, 'geocoder', geocoding.geocoder)
+        geocoding.geocoder = geocoding.LookupGeocoder(table)
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_events_geocoded_on_write(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['create:event', 'update:event']
+        }
+        self.use_geocoder({'10 Downing Street, London': (51.5034, -0.1276)})
+
+        res = client().post('/events', json={'name': 'new event', 'organisation_id': 1,
+            'address': '10 downing street   london'})
+        created = json.loads(res.data)['created']
+        self.assertEqual((created['latitude'], created['longitude']), (51.5034, -0.1276))
+
+        #unknown addresses clear the coordinates, given coordinates are kept
+        res = client().patch(f'/events/{created["id"]}', json={'address': 'somewhere'})
+        updated = json.loads(res.data)['updated']
+        self.assertEqual((updated['latitude'], updated['longitude']), (None, None))
+        res = client().patch(f'/events/{created["id"]}', json={'address': '10 Downing Street, London',
+            'latitude': 51.5, 'longitude': -0.1})
+        updated = json.loads(res.data)['updated']
+        self.assertEqual((updated['latitude'], updated['longitude']), (51.5, -0.1))
+        res = client().patch(f'/events/{created["id"]}', json={'name': 'renamed'})
+        self.assertEqual(json.loads(res.data)['updated']['latitude'], 51.5)
+
+        #without a geocoder a new address keeps the coordinates
+        geocoding.geocoder = None
+        res = client().patch(f'/events/{created["id"]}', json={'address': 'next door'})
+        updated = json.loads(res.data)['updated']
+        self.assertEqual((updated['latitude'], updated['longitude']), (51.5, -0.1))
+        self.use_geocoder({'10 Downing Street, London': (51.5034, -0.1276)})
+
+        for coordinates in ({'latitude': 91, 'longitude': 0}, {'latitude': 10}):
+            res = client().post('/events', json={'name': 'bad', 'organisation_id': 1,
+                **coordinates})
+            self.assertEqual(res.status_code, 422, coordinates)
+
+        body = '\n'.join(json.dumps(record) for record in (
+            {'name': 'imported', 'address': '10 Downing Street, London'},
+            {'name': 'located', 'latitude': '48.85', 'longitude': '2.35'},
+            {'name': 'bad', 'latitude': 48.85},
+        ))
+        res = client().post('/events/import', data=body, content_type='application/x-ndjson')
+        results = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(results[0], {'line': 3, 'error': 'latitude and longitude go together'})
+        imported = Event.query.filter(Event.name.in_(['imported', 'located'])) \
+            .order_by(Event.name).all()
+        self.assertEqual([(e.latitude, e.longitude) for e in imported],
+            [(51.5034, -0.1276), (48.85, 2.35)])
+
+    def test_geocode_events_command(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(geocode_events_command)
+        self.assertEqual(result.output, '0 events geocoded\n')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'addresses.csv')
+            with open(path, 'w') as f:
+                f.write('address,latitude,longitude\n"London SW1A 0AA, UK",51.4995,-0.1248\n')
+            self.use_geocoder({})
+            geocoding.geocoder = geocoding.LookupGeocoder.from_csv(path)
+        response_cache.clear()
+        etag = client().get('/events/1').headers['ETag']
+
+        result = runner.invoke(geocode_events_command, ['--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output, '5 events geocoded\n')
+        res = client().get('/events/1')
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(json.loads(res.data)['data']['latitude'], 51.4995)
+
+    def test_nearby_events(self):
+        #a venue hosting more events than a page, and events around it
+        start = datetime.now() + timedelta(days=1)
+        rows = [{'name': f'venue {i}', 'latitude': 51.5, 'longitude': -0.12}
+            for i in range(3)]
+        rows += [{'name': name, 'latitude': lat, 'longitude': lng}
+            for name, lat, lng in (('near', 51.51, -0.12), ('brighton', 50.82, -0.14),
+                ('paris', 48.85, 2.35), ('sydney', -33.87, 151.21))]
+        add_events([dict(row, organisation_id=1, start_datetime=start,
+            end_datetime=start + timedelta(hours=2)) for row in rows])
+        Event.query.filter_by(name='near').update({'end_datetime': datetime(2000, 1, 2),
+            'start_datetime': datetime(2000, 1, 1)})
+        db.session.commit()
+
+        def nearby(query):
+            names, distances = [], []
+            cursor = ''
+            while cursor is not None:
+                res = client().get(f'/events/nearby?{query}&cursor={cursor}')
+                self.assertEqual(res.status_code, 200)
+                data = json.loads(res.data)
+                names += [e['name'] for e in data['data']]
+                distances += [e['distance_km'] for e in data['data']]
+                cursor = data['next_cursor']
+            return names, distances
+
+        names, distances = nearby('lat=51.5&lng=-0.12&limit=2')
+        self.assertEqual(names, ['venue 0', 'venue 1', 'venue 2', 'near'])
+        self.assertEqual(distances, [0.0, 0.0, 0.0, 1.112])
+        names, distances = nearby('lat=51.5&lng=-0.12&radius_km=100&limit=3&upcoming=true')
+        self.assertEqual(names, ['venue 0', 'venue 1', 'venue 2', 'brighton'])
+        self.assertAlmostEqual(distances[-1], 75.63, places=2)
+        #across the 180th meridian
+        names, _ = nearby('lat=-33.8&lng=179.9&radius_km=500')
+        self.assertEqual(names, [])
+        names, _ = nearby('lat=-33.8&lng=151.3&radius_km=20')
+        self.assertEqual(names, ['sydney'])
+
+        #nearest to the center of the box in degrees
+        names, _ = nearby('bbox=-1,48,3,51')
+        self.assertEqual(names, ['paris', 'brighton'])
+
+        for query in ('', 'lat=51.5', 'lat=91&lng=0', 'lat=1&lng=1&radius_km=0',
+                'lat=1&lng=1&radius_km=501', 'lat=nan&lng=1', 'bbox=1,2,3', 'bbox=3,1,1,2',
+                'bbox=1,1,2,2&lat=1', 'lat=1&lng=1&cursor=xyz'):
+            self.assertEqual(client().get('/events/nearby?' + query).status_code, 400, query)
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_counts_maintained_by_writes(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        org_payload = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['create:event', 'update:event', 'delete:event']
+        }
+        user_payload = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': ['add:event-participant', 'remove:event-participant']
+        }
+
+        mock_verify_decode_jwt.return_value = org_payload
+        res = client().post('/events', json={'name': 'new event', 'organisation_id': 1})
+        new_id = json.loads(res.data)['created']['id']
+        self.assertCountsConsistent()
+
+        mock_verify_decode_jwt.return_value = user_payload
+        client().post(f'/events/{new_id}/participants', json={'user_id': 1})
+        self.assertCountsConsistent()
+        #already a participant: nothing changes
+        client().post(f'/events/{new_id}/participants', json={'user_id': 1})
+        self.assertCountsConsistent()
+        self.assertEqual(Event.query.get(new_id).participant_count, 1)
+        client().delete('/events/1/participants', json={'user_id': 1})
+        self.assertCountsConsistent()
+
+        mock_verify_decode_jwt.return_value = org_payload
+        client().patch(f'/events/{new_id}', json={'organisation_id': 2})
+        self.assertCountsConsistent()
+        client().delete('/events/1')
+        self.assertCountsConsistent()
+        self.assertEqual(Organisation.query.get(1).event_count, 0)
+
     def test_get_event_success(self):
         res = client().get('/events/1')
         data = json.loads(res.data)
@@ -47,6 +614,167 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['data']['id'], 1)
 
+    def test_get_event_conditional(self):
+        res = client().get('/events/1')
+        etag = res.headers['ETag']
+        self.assertTrue(etag)
+
+        #served from the response cache
+        res = client().get('/events/1', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        #the 304 path only reads the version, participants are not loaded
+        response_cache.clear()
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            res = client().get('/events/1', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(counter.count, 1)
+
+        res = client().get('/events/2', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        res = client().get('/events/100', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 404)
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_writes_change_etags(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['update:event', 'create:event']
+        }
+        #event 2 belongs to organisation 2, user 1 is not a participant yet
+        def etags():
+            return (client().get('/events/1').headers['ETag'],
+                client().get('/organisations/1').headers['ETag'])
+
+        before = etags()
+        client().patch('/events/1', json={'name': 'new name'})
+        after_update = etags()
+        self.assertNotEqual(before[0], after_update[0])
+        self.assertNotEqual(before[1], after_update[1])
+
+        client().post('/events', json={'name': 'new event', 'organisation_id': 1})
+        after_create = etags()
+        self.assertEqual(after_update[0], after_create[0])
+        self.assertNotEqual(after_update[1], after_create[1])
+
+        res = client().get('/events/1', headers={'If-None-Match': before[0]})
+        self.assertEqual(res.status_code, 200)
+
+        event = Event.query.get(1)
+        event.participants.remove(User.query.get(1))
+        event.update()
+        self.assertNotEqual(etags(), after_create)
+
+    def test_response_cache_hit(self):
+        first = client().get('/events/1')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            second = client().get('/events/1')
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(second.mimetype, 'application/json')
+
+        #listings are keyed by query string, streams bypass the cache
+        self.assertEqual(client().get('/events?limit=2').headers['X-Cache'], 'MISS')
+        self.assertEqual(client().get('/events?limit=2').headers['X-Cache'], 'HIT')
+        self.assertNotIn('X-Cache', client().get('/events?stream=true').headers)
+        self.assertEqual(response_cache.stats()['hits'], 2)
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_response_cache_invalidated_by_writes(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': ['add:event-participant']
+        }
+        urls = ['/events', '/events/2', '/events/3', '/organisations', 
+            '/organisations/2', '/organisations/3']
+        for url in urls:
+            client().get(url)
+
+        #user 1 joins event 3 of organisation 3
+        res = client().post('/events/3/participants', json={'user_id': 1})
+        self.assertEqual(res.status_code, 200)
+
+        cache_status = {url: client().get(url).headers['X-Cache'] for url in urls}
+        self.assertEqual(cache_status, {
+            '/events': 'MISS',
+            '/events/2': 'HIT',
+            '/events/3': 'MISS',
+            '/organisations': 'HIT',
+            '/organisations/2': 'HIT',
+            '/organisations/3': 'MISS',
+        })
+        data = json.loads(client().get('/events/3').data)
+        self.assertIn(1, [p['id'] for p in data['data']['participants']])
+
+    def test_response_cache_read_racing_a_write(self):
+        def write_during_read(row, *args, **kwargs):
+            #another worker renames the event after the row was selected
+            with db.engine.begin() as conn:
+                conn.execute(text("UPDATE event SET name = 'renamed' WHERE id = 1"))
+            response_cache.invalidate_rows({('event', 1)})
+            return format_event_row(row, *args, **kwargs)
+
+        with patch('app.format_event_row', side_effect=write_during_read):
+            res = client().get('/events/1')
+        self.assertEqual(json.loads(res.data)['data']['name'], 'test event 0')
+
+        #the old body was stored under the previous generation of the event
+        res = client().get('/events/1')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(res.data)['data']['name'], 'renamed')
+
+    def test_response_cache_organisation_expires_with_upcoming_events(self):
+        Event(name='ending soon', organisation_id=2, start_datetime=datetime.now(),
+            end_datetime=datetime.now() + timedelta(seconds=5)).insert()
+        self.assertEqual(client().get('/organisations/2').headers['X-Cache'], 'MISS')
+        self.assertEqual(client().get('/organisations/2').headers['X-Cache'], 'HIT')
+
+        #once the event ends it is listed as past
+        backend = response_cache.backend
+        now = backend.clock()
+        with patch.object(backend, 'clock', lambda: now + 5):
+            self.assertEqual(client().get('/organisations/2').headers['X-Cache'], 'MISS')
+
+    def test_response_cache_lru_and_ttl(self):
+        now = [0]
+        backend = MemoryBackend(maxsize=2, ttl=10, clock=lambda: now[0])
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertEqual((backend.get('a'), backend.get('b'), backend.get('c')), 
+            (1, None, 3))
+        self.assertEqual(backend.evictions, 1)
+
+        now[0] = 10
+        self.assertIsNone(backend.get('a'))
+
+    def test_response_cache_shared_backend(self):
+        self.addCleanup(setattr, response_cache, 'backend', response_cache.backend)
+        store = FakeRedis()
+        response_cache.backend = SharedBackend(store)
+
+        first = client().get('/events')
+        self.assertEqual(client().get('/events').headers['X-Cache'], 'HIT')
+        #a second worker sharing the store sees entries and invalidations
+        response_cache.backend = SharedBackend(store)
+        self.assertEqual(client().get('/events').data, first.data)
+
+        Event(name='new event', organisation_id=1).insert()
+        self.assertEqual(client().get('/events').headers['X-Cache'], 'MISS')
+
     def test_get_event_not_found(self):
         res = client().get('/events/100')
         data = json.loads(res.data)
@@ -55,6 +783,136 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    @patch('bulk_events.IMPORT_BATCH_SIZE', 3)
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_import_events_ndjson(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['create:event']
+        }
+        lines = [
+            {'name': 'a', 'organisation_id': 1, 'start_datetime': '2022-01-01T10:00:00'},
+            {'name': 'b'},
+            'not json',
+            {'name': 'c', 'start_datetime': '2022-01-01T10:00:00', 'end_datetime': '2022-01-01T09:00:00'},
+            {'name': 'd', 'organisation_id': 2},
+            {'name': 'e', 'colour': 'red'},
+            {'id': 99, 'name': 'f', 'address': 'London'},
+        ]
+        body = '\n'.join(l if isinstance(l, str) else json.dumps(l) for l in lines)
+        res = client().post('/events/import', data=body, 
+            content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        results = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(results, [
+            {'line': 3, 'error': 'invalid json'},
+            {'batch': 1, 'imported': 2, 'failed': 1},
+            {'line': 4, 'error': 'start date must be earlier than end date'},
+            {'line': 5, 'error': 'organisation not permitted'},
+            {'line': 6, 'error': 'unknown fields: colour'},
+            {'batch': 2, 'imported': 0, 'failed': 3},
+            {'batch': 3, 'imported': 1, 'failed': 0},
+            {'imported': 3, 'failed': 4},
+        ])
+        imported = Event.query.filter(Event.name.in_(['a', 'b', 'f'])) \
+            .order_by(Event.name).all()
+        self.assertEqual([(e.name, e.organisation_id) for e in imported], 
+            [('a', 1), ('b', 1), ('f', 1)])
+        self.assertNotEqual(imported[2].id, 99)
+        self.assertCountsConsistent()
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_import_events_csv(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['create:event']
+        }
+        body = (
+            'name,description,start_datetime,end_datetime\n'
+            'csv event,,2022-01-01T10:00:00,2022-01-01T12:00:00\n'
+            ',missing name,,\n'
+            'bad date,,tomorrow,\n'
+        )
+        res = client().post('/events/import', data=body, content_type='text/csv')
+        results = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(results, [
+            {'line': 3, 'error': 'name is required'},
+            {'line': 4, 'error': 'start_datetime is not an iso formatted datetime'},
+            {'batch': 1, 'imported': 1, 'failed': 2},
+            {'imported': 1, 'failed': 2},
+        ])
+        event = Event.query.filter_by(name='csv event').one()
+        self.assertIsNone(event.description)
+        self.assertEqual(event.end_datetime, datetime(2022, 1, 1, 12, 0, 0))
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_import_events_not_permitted(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057', #a user, not an organisation
+            'permissions': ['create:event']
+        }
+        res = client().post('/events/import', data='{"name": "a"}', 
+            content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(Event.query.filter_by(name='a').count(), 0)
+
+    def test_export_events(self):
+        res = client().get('/events/export?format=csv&organisation_id=3')
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(res.mimetype, 'text/csv')
+        lines = res.data.decode().splitlines()
+        self.assertEqual(lines[0],
+            'id,name,description,start_datetime,end_datetime,address,organisation_id,latitude,longitude')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['3', '4', '5'])
+
+        res = client().get('/events/export')
+        exported = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(len(exported), 5)
+        event = Event.query.get(1)
+        self.assertEqual(exported[0], {
+            'id': 1,
+            'name': event.name,
+            'description': event.description,
+            'start_datetime': event.start_datetime.isoformat(),
+            'end_datetime': event.end_datetime.isoformat(),
+            'address': event.address,
+            'organisation_id': event.organisation_id,
+            'latitude': None,
+            'longitude': None,
+        })
+
+        res = client().get('/events/export?format=xml')
+        self.assertEqual(res.status_code, 400)
+
+    def test_import_export_cli(self):
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'events.csv')
+            result = runner.invoke(export_events_command, [path])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            #the export is read back as is, creating a copy of every event
+            result = runner.invoke(import_events_command, [path, '--batch-size', '2'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            results = [json.loads(line) for line in result.output.splitlines()]
+            self.assertEqual(results[-1], {'imported': 5, 'failed': 0})
+            self.assertEqual(len(results), 4)
+        self.assertEqual(Event.query.count(), 10)
+        self.assertCountsConsistent()
+
+        result = runner.invoke(import_events_command, ['-', '--format', 'ndjson'], 
+            input='{"name": "no organisation"}\n')
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('organisation_id is required', result.output)
+
     @patch('auth.get_token_auth_header')
     @patch('auth.verify_decode_jwt')
     def test_create_event_success(self, mock_verify_decode_jwt, mock_get_auth_header):
@@ -78,6 +936,26 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertEqual(count_before+1, count_after)
         self.assertEqual(event.name, data['created']['name'])
 
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_create_event_maintained_fields(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['create:event']
+        }
+
+        count_before = Event.query.count()
+        for field, value in (('participant_count', 100), ('version', 7), 
+                ('search_vector', 'x'), ('id', 100)):
+            res = client().post('/events', json={
+                'name': 'new event',
+                'organisation_id': 1,
+                field: value
+            })
+            self.assertEqual(res.status_code, 400)
+        self.assertEqual(Event.query.count(), count_before)
+
     @patch('auth.get_token_auth_header')
     @patch('auth.verify_decode_jwt')
     def test_create_event_not_permitted_role(self, mock_verify_decode_jwt, mock_get_auth_header):
@@ -153,7 +1031,58 @@ class VolunteerAppTest(unittest.TestCase):
         event = Event.query.get(event_id)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(event.name, data['updated']['name'])
-  
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_write_responses_query_count(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['create:event', 'update:event']
+        }
+        #after the write, the response is loaded with a join on organisation
+        #and one SELECT ... IN of the participants
+        def response_statements(counter):
+            statements = counter.statements
+            last_write = max(i for i, s in enumerate(statements)
+                if not s.lstrip().startswith('SELECT'))
+            return statements[last_write + 1:]
+
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            res = client().patch('/events/1', json={'name': 'new name'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['updated']['participants']), 2)
+        statements = response_statements(counter)
+        self.assertEqual(len(statements), 2, '\n'.join(statements))
+        self.assertIn('JOIN organisation', statements[0])
+
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            res = client().post('/events', json={'name': 'new event', 'organisation_id': 1})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['created']['organisation']['name'],
+            'Test Organisation')
+        statements = response_statements(counter)
+        self.assertEqual(len(statements), 2, '\n'.join(statements))
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_update_event_maintained_fields(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['update:event']
+        }
+
+        for body in ({'participant_count': 100}, {'version': 1}, {'search_vector': 'x'},
+                {'name': 'new name', 'id': 2}):
+            res = client().patch('/events/1', json=body)
+            self.assertEqual(res.status_code, 400)
+        event = Event.query.get(1)
+        self.assertEqual(event.participant_count, 2)
+        self.assertEqual(event.name, 'test event 0')
+
     @patch('auth.get_token_auth_header')
     @patch('auth.verify_decode_jwt')
     def test_update_event_not_found(self, mock_verify_decode_jwt, mock_get_auth_header):
@@ -317,6 +1246,33 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertIn(user_id, data['updated']['event_participants']) #check output
 
 
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_participant_writes_query_count(self,  mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': ['add:event-participant', 'remove:event-participant']
+        }
+        #the participant list is never loaded, more sign-ups cost nothing
+        counts = []
+        for n_events in (0, 10):
+            self.add_events_with_participants(organisation_id=3, n_events=n_events)
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                res = client().delete('/events/1/participants', json={'user_id': 1})
+                self.assertEqual(res.status_code, 200)
+                res = client().post('/events/1/participants', json={'user_id': 1})
+                self.assertEqual(res.status_code, 200)
+            counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(json.loads(res.data)['updated']['event_participants'], [1, 2])
+        self.assertCountsConsistent()
+
+        #removing a user who isn't a participant
+        res = client().delete('/events/3/participants', json={'user_id': 1})
+        self.assertEqual(res.status_code, 422)
+
     @patch('auth.get_token_auth_header')
     @patch('auth.verify_decode_jwt')
     def test_add_event_participant_event_not_found(self,  mock_verify_decode_jwt, mock_get_auth_header):
@@ -503,6 +1459,210 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertEqual(len(event.participants), 1)
 
 
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_add_event_participants_bulk(self,  mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['add:event-participant']
+        }
+        #event 1 of organisation 1 has users 1 and 2
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            res = client().post('/events/1/participants/bulk', json={
+                'user_ids': [3, 1, 4, 1000, 3]
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [
+            {'user_id': 3, 'status': 'added'},
+            {'user_id': 1, 'status': 'already_registered'},
+            {'user_id': 4, 'status': 'added'},
+            {'user_id': 1000, 'status': 'not_found'},
+        ])
+        #existence checked with one IN query, all rows written by one insert
+        inserts = [s for s in counter.statements if s.startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual([u.id for u in Event.query.get(1).participants], [1, 2, 3, 4])
+        self.assertCountsConsistent()
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_add_event_participants_bulk_errors(self,  mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58135612d820070a5f049',
+            'permissions': ['add:event-participant']
+        }
+        for body in ({}, {'user_ids': []}, {'user_ids': 1}, {'user_ids': ['1']}):
+            res = client().post('/events/1/participants/bulk', json=body)
+            self.assertEqual(res.status_code, 400, body)
+
+        res = client().post('/events/1000/participants/bulk', json={'user_ids': [3]})
+        self.assertEqual(res.status_code, 422)
+
+        #event 3 belongs to another organisation
+        res = client().post('/events/3/participants/bulk', json={'user_ids': [3]})
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual([u.id for u in Event.query.get(3).participants], [2, 4])
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_add_user_to_events_bulk(self,  mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': ['add:event-participant']
+        }
+        res = client().post('/users/1/events', json={'event_ids': [2, 3, 1000]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [
+            {'event_id': 2, 'status': 'already_registered'},
+            {'event_id': 3, 'status': 'added'},
+            {'event_id': 1000, 'status': 'not_found'},
+        ])
+        self.assertIn(1, [u.id for u in Event.query.get(3).participants])
+        self.assertCountsConsistent()
+
+        #registering someone else
+        res = client().post('/users/2/events', json={'event_ids': [3]})
+        self.assertEqual(res.status_code, 403)
+
+    def test_health(self):
+        res = client().get('/health')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        pool = list(data['pools'].values())[-1]
+        self.assertTrue(pool['pool'].endswith('QueuePool'))
+        self.assertGreater(pool['checkouts'], 0)
+
+    def test_metrics_disabled(self):
+        res = client().get('/metrics')
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn('Server-Timing', client().get('/events/1').headers)
+        self.assertEqual(auth.verify_listeners, [])
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_metrics(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': ['add:event-participant']
+        }
+        metrics.enable(app)
+        self.addCleanup(metrics.disable, app)
+        metrics.registry.clear()
+        response_cache.clear()
+
+        res = client().get('/events/1')
+        self.assertRegex(res.headers['Server-Timing'],
+            r'^db;dur=[0-9.]+;desc="1 queries", total;dur=[0-9.]+$')
+        res = client().post('/events/3/participants', json={'user_id': 1})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('auth;dur=', res.headers['Server-Timing'])
+        client().get('/events/100')
+
+        res = client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain; version=0.0.4'))
+        text = res.get_data(as_text=True)
+        for line in [
+            'http_requests_total{method="GET",route="/events/<int:event_id>",status="200"} 1',
+            'http_requests_total{method="GET",route="/events/<int:event_id>",status="404"} 1',
+            'http_request_duration_seconds_count{method="GET",route="/events/<int:event_id>"} 2',
+            'http_request_duration_seconds_bucket{method="GET",route="/events/<int:event_id>",le="+Inf"} 2',
+            'db_queries_total{method="GET",route="/events/<int:event_id>"} 2',
+            'auth_verify_duration_seconds_count{method="POST",route="/events/<int:event_id>/participants"} 1',
+        ]:
+            self.assertIn(line, text.splitlines())
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+
+        metrics.disable(app)
+        self.assertEqual(client().get('/metrics').status_code, 404)
+        self.assertEqual(auth.verify_listeners, [])
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_profile_worker(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': [profiler.PROFILE_PERMISSION]
+        }
+        def busy_worker(until):
+            while datetime.now() < until:
+                pass
+        worker = threading.Thread(target=busy_worker,
+            args=(datetime.now() + timedelta(seconds=1),))
+        worker.start()
+        self.addCleanup(worker.join)
+
+        res = client().get('/admin/profile?seconds=0.3')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        lines = res.get_data(as_text=True).splitlines()
+        busy = [line for line in lines if 'busy_worker (test_app.py:' in line]
+        self.assertTrue(busy)
+        stack, count = busy[0].rsplit(' ', 1)
+        self.assertTrue(stack.startswith('_bootstrap (threading.py:'))
+        self.assertGreater(int(count), 0)
+
+        for seconds in ['0', 'abc', '3600']:
+            res = client().get(f'/admin/profile?seconds={seconds}')
+            self.assertEqual(res.status_code, 400, seconds)
+
+        with patch.object(profiler, '_worker_profile', threading.Lock()) as busy_lock:
+            busy_lock.acquire()
+            self.assertEqual(client().get('/admin/profile?seconds=1').status_code, 409)
+
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': ['add:event-participant']
+        }
+        self.assertEqual(client().get('/admin/profile?seconds=1').status_code, 403)
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_profile_request(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': 'auth0|60c58174612d820070a5f057',
+            'permissions': [profiler.PROFILE_PERMISSION]
+        }
+        response_cache.clear()
+
+        def slow_format(row, **kwargs):
+            until = datetime.now() + timedelta(milliseconds=50)
+            while datetime.now() < until:
+                pass
+            return format_event_row(row, **kwargs)
+
+        with patch('app.format_event_row', slow_format):
+            res = client().get('/events/1', headers={'X-Profile': '1'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Profiled-Status'], '200')
+        self.assertGreater(int(res.headers['X-Profile-Samples']), 0)
+        self.assertIn('get_event (app.py:', res.get_data(as_text=True))
+        self.assertIn('slow_format (test_app.py:', res.get_data(as_text=True))
+
+        #the header is ignored without the permission
+        mock_verify_decode_jwt.return_value = {'permissions': []}
+        expected = client().get('/events/1').data
+        for _ in range(2):
+            res = client().get('/events/1', headers={'X-Profile': '1'})
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn('X-Profiled-Status', res.headers)
+            self.assertEqual(res.data, expected)
+            mock_get_auth_header.side_effect = auth.AuthError({
+                'code': 'authorization_header_missing',
+                'description': 'Authorization header is expected.'}, 401)
+
     def test_get_all_organisations(self):
         res = client().get('/organisations')
         data = json.loads(res.data)
@@ -523,6 +1683,60 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertIn('past_events', data['data'].keys())
         self.assertIn('upcoming_events', data['data'].keys())
 
+    def test_get_organisation_query_count(self):
+        self.assertQueryCount(3, '/organisations/3')
+        self.add_events_with_participants(organisation_id=3, n_events=10)
+        res = self.assertQueryCount(3, '/organisations/3')
+        self.assertEqual(len(json.loads(res.data)['data']['past_events']), 13)
+
+    def test_get_organisation_paginated_buckets(self):
+        Event(name='undated event', organisation_id=3).insert()
+        Event(
+            name='upcoming event',
+            organisation_id=3,
+            start_datetime=datetime.now() + timedelta(days=1),
+            end_datetime=datetime.now() + timedelta(days=2)
+        ).insert()
+
+        def buckets(query):
+            res = client().get('/organisations/3?' + query)
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data)['data']
+            return ([e['id'] for e in data['past_events']], data['past_events_next_cursor'],
+                [e['id'] for e in data['upcoming_events']], data['upcoming_events_next_cursor'])
+
+        past, past_cursor, upcoming, upcoming_cursor = buckets('past_limit=2&upcoming_limit=1')
+        self.assertEqual((past, upcoming), ([5, 4], [7]))
+
+        past, past_cursor, upcoming, upcoming_cursor = buckets(
+            f'past_limit=2&upcoming_limit=1&past_cursor={past_cursor}&upcoming_cursor={upcoming_cursor}')
+        self.assertEqual((past, past_cursor, upcoming, upcoming_cursor), ([3], None, [6], None))
+
+        for query in ['past_limit=0', 'upcoming_limit=abc', 'past_cursor=abc']:
+            res = client().get('/organisations/3?' + query)
+            self.assertEqual(res.status_code, 400, query)
+
+    def test_get_organisation_conditional(self):
+        etag = client().get('/organisations/2').headers['ETag']
+        response_cache.clear()
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            res = client().get('/organisations/2', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(counter.count, 1)
+
+        #an upcoming event ending moves to past_events, the etag follows
+        event = Event.query.get(2)
+        event.end_datetime = datetime(2100, 1, 1)
+        event.update()
+        etag = client().get('/organisations/2').headers['ETag']
+        response_cache.clear()
+        with patch('app.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime(2100, 1, 2)
+            res = client().get('/organisations/2', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['data']['upcoming_events']), 0)
+
     def test_get_organisation_not_found(self):
         org_id = 100
         res = client().get(f'/organisations/{org_id}')
@@ -533,5 +1747,127 @@ class VolunteerAppTest(unittest.TestCase):
         self.assertEqual(data['message'], 'resource not found')
       
 
+class SetupDbTest(unittest.TestCase):
+    def setup_other_app(self, database_path):
+        """A second app bound to database_path, the test app is bound back after"""
+        self.addCleanup(setattr, db, 'app', db.app)
+        other = Flask(__name__)
+        setup_db(other, database_path=database_path)
+        Migrate(other, db)
+        return other
+
+    def test_setup_db_does_not_connect(self):
+        #setup_db used to create the tables, failing without a database
+        unreachable = 'postgresql+psycopg2://nobody@127.0.0.1:1/nothing'
+        connections = []
+        listener = lambda conn, *args: connections.append(conn.engine.url)
+        sa_event.listen(Engine, 'engine_connect', listener)
+        self.addCleanup(sa_event.remove, Engine, 'engine_connect', listener)
+        with patch.object(db, 'create_all') as create_all:
+            other = self.setup_other_app(unreachable)
+            with other.app_context():
+                #the engine of the unreachable database is only created
+                self.assertEqual(db.engine.url.port, 1)
+        create_all.assert_not_called()
+        self.assertEqual(connections, [])
+
+    def test_init_db_command(self):
+        name = make_url(DB_PATH).database + '_init'
+        with create_engine(DB_PATH, isolation_level='AUTOCOMMIT').connect() as conn:
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+            conn.execute(text(f'CREATE DATABASE "{name}"'))
+        other = self.setup_other_app(make_url(DB_PATH).set(database=name))
+        runner = other.test_cli_runner()
+
+        #empty database: tables created, stamped with the latest migration
+        result = runner.invoke(init_db_command)
+        self.assertEqual(result.exit_code, 0, result.output)
+        with other.app_context():
+            engine = db.engine
+            self.assertTrue(inspect(engine).has_table('event'))
+            with engine.connect() as conn:
+                version = conn.execute(text('SELECT version_num FROM alembic_version')).scalar()
+        self.assertEqual(version, '1a4f7c3e9b25')
+
+        #up to date database: nothing to do
+        result = runner.invoke(init_db_command)
+        self.assertEqual(result.exit_code, 0, result.output)
+        engine.dispose()
+
+
+@unittest.skipUnless(APP_MODE == 'asgi', 'run with APP_MODE=asgi')
+class AsyncModeTest(unittest.TestCase):
+    def run_concurrently(self, application, n_requests):
+        async def request():
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                sent.append(message)
+
+            await application({'type': 'http', 'method': 'GET', 'path': '/',
+                'query_string': b'', 'headers': []}, receive, send)
+            return sent[0]['status'], b''.join(m.get('body', b'') for m in sent[1:])
+
+        async def gather():
+            return await asyncio.gather(*[request() for _ in range(n_requests)])
+        return asgi_test_app.loop.run_until_complete(gather())
+
+    def test_slow_requests_run_concurrently(self):
+        def slow_query(environ, start_response):
+            with db.engine.connect() as conn:
+                conn.execute(text('SELECT pg_sleep(0.3)'))
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'done']
+
+        start = datetime.now()
+        results = self.run_concurrently(asgi.ASGIAdapter(slow_query), 10)
+        elapsed = (datetime.now() - start).total_seconds()
+        self.assertEqual(results, [(200, b'done')] * 10)
+        #one after the other these would take 3 seconds
+        self.assertLess(elapsed, 1.5)
+
+    def test_request_body_is_read_as_it_arrives(self):
+        messages = [{'type': 'http.request', 'body': b'first\nsec', 'more_body': True},
+            {'type': 'http.request', 'body': b'ond\nlast', 'more_body': False}]
+
+        async def receive():
+            return messages.pop(0)
+
+        def read_lines(environ, start_response):
+            lines = list(environ['wsgi.input'])
+            start_response('200 OK', [])
+            return [b'|'.join(lines)]
+
+        application = asgi.ASGIAdapter(read_lines)
+
+        async def request():
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+            await application({'type': 'http', 'method': 'POST', 'path': '/',
+                'query_string': b'', 'headers': []}, receive, send)
+            return sent
+        sent = asgi_test_app.loop.run_until_complete(request())
+        self.assertEqual(sent[1]['body'], b'first\n|second\n|last')
+
+    def test_concurrent_key_misses_share_one_fetch(self):
+        async def fetch():
+            await asyncio.sleep(0.1)
+            return {'keys': []}
+        store = asgi.AsyncJWKSKeyStore(lambda: asgi.await_only(fetch()))
+
+        def get_key(environ, start_response):
+            start_response('200 OK', [])
+            return [str(store.get_key('kid')).encode()]
+
+        results = self.run_concurrently(asgi.ASGIAdapter(get_key), 5)
+        self.assertEqual(results, [(200, b'None')] * 5)
+        self.assertEqual(store.fetch_count, 1)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,198 @@
+import time
+import threading
+import unittest
+from unittest.mock import patch
+
+from jose import jwt
+from jose.backends.base import Key
+
+import auth
+from auth import AuthError, JWKSKeyStore, TokenCache, make_file_fetcher, verify_decode_jwt
+from test_keys import JWKS_PATH, JWKS_ROTATED_PATH, make_token
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingFetcher(object):
+    def __init__(self, path, delay=0):
+        self.fetch = make_file_fetcher(path)
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.fetch()
+
+
+class JWKSKeyStoreTest(unittest.TestCase):
+    def test_keys_are_fetched_once_within_ttl(self):
+        fetcher = CountingFetcher(JWKS_PATH)
+        store = JWKSKeyStore(fetcher, ttl=600, min_refresh_interval=30)
+
+        for _ in range(5):
+            self.assertIsNotNone(store.get_key('test-key-1'))
+        self.assertEqual(fetcher.calls, 1)
+
+    def test_stale_keys_served_while_refreshing_in_background(self):
+        clock = FakeClock()
+        fetcher = CountingFetcher(JWKS_PATH)
+        store = JWKSKeyStore(fetcher, ttl=600, min_refresh_interval=30, clock=clock)
+        store.get_key('test-key-1')
+
+        clock.now += 601
+        self.assertIsNotNone(store.get_key('test-key-1'))
+        store._background.join()
+        self.assertEqual(fetcher.calls, 2)
+
+    def test_unknown_kid_triggers_refresh(self):
+        fetcher = CountingFetcher(JWKS_PATH)
+        store = JWKSKeyStore(fetcher, ttl=600, min_refresh_interval=0)
+        self.assertIsNone(store.get_key('test-key-2'))
+
+        fetcher.fetch = make_file_fetcher(JWKS_ROTATED_PATH)
+        self.assertIsNotNone(store.get_key('test-key-2'))
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        clock = FakeClock()
+        fetcher = CountingFetcher(JWKS_PATH)
+        store = JWKSKeyStore(fetcher, ttl=600, min_refresh_interval=30, clock=clock)
+
+        for _ in range(10):
+            self.assertIsNone(store.get_key('unknown'))
+        self.assertEqual(fetcher.calls, 1)
+
+        clock.now += 31
+        store.get_key('unknown')
+        self.assertEqual(fetcher.calls, 2)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        fetcher = CountingFetcher(JWKS_ROTATED_PATH, delay=0.2)
+        store = JWKSKeyStore(fetcher, ttl=600, min_refresh_interval=0)
+
+        threads = [threading.Thread(target=store.get_key, args=('test-key-2',))
+            for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(fetcher.calls, 1)
+
+    def test_keys_are_precompiled(self):
+        store = JWKSKeyStore(make_file_fetcher(JWKS_ROTATED_PATH))
+        key = store.get_key('test-key-1')
+
+        self.assertIsInstance(key, Key)
+        self.assertIs(store.get_key('test-key-1'), key)
+        self.assertIsNot(store.get_key('test-key-2'), key)
+
+    def test_failed_refresh_keeps_previous_keys(self):
+        clock = FakeClock()
+        fetcher = CountingFetcher(JWKS_PATH)
+        store = JWKSKeyStore(fetcher, ttl=600, min_refresh_interval=0, clock=clock)
+        store.get_key('test-key-1')
+
+        fetcher.fetch = make_file_fetcher('/does/not/exist.json')
+        store.refresh()
+        self.assertIsNotNone(store.get_key('test-key-1'))
+
+
+class TokenCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.set('a', {'sub': 'a', 'exp': exp})
+        cache.set('b', {'sub': 'b', 'exp': exp})
+        cache.get('a')
+        cache.set('c', {'sub': 'c', 'exp': exp})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a')['sub'], 'a')
+        self.assertEqual(cache.get('c')['sub'], 'c')
+        self.assertEqual(len(cache), 2)
+
+    def test_entry_evicted_at_exp(self):
+        clock = FakeClock()
+        cache = TokenCache(maxsize=10, clock=clock)
+        cache.set('a', {'sub': 'a', 'exp': clock.now + 60})
+        self.assertIsNotNone(cache.get('a'))
+
+        clock.now += 60
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_payload_without_exp_not_cached(self):
+        cache = TokenCache(maxsize=10)
+        cache.set('a', {'sub': 'a'})
+        self.assertIsNone(cache.get('a'))
+
+
+class VerifyDecodeJwtTest(unittest.TestCase):
+    def setUp(self):
+        for name, value in (
+                ('jwks_store', JWKSKeyStore(make_file_fetcher(JWKS_ROTATED_PATH))),
+                ('token_cache', TokenCache(maxsize=10))):
+            patcher = patch.object(auth, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_valid_token(self):
+        payload = verify_decode_jwt(make_token())
+        self.assertEqual(payload['sub'], 'auth0|60c58174612d820070a5f057')
+
+    def test_rotated_key(self):
+        payload = verify_decode_jwt(make_token(kid='test-key-2'))
+        self.assertEqual(payload['permissions'], ['add:event-participant'])
+
+    def test_expired_token(self):
+        with self.assertRaises(AuthError) as ctx:
+            verify_decode_jwt(make_token(expires_in=-10))
+        self.assertEqual(ctx.exception.error['code'], 'token_expired')
+
+    def test_wrong_audience(self):
+        with self.assertRaises(AuthError) as ctx:
+            verify_decode_jwt(make_token(aud='someone-else'))
+        self.assertEqual(ctx.exception.error['code'], 'invalid_claims')
+
+    def test_cached_payload_matches_uncached(self):
+        token = make_token()
+        with patch.object(auth, 'token_cache', TokenCache(maxsize=0)):
+            uncached = verify_decode_jwt(token)
+
+        first = verify_decode_jwt(token)
+        with patch('auth.jwt.decode') as mock_decode:
+            second = verify_decode_jwt(token)
+            mock_decode.assert_not_called()
+
+        self.assertEqual(uncached, first)
+        self.assertEqual(uncached, second)
+        self.assertEqual((auth.token_cache.hits, auth.token_cache.misses), (1, 1))
+
+    def test_cached_path_raises_same_errors(self):
+        tokens = [
+            make_token(expires_in=-10),
+            make_token(aud='someone-else'),
+            make_token(kid='test-key-1')[:-4] + 'abcd',
+        ]
+        for token in tokens:
+            with patch.object(auth, 'token_cache', TokenCache(maxsize=0)):
+                with self.assertRaises(AuthError) as uncached:
+                    verify_decode_jwt(token)
+            for _ in range(2):
+                with self.assertRaises(AuthError) as cached:
+                    verify_decode_jwt(token)
+                self.assertEqual(cached.exception.error, uncached.exception.error)
+                self.assertEqual(cached.exception.status_code,
+                    uncached.exception.status_code)
+        self.assertEqual(len(auth.token_cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
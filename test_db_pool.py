@@ -0,0 +1,109 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+import db_pool
+from db_pool import engine_options, configure_engine, PoolMetrics
+
+DB_HOST = os.environ['DB_HOST']
+DB_USER = os.environ['DB_USER']
+DB_PASSWORD = os.environ['DB_PASSWORD']
+DB_NAME = os.environ['DB_NAME']
+DB_PATH = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
+
+
+class EngineOptionsTest(unittest.TestCase):
+    def test_pool_options(self):
+        with patch.multiple(db_pool, DB_POOL_SIZE=3, DB_MAX_OVERFLOW=1, 
+                DB_POOL_RECYCLE=60, DB_APPLICATION_NAME='worker-1'):
+            options = engine_options(external_pooler=False, statement_timeout=500)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 1)
+        self.assertEqual(options['pool_recycle'], 60)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {
+            'application_name': 'worker-1',
+            'options': '-c statement_timeout=500'
+        })
+
+    def test_external_pooler_options(self):
+        options = engine_options(external_pooler=True, statement_timeout=500)
+        self.assertIs(options['poolclass'], NullPool)
+        self.assertNotIn('options', options['connect_args'])
+
+    def test_async_driver_options(self):
+        with patch.object(db_pool, 'DB_APPLICATION_NAME', 'worker-1'):
+            options = engine_options(external_pooler=False, statement_timeout=500,
+                async_driver=True)
+        self.assertEqual(options['connect_args'], {'server_settings': {
+            'application_name': 'worker-1',
+            'statement_timeout': '500'
+        }})
+
+        options = engine_options(external_pooler=True, statement_timeout=500, async_driver=True)
+        self.assertEqual(options['connect_args']['statement_cache_size'], 0)
+        self.assertNotIn('statement_timeout', options['connect_args']['server_settings'])
+
+    def test_database_url(self):
+        self.assertEqual(db_pool.database_url(DB_PATH, async_driver=False).drivername,
+            'postgresql+psycopg2')
+        url = db_pool.database_url(DB_PATH, async_driver=True, async_fallback=False)
+        self.assertEqual(url.drivername, 'postgresql+asyncpg')
+        self.assertNotIn('async_fallback', url.query)
+
+
+class PoolTest(unittest.TestCase):
+    def make_engine(self, external_pooler=False, statement_timeout=0):
+        engine = configure_engine(
+            create_engine(DB_PATH, **engine_options(external_pooler, statement_timeout)),
+            external_pooler, statement_timeout)
+        self.addCleanup(engine.dispose)
+        return engine
+
+    def test_statement_timeout(self):
+        for external_pooler in (False, True):
+            engine = self.make_engine(external_pooler, statement_timeout=100)
+            with engine.begin() as conn:
+                self.assertEqual(conn.execute(text('SHOW statement_timeout')).scalar(), '100ms')
+                self.assertEqual(conn.execute(text('SHOW application_name')).scalar(), 
+                    db_pool.DB_APPLICATION_NAME)
+                with self.assertRaises(OperationalError):
+                    conn.execute(text('SELECT pg_sleep(1)'))
+
+    def test_pool_metrics(self):
+        engine = self.make_engine()
+        metrics = PoolMetrics(engine, clock=iter(range(100)).__next__)
+        with engine.connect() as first:
+            with engine.connect() as second:
+                self.assertEqual(metrics.checked_out, 2)
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+
+        stats = metrics.stats()
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['connects'], 2) #the third checkout reuses a connection
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['max_checked_out'], 2)
+        self.assertEqual(stats['invalidations'], 0)
+
+    def test_dead_connections_are_replaced(self):
+        engine = self.make_engine()
+        metrics = PoolMetrics(engine)
+        with engine.connect() as conn:
+            pid = conn.execute(text('SELECT pg_backend_pid()')).scalar()
+        #i.e. a failover closing every connection
+        with create_engine(DB_PATH, poolclass=NullPool).connect() as admin:
+            admin.execute(text('SELECT pg_terminate_backend(:pid)'), {'pid': pid})
+
+        with engine.connect() as conn:
+            self.assertNotEqual(conn.execute(text('SELECT pg_backend_pid()')).scalar(), pid)
+        self.assertEqual(metrics.invalidations, 1)
+        self.assertEqual(metrics.connects, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
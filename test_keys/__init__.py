@@ -0,0 +1,32 @@
+"""Local RSA test keys standing in for the Auth0 signing keys, shared by the
+tests and the benchmarks.
+
+test-key-1 is published in jwks.json, jwks_rotated.json adds test-key-2.
+"""
+import os
+import time
+
+from jose import jwt
+
+import auth
+
+KEYS_DIR = os.path.dirname(os.path.abspath(__file__))
+JWKS_PATH = os.path.join(KEYS_DIR, 'jwks.json')
+JWKS_ROTATED_PATH = os.path.join(KEYS_DIR, 'jwks_rotated.json')
+
+
+def make_token(kid='test-key-1', expires_in=3600, **claims):
+    """Sign a token with one of the local test keys"""
+    with open(os.path.join(KEYS_DIR, f'{kid}.pem')) as f:
+        private_key = f.read()
+    now = int(time.time())
+    payload = {
+        'iss': f'https://{auth.AUTH0_DOMAIN}/',
+        'aud': auth.API_AUDIENCE,
+        'sub': 'auth0|60c58174612d820070a5f057',
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': ['add:event-participant'],
+    }
+    payload.update(claims)
+    return jwt.encode(payload, private_key, algorithm='RS256', headers={'kid': kid})
@@ -0,0 +1,222 @@
+import os
+import json
+import unittest
+from unittest.mock import patch
+
+from jose import jwt
+from sqlalchemy import create_engine, select, text, event as sa_event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError
+
+from app import app
+from models import setup_db, Event
+from fixtures import reset_db_with_fixtures
+from response_cache import response_cache, REPLICA_RESPONSE_TTL
+from replicas import replica_set, sticky_subjects
+
+DB_HOST = os.environ['DB_HOST']
+DB_USER = os.environ['DB_USER']
+DB_PASSWORD = os.environ['DB_PASSWORD']
+DB_NAME = os.environ['DB_NAME']
+DB_PATH = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
+#a second local database standing in for a replica
+REPLICA_PATH = make_url(DB_PATH).set(database=make_url(DB_PATH).database + '_replica')
+
+db = setup_db(app, database_path=DB_PATH)
+client = app.test_client
+
+USER_SUB = 'auth0|60c58174612d820070a5f057'
+ORG_SUB = 'auth0|60c58135612d820070a5f049'
+#name of event 1 in the fixtures
+PRIMARY_NAME = 'test event 0'
+
+
+def bearer(sub):
+    return {'Authorization': 'Bearer ' + jwt.encode({'sub': sub}, 'secret', algorithm='HS256')}
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with create_engine(DB_PATH, isolation_level='AUTOCOMMIT').connect() as conn:
+            exists = conn.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                {'name': REPLICA_PATH.database}).scalar()
+            if not exists:
+                conn.execute(text(f'CREATE DATABASE "{REPLICA_PATH.database}"'))
+
+    def setUp(self):
+        """copy the fixtures to the replica, with event 1 renamed there"""
+        reset_db_with_fixtures(db=db)
+        response_cache.clear()
+        replica = create_engine(REPLICA_PATH)
+        db.Model.metadata.drop_all(replica)
+        db.Model.metadata.create_all(replica)
+        with db.engine.connect() as source, replica.begin() as target:
+            for table in db.Model.metadata.sorted_tables:
+                #generated columns are computed again by the replica
+                columns = [column for column in table.c if column.computed is None]
+                rows = source.execute(select(*columns)).mappings().all()
+                if rows:
+                    target.execute(table.insert(), [dict(row) for row in rows])
+            target.execute(text("UPDATE event SET name = 'replica copy' WHERE id = 1"))
+        replica.dispose()
+
+        #checks are run by the tests rather than in the background
+        patcher = patch.object(replica_set, '_checks_pid', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('replicas.spawn')
+        self.spawn = patcher.start()
+        self.addCleanup(patcher.stop)
+        replica_set.configure([REPLICA_PATH])
+        replica_set.check_all()
+        self.addCleanup(replica_set.configure, [])
+        self.addCleanup(sticky_subjects.clear)
+
+    def tearDown(self):
+        db.session.close()
+
+    def get_event_name(self, headers=None):
+        response_cache.clear()
+        res = client().get('/events/1', headers=headers or {})
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['data']['name']
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.get_event_name(), 'replica copy')
+        res = client().get('/events?limit=1')
+        self.assertEqual(json.loads(res.data)['data'][0]['name'], 'replica copy')
+        #outside of requests everything runs on the primary
+        self.assertNotEqual(Event.query.get(1).name, 'replica copy')
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_read_your_writes(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': USER_SUB,
+            'permissions': ['add:event-participant']
+        }
+        res = client().post('/events/3/participants', json={'user_id': 1},
+            headers=bearer(USER_SUB))
+        self.assertEqual(res.status_code, 200)
+        #the write went to the primary
+        self.assertIn(1, [u.id for u in Event.query.get(3).participants])
+
+        self.assertEqual(self.get_event_name(bearer(USER_SUB)), PRIMARY_NAME)
+        self.assertEqual(self.get_event_name(bearer('someone else')), 'replica copy')
+        self.assertEqual(self.get_event_name(), 'replica copy')
+
+        with patch.object(sticky_subjects, 'clock', lambda: float('inf')):
+            self.assertEqual(self.get_event_name(bearer(USER_SUB)), 'replica copy')
+
+    @patch('auth.get_token_auth_header')
+    @patch('auth.verify_decode_jwt')
+    def test_cached_reads_after_writes(self, mock_verify_decode_jwt, mock_get_auth_header):
+        mock_get_auth_header.return_value = 'some_token'
+        mock_verify_decode_jwt.return_value = {
+            'sub': ORG_SUB,
+            'permissions': ['update:event']
+        }
+        response_cache.clear()
+        res = client().patch('/events/1', json={'name': 'renamed'}, headers=bearer(ORG_SUB))
+        self.assertEqual(res.status_code, 200)
+
+        #the replica hasn't seen the write, its response is cached briefly
+        res = client().get('/events/1')
+        self.assertEqual(json.loads(res.data)['data']['name'], 'replica copy')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+
+        #the writer skips it and reads the primary, and that response is cached
+        res = client().get('/events/1', headers=bearer(ORG_SUB))
+        self.assertEqual(json.loads(res.data)['data']['name'], 'renamed')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = client().get('/events/1')
+        self.assertEqual(json.loads(res.data)['data']['name'], 'renamed')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        #entries stored before a write are skipped by the writer
+        response_cache.set(response_cache.row_key('event', 1), (b'{"data": {"name": "stale"}}',
+            {'Content-Type': 'application/json'}))
+        res = client().get('/events/1', headers=bearer(ORG_SUB))
+        self.assertEqual(json.loads(res.data)['data']['name'], 'renamed')
+
+    def test_replica_reads_are_cached(self):
+        response_cache.clear()
+        for expected in ('MISS', 'HIT'):
+            res = client().get('/events/1')
+            self.assertEqual(json.loads(res.data)['data']['name'], 'replica copy')
+            self.assertEqual(res.headers['X-Cache'], expected)
+        res = client().get('/events?limit=1')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = client().get('/events?limit=1')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        #for no longer than a replica may lag
+        backend = response_cache.backend
+        now = backend.clock()
+        with patch.object(backend, 'clock', lambda: now + REPLICA_RESPONSE_TTL):
+            res = client().get('/events/1')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+
+    def test_one_replica_per_request(self):
+        replica_set.configure([REPLICA_PATH, REPLICA_PATH])
+        replica_set.check_all()
+        statements = {}
+        for replica in replica_set.replicas:
+            sa_event.listen(replica.engine, 'before_cursor_execute',
+                lambda conn, *args: statements.setdefault(conn.engine, []).append(args[1]))
+
+        #the organisation, its past and its upcoming events on one replica,
+        #the next request on the other
+        engines = []
+        for _ in range(2):
+            response_cache.clear()
+            statements.clear()
+            res = client().get('/organisations/1')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(statements), 1)
+            engine, request_statements = statements.popitem()
+            self.assertGreater(len(request_statements), 1)
+            engines.append(engine)
+        self.assertNotEqual(engines[0], engines[1])
+
+    def test_checks_run_off_the_request_path(self):
+        replica_set.configure([REPLICA_PATH])
+        #not checked yet, reads go to the primary and nothing is checked inline
+        self.assertEqual(self.get_event_name(), PRIMARY_NAME)
+        self.assertIsNone(replica_set.replicas[0].checked_at)
+        self.spawn.assert_called_once_with(replica_set.run_checks)
+
+        replica_set.check_all()
+        self.assertEqual(self.get_event_name(), 'replica copy')
+
+    def test_failing_replicas_are_ejected(self):
+        broken = REPLICA_PATH.set(database='no_such_database')
+        replica_set.configure([broken, REPLICA_PATH])
+        replica_set.check_all()
+        for _ in range(3):
+            self.assertEqual(self.get_event_name(), 'replica copy')
+        self.assertEqual(replica_set.stats(), {'replicas': 2, 'healthy': 1, 'ejections': 1})
+
+        #no healthy replica left, reads fall back to the primary
+        replica_set.configure([broken])
+        replica_set.check_all()
+        self.assertEqual(self.get_event_name(), PRIMARY_NAME)
+
+    def test_replicas_out_of_connections_are_ejected(self):
+        engine = replica_set.replicas[0].engine
+        with patch.object(engine, 'connect', side_effect=TimeoutError('pool timeout')):
+            replica_set.check_all()
+        self.assertEqual(self.get_event_name(), PRIMARY_NAME)
+        self.assertEqual(replica_set.stats()['healthy'], 0)
+
+    def test_lagging_replicas_are_ejected(self):
+        with patch.object(replica_set, 'max_lag', -1):
+            replica_set.check_all()
+        self.assertEqual(self.get_event_name(), PRIMARY_NAME)
+        self.assertEqual(replica_set.stats()['healthy'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
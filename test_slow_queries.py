@@ -0,0 +1,155 @@
+import os
+import json
+import logging
+import tempfile
+import unittest
+
+from sqlalchemy import text
+
+from app import app
+from models import setup_db, Event
+from fixtures import reset_db_with_fixtures
+from response_cache import response_cache
+from slow_queries import SlowQueryLog, normalize, fingerprint, read_log, summarise, \
+    slow_queries_command
+
+DB_HOST = os.environ['DB_HOST']
+DB_USER = os.environ['DB_USER']
+DB_PASSWORD = os.environ['DB_PASSWORD']
+DB_NAME = os.environ['DB_NAME']
+DB_PATH = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
+
+db = setup_db(app, database_path=DB_PATH)
+client = app.test_client
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+
+    def emit(self, record):
+        self.entries.append(json.loads(record.getMessage()))
+
+
+class FingerprintTest(unittest.TestCase):
+    def test_values_are_normalized(self):
+        self.assertEqual(
+            normalize("SELECT * FROM event WHERE id IN (%(id_1_1)s, %(id_1_2)s) "
+                "AND name = 'it''s'  AND age > 17"),
+            'SELECT * FROM event WHERE id IN (...) AND name = ? AND age > ?')
+        self.assertEqual(normalize('INSERT INTO t (a, b) VALUES ($1, $2), ($3, $4)'),
+            'INSERT INTO t (a, b) VALUES (...)')
+        #column names with digits are kept
+        self.assertEqual(normalize('SELECT event_1.id FROM event AS event_1'),
+            'SELECT event_1.id FROM event AS event_1')
+
+    def test_same_query_with_other_values_shares_a_fingerprint(self):
+        self.assertEqual(
+            fingerprint('SELECT 1 FROM event WHERE id IN (%(p_1)s, %(p_2)s)'),
+            fingerprint('SELECT 1 FROM event WHERE id IN (%(p_1)s, %(p_2)s, %(p_3)s)'))
+        self.assertNotEqual(fingerprint('SELECT 1 FROM event'), fingerprint('SELECT 1 FROM "user"'))
+
+
+class SlowQueryLogTest(unittest.TestCase):
+    def setUp(self):
+        reset_db_with_fixtures(db=db)
+        response_cache.clear()
+        self.handler = ListHandler()
+        logger = logging.getLogger('test_slow_queries')
+        logger.addHandler(self.handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        self.addCleanup(logger.removeHandler, self.handler)
+        self.log = SlowQueryLog(threshold_ms=0, explain_sample=0, logger=logger)
+        self.log.attach()
+        self.addCleanup(self.log.detach)
+
+    def tearDown(self):
+        db.session.close()
+
+    def test_slow_queries_are_logged_with_their_route(self):
+        res = client().get('/events/1')
+        self.assertEqual(res.status_code, 200)
+        entry = self.handler.entries[-1]
+        self.assertEqual((entry['method'], entry['route'], entry['path']),
+            ('GET', '/events/<int:event_id>', '/events/1'))
+        self.assertIn(1, entry['params'].values())
+        self.assertEqual(entry['fingerprint'], fingerprint(entry['statement']))
+        self.assertNotIn('plan', entry)
+
+        self.handler.entries.clear()
+        self.log.threshold_ms = 10000
+        client().get('/events/2')
+        self.assertEqual(self.handler.entries, [])
+
+    def test_sampled_explain(self):
+        self.log.explain_sample = 1
+        Event.query.filter(Event.id == 1).first()
+        entry = self.handler.entries[-1]
+        self.assertIsNone(entry['route'])
+        plan = entry['plan'][0]
+        self.assertIn('Plan', plan)
+        self.assertIn('Shared Hit Blocks', plan['Plan'])
+        self.assertIn('Execution Time', plan)
+
+        #writes aren't run again
+        event = Event.query.get(2)
+        event.name = 'renamed'
+        event.update()
+        update = [e for e in self.handler.entries if e['statement'].startswith('UPDATE event')]
+        self.assertNotIn('plan', update[0])
+        self.assertEqual(Event.query.get(2).name, 'renamed')
+
+    def test_failing_explain_keeps_the_transaction(self):
+        with db.engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+            self.assertEqual(self.log.explain(conn, 'SELECT no_such_column', {})['error'][:6],
+                'column')
+            self.assertEqual(conn.execute(text('SELECT 2')).scalar(), 2)
+
+
+class SummaryTest(unittest.TestCase):
+    def make_log(self):
+        entries = [
+            {'fingerprint': 'a', 'statement': 'SELECT * FROM event WHERE id = %(id)s',
+                'duration_ms': 10, 'method': 'GET', 'route': '/events/<int:event_id>'},
+            {'fingerprint': 'a', 'statement': 'SELECT * FROM event WHERE id = %(id)s',
+                'duration_ms': 30, 'method': 'GET', 'route': '/events/<int:event_id>',
+                'plan': [{'Plan': {}}]},
+            {'fingerprint': 'b', 'statement': 'SELECT * FROM "user"', 'duration_ms': 25,
+                'route': None},
+        ]
+        f = tempfile.NamedTemporaryFile('w', suffix='.log', delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write('not json\n')
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        return f.name
+
+    def test_summarise_by_fingerprint(self):
+        with open(self.make_log()) as f:
+            summary = summarise(read_log(f))
+        self.assertEqual([row['fingerprint'] for row in summary], ['a', 'b'])
+        self.assertEqual(summary[0]['count'], 2)
+        self.assertEqual((summary[0]['total_ms'], summary[0]['mean_ms'], summary[0]['max_ms']),
+            (40, 20, 30))
+        self.assertEqual(summary[0]['routes'], ['GET /events/<int:event_id>'])
+        self.assertEqual(summary[0]['statement'], 'SELECT * FROM event WHERE id = ?')
+        self.assertEqual(summary[0]['plans'], 1)
+
+    def test_slow_queries_command(self):
+        path = self.make_log()
+        result = app.test_cli_runner().invoke(slow_queries_command, [path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        lines = result.output.splitlines()
+        self.assertTrue(lines[0].startswith('a'))
+        self.assertIn('2 x  total 40.0 ms', lines[0])
+
+        result = app.test_cli_runner().invoke(slow_queries_command, [path, '--json', '--top', '1'])
+        self.assertEqual([row['fingerprint'] for row in json.loads(result.output)], ['a'])
+
+
+if __name__ == "__main__":
+    unittest.main()